@@ -0,0 +1,385 @@
+"""
+Микробенчмарки горячих функций бота без токена и сети.
+
+Скрипт импортирует bot.py с фиктивным токеном (сеть при этом не используется)
+и замеряет: build_menu, split_long_message, tales_menu_kb и story_menu_kb
+(холодную сборку и готовую клавиатуру из реестра), поиск по ручному словарю
+и predict_themes гибридного классификатора, цену записи в лог для цикла событий,
+compress_image на иллюстрации
+и каждый метод Database при нескольких одновременных потоках-писателях
+(на временной базе).
+
+Результаты сохраняются в JSON. При сравнении с базовым прогоном (--baseline)
+медиана каждого замера сравнивается с базовой, и замедление больше порога
+(--threshold) считается регрессией: скрипт печатает её и завершается с кодом 1.
+
+Пример:
+    python bench.py --output baseline.json
+    python bench.py --baseline baseline.json --threshold 0.15
+    python bench.py --only story_menu_kb --only db.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+BASE_DIR = Path(__file__).parent
+
+# bot.py читает данные по относительным путям и требует токен при импорте
+os.chdir(BASE_DIR)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("FSM_STORAGE", "memory")
+
+import bot  # noqa: E402
+
+from fake_bot_api import percentile  # noqa: E402
+
+# Логи обработчиков (например, story_menu_kb) не должны попадать в замеры и вывод
+bot.logger.setLevel(logging.WARNING)
+logger = logging.getLogger("bench")
+
+# Слово, которого нет в ручном словаре: поиск проходит весь словарь
+MISSING_WORD = "абракадабра"
+
+
+def summarize(per_op: List[float]) -> dict:
+    """Статистика по временам одной операции, мкс"""
+    per_op_us = [value * 1e6 for value in per_op]
+    median = statistics.median(per_op_us)
+    return {
+        "samples": len(per_op_us),
+        "median_us": round(median, 3),
+        "mean_us": round(statistics.fmean(per_op_us), 3),
+        "min_us": round(min(per_op_us), 3),
+        "p95_us": round(percentile(per_op_us, 95), 3),
+        "stdev_us": round(statistics.stdev(per_op_us), 3) if len(per_op_us) > 1 else 0.0,
+        "ops_per_s": round(1e6 / median, 1) if median else 0.0,
+    }
+
+
+async def measure(func: Callable, samples: int, min_sample_time: float) -> dict:
+    """
+    Замеряет функцию (обычную или корутинную): число вызовов в одном замере
+    подбирается так, чтобы замер длился не меньше min_sample_time.
+    """
+    # Замеры задаются лямбдами, поэтому корутину распознаём по первому вызову
+    probe = func()
+    is_async = inspect.isawaitable(probe)
+    if is_async:
+        await probe
+
+    async def run(loops: int) -> float:
+        started = time.perf_counter()
+        if is_async:
+            for _ in range(loops):
+                await func()
+        else:
+            for _ in range(loops):
+                func()
+        return time.perf_counter() - started
+
+    # Прогрев и подбор числа вызовов
+    loops = 1
+    while True:
+        elapsed = await run(loops)
+        if elapsed >= min_sample_time or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_sample_time / 10 else 2
+
+    per_op = [await run(loops) / loops for _ in range(samples)]
+    result = summarize(per_op)
+    result["loops"] = loops
+    return result
+
+
+# --- Замеры функций бота ---
+def sample_story() -> dict:
+    """Самая длинная сказка: худший случай для разбиения текста"""
+    return max(bot.tales_data['stories'], key=lambda story: len(story['rus_text']))
+
+
+def sample_image() -> Optional[Path]:
+    images = sorted(path for path in (BASE_DIR / "illustraciones").rglob("*")
+                    if path.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"))
+    return images[0] if images else None
+
+
+def sample_unknown_words(limit: int = 50) -> List[str]:
+    """Слова из лексики сказок, которых нет в ручном словаре (идут в нейросеть)"""
+    words = []
+    for story in bot.tales_data['stories']:
+        for word in story.get('rus_words') or []:
+            clean = bot.hybrid_classifier.clean_input_word(word)
+            if clean and clean not in bot.manual_dictionary and clean not in words:
+                words.append(clean)
+    return words[:limit] or [MISSING_WORD]
+
+
+def cycle(values: list) -> Callable[[], object]:
+    """Возвращает следующий элемент списка при каждом вызове"""
+    state = {"index": 0}
+
+    def next_value():
+        value = values[state["index"] % len(values)]
+        state["index"] += 1
+        return value
+    return next_value
+
+
+def function_benchmarks() -> Dict[str, Callable[[], Awaitable]]:
+    """Имя замера -> функция без аргументов"""
+    story = sample_story()
+    story_id = story['id']
+    story_ids = [s['id'] for s in bot.tales_data['stories']]
+    tale_buttons = [(s['rus_title'], bot.pack_callback(bot.CALLBACK_SHOW_STORY, s['id']))
+                    for s in bot.tales_data['stories'][:5]]
+    story_text = f"📖 <b>{story['rus_title']}</b>\n{story['rus_text']}"
+    known_words = list(bot.manual_dictionary)[:50] or [MISSING_WORD]
+    next_known = cycle(known_words)
+    unknown_words = sample_unknown_words()
+    next_unknown = cycle(unknown_words)
+    next_story_id = cycle(story_ids)
+    classifier = bot.hybrid_classifier
+    predict_uncached = bot.HybridThemeClassifier.predict_themes.__wrapped__
+
+    benchmarks = {
+        "build_menu": lambda: bot.build_menu(
+            tale_buttons,
+            back_button=("🗂️ Главное меню", bot.pack_callback(bot.CALLBACK_BACK_TO_MAIN)),
+            additional_buttons=[("Вперёд ▶️", bot.pack_callback(bot.CALLBACK_TALES_PAGE_PREFIX, 1))],
+            columns=1
+        ),
+        "split_long_message": lambda: bot.split_long_message(story_text),
+        "tales_menu_kb[cold]": lambda: bot.tales_menu_kb.__wrapped__(1),
+        "tales_menu_kb[cached]": lambda: bot.tales_menu_kb(1),
+        "story_menu_kb[cold]": lambda: bot.story_buttons_kb.__wrapped__(next_story_id()),
+        "story_menu_kb[cached]": lambda: bot.story_menu_kb(story_id),
+        "smart_dict_search[hit]": lambda: classifier.smart_dict_search(next_known()),
+        "smart_dict_search[miss]": lambda: classifier.smart_dict_search(MISSING_WORD),
+        "predict_themes[cold]": lambda: predict_uncached(classifier, next_unknown()),
+        "predict_themes[cached]": lambda: classifier.predict_themes(next_unknown()),
+    }
+
+    benchmarks.update(logging_benchmarks())
+
+    image = sample_image()
+    if image:
+        benchmarks["compress_image"] = lambda: bot.compress_image(image)
+    else:
+        logger.warning("Иллюстрации не найдены, compress_image пропущен")
+    return benchmarks
+
+
+class DiscardQueue:
+    """Очередь без потока записи: замеряется только то, что платит цикл событий"""
+
+    def put_nowait(self, item):
+        pass
+
+
+def logging_benchmarks() -> Dict[str, Callable[[], object]]:
+    """Цена записи в лог для вызывающего кода: через очередь, с отбрасыванием и выключенный уровень"""
+    queued = logging.getLogger("bench.logging.queued")
+    limited = logging.getLogger("bench.logging.limited")
+    for bench_logger in (queued, limited):
+        bench_logger.propagate = False
+        bench_logger.setLevel(logging.INFO)
+        bench_logger.addHandler(bot.LogQueueHandler(DiscardQueue()))
+    limited.addFilter(bot.LogRateLimitFilter(rate=0))
+    disabled = logging.getLogger("bench.logging.disabled")
+    disabled.setLevel(logging.INFO)
+    return {
+        "logging[queued]": lambda: queued.info("Обновление %s обработано", 42, extra={"handler": "bench"}),
+        "logging[rate_limited]": lambda: limited.info("Обновление %s обработано", 42),
+        "logging[disabled]": lambda: disabled.debug("Обновление %s обработано", 42),
+    }
+
+
+# --- Замеры базы данных ---
+def db_operations(db: "bot.Database", user_ids: List[int], tale_ids: List[int]) -> Dict[str, Callable[[int], object]]:
+    """Метод Database -> вызов для i-й операции"""
+    users = {user_id: bot.types.User(id=user_id, is_bot=False, first_name=f"Learner{user_id}")
+             for user_id in user_ids}
+
+    def pick(i: int):
+        return user_ids[i % len(user_ids)], tale_ids[i % len(tale_ids)]
+
+    return {
+        "add_user": lambda i: db.add_user(users[user_ids[i % len(user_ids)]]),
+        "update_tale_progress": lambda i: db.update_tale_progress(*pick(i)),
+        "mark_tale_completed": lambda i: db.mark_tale_completed(*pick(i)),
+        "save_test_result": lambda i: db.save_test_result(*pick(i), i % 10, i % 2 == 0),
+        "get_user_progress": lambda i: db.get_user_progress(pick(i)[0]),
+    }
+
+
+def measure_db_method(operation: Callable[[int], object], writers: int, calls: int) -> dict:
+    """Запускает writers потоков, каждый делает calls вызовов метода одновременно с остальными"""
+    barrier = threading.Barrier(writers)
+    latencies: List[float] = []
+    errors = []
+    lock = threading.Lock()
+
+    def writer(index: int):
+        local = []
+        barrier.wait()
+        for call in range(calls):
+            started = time.perf_counter()
+            try:
+                operation(index * calls + call)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        list(executor.map(writer, range(writers)))
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies) if latencies else {"samples": 0}
+    result.update({
+        "writers": writers,
+        "throughput_ops_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "errors": len(errors),
+        "locked": sum("locked" in error for error in errors),
+    })
+    return result
+
+
+def run_db_benchmarks(writers: int, calls: int, selected: Callable[[str], bool]) -> Dict[str, dict]:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = bot.Database(str(Path(tmp) / "bench.db"))
+        user_ids = list(range(100000, 100000 + 200))
+        tale_ids = [story['id'] for story in bot.tales_data['stories']]
+        for name, operation in db_operations(db, user_ids, tale_ids).items():
+            if not selected(f"db.{name}"):
+                continue
+            logger.info(f"Замер db.{name}: {writers} потоков × {calls} вызовов")
+            results[f"db.{name}"] = measure_db_method(operation, writers, calls)
+    return results
+
+
+# --- Сравнение с базовым прогоном ---
+def compare(current: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[dict]:
+    """Сравнивает медианы; ratio > 1 + threshold — регрессия"""
+    rows = []
+    for name, result in current.items():
+        base = baseline.get(name)
+        if not base or not base.get("median_us") or not result.get("median_us"):
+            continue
+        ratio = result["median_us"] / base["median_us"]
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append({
+            "name": name,
+            "baseline_us": base["median_us"],
+            "current_us": result["median_us"],
+            "ratio": round(ratio, 3),
+            "status": status,
+        })
+    return rows
+
+
+def print_results(results: Dict[str, dict], comparison: List[dict]):
+    by_name = {row["name"]: row for row in comparison}
+    width = max(len(name) for name in results) if results else 10
+    print(f"{'замер':<{width}}  {'медиана, мкс':>14}  {'p95, мкс':>12}  {'к базе':>8}")
+    for name, result in results.items():
+        row = by_name.get(name)
+        versus = f"{row['ratio']:.2f}x" if row else "—"
+        marker = "  ⚠️ регрессия" if row and row["status"] == "regression" else ""
+        print(f"{name:<{width}}  {result.get('median_us', 0):>14.2f}  {result.get('p95_us', 0):>12.2f}  "
+              f"{versus:>8}{marker}")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run(args) -> int:
+    def selected(name: str) -> bool:
+        return not args.only or any(name.startswith(prefix) for prefix in args.only)
+
+    # Данные загружаются фазами запуска бота, модели — как при прогреве
+    await asyncio.gather(*bot.start_startup_phases(bot.phase_names(critical=True)))
+    await asyncio.to_thread(bot.load_theme_models)
+
+    results: Dict[str, dict] = {}
+    for name, func in function_benchmarks().items():
+        if selected(name):
+            logger.info(f"Замер {name}")
+            results[name] = await measure(func, args.samples, args.min_time)
+    results.update(run_db_benchmarks(args.db_writers, args.db_calls, selected))
+
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "samples": args.samples,
+            "min_time_s": args.min_time,
+        },
+        "results": results,
+    }
+
+    comparison = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            comparison = compare(results, json.load(f)["results"], args.threshold)
+        report["comparison"] = comparison
+
+    print_results(results, comparison)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    regressions = [row["name"] for row in comparison if row["status"] == "regression"]
+    if regressions:
+        print(f"Регрессии (порог {args.threshold:.0%}): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих функций бота")
+    parser.add_argument("--samples", type=int, default=20, help="число замеров каждой функции")
+    parser.add_argument("--min-time", type=float, default=0.02, help="минимальная длительность одного замера, с")
+    parser.add_argument("--db-writers", type=int, default=8, help="одновременных потоков на метод Database")
+    parser.add_argument("--db-calls", type=int, default=200, help="вызовов метода Database на поток")
+    parser.add_argument("--only", action="append", default=[], metavar="PREFIX",
+                        help="запускать только замеры с этим префиксом (можно несколько раз)")
+    parser.add_argument("--baseline", help="JSON базового прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление медианы (0.2 — 20%%)")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+    try:
+        sys.exit(asyncio.run(run(args)))
+    finally:
+        bot.image_executor.shutdown(wait=False)
@@ -1,29 +1,57 @@
 import os
 import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import nest_asyncio
 from aiogram.fsm.context import FSMContext  
 from PIL import Image, ImageFile
 import io
+import shutil
+import time
+PROCESS_STARTED = time.perf_counter()  # отсчёт для отчёта о запуске
+import heapq
+import atexit
+import queue
+import sys
+import threading
+import hashlib
+import hmac
+import secrets
+import copy
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 nest_asyncio.apply()
 import asyncio
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict
-from collections import defaultdict
+from typing import Callable, List, Tuple, Optional, Dict
+from collections import Counter, defaultdict, OrderedDict
 import re
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
-from aiogram.enums import ParseMode
+from aiogram.enums import ChatAction, ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import AiogramError
+from aiogram.exceptions import AiogramError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiohttp import ClientSession, TraceConfig, web
+from pydantic import ConfigDict
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram import __version__ as aiogram_version
 import aiofiles
 import html
 from aiogram.enums import ParseMode
 import sqlite3
-from contextlib import closing
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from aiogram.types import BotCommand
 from aiogram.filters import Command
@@ -45,7 +73,8 @@ import numpy as np
 from natasha import Segmenter, MorphVocab, NewsMorphTagger, NewsEmbedding, Doc
 from typing import Dict, List, Set
 import re
-from functools import lru_cache
+from functools import lru_cache, partial, wraps
+from bisect import bisect_left
 from collections import defaultdict
 from aiogram import F, types
 from aiogram.utils.keyboard import InlineKeyboardBuilder
@@ -67,69 +96,632 @@ from collections import defaultdict
 
 
 
+# --- Явная загрузка .env ---
+env_path = Path(__file__).parent / '.env'
+load_dotenv(env_path)
+
 # --- Настройка логов ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Цикл событий только кладёт записи в очередь; форматирование и запись в stderr
+# выполняет отдельный поток (QueueListener).
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json — строка JSON на запись, text — как раньше
+# Уровни отдельных логгеров, например "aiogram=WARNING,__main__.hot=DEBUG"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# Частые записи (на каждое обновление): не больше LOG_HOT_RATE в секунду с одного места в коде
+LOG_HOT_RATE = float(os.getenv("LOG_HOT_RATE", "5"))
+LOG_HOT_LOGGERS = ("aiogram.event",)
+
+# Стандартные атрибуты записи; всё остальное пришло через extra и попадает в JSON
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Строка JSON: время, уровень, логгер, функция, текст и поля из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь: подставляет аргументы и готовит трассировку
+    (объекты исключения не передаются в другой поток), остальное — в потоке записи.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.counts: Counter = Counter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.counts[record.levelname] += 1
+        return record
+
+
+class LogRateLimitFilter(logging.Filter):
+    """
+    Пропускает не больше rate записей в секунду с одного места в коде (логгер и строка)
+    ниже уровня ERROR. Число отброшенных записей добавляется к следующей пропущенной
+    записи полем suppressed.
+    """
+
+    def __init__(self, rate: float = LOG_HOT_RATE):
+        super().__init__()
+        self.rate = rate
+        # место в коде -> [начало окна, пропущено, отброшено]
+        self.windows: Dict[tuple, list] = {}
+        self.suppressed_total = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= 1.0:
+            if window and window[2]:
+                record.suppressed = window[2]
+            window = self.windows[key] = [record.created, 0, 0]
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        self.suppressed_total += 1
+        return False
+
+
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_queue_handler = LogQueueHandler(log_queue)
+log_rate_limit = LogRateLimitFilter()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+log_listener = QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+
+
+def configure_logging():
+    root = logging.getLogger()
+    root.handlers[:] = [log_queue_handler]
+    root.setLevel(LOG_LEVEL.upper())
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    for name in (*LOG_HOT_LOGGERS, f"{__name__}.hot"):
+        logging.getLogger(name).addFilter(log_rate_limit)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+configure_logging()
 logger = logging.getLogger(__name__)
+# Записи, которые появляются на каждое обновление, — с ограничением частоты
+hot_logger = logging.getLogger(f"{__name__}.hot")
 
 themes_dict: Dict[str, List[Tuple[str, str]]] = {}
 
-# --- Явная загрузка .env ---
-env_path = Path(__file__).parent / '.env'
-load_dotenv(env_path)
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     raise ValueError("Не задан TELEGRAM_BOT_TOKEN в .env файле")
 
+# Адрес Bot API (например, локальная заглушка fake_bot_api.py для замеров)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# --- Режим получения обновлений ---
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling (для разработки) или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+
 # --- Константы callback_data ---
-CALLBACK_TALES = "tales"
-CALLBACK_VOCABULARY = "vocabulary"
-CALLBACK_GRAMMAR = "grammar"
-CALLBACK_LEXICON = "lexicon"
-CALLBACK_BACK_TO_MAIN = "back_to_main"
-CALLBACK_BACK_TO_TALES = "back_to_tales"
-CALLBACK_BACK_TO_VOCABULARY = "back_to_vocabulary"
-CALLBACK_SHOW_STORY = "show_story_"
-CALLBACK_SHOW_GRAMMAR = "show_grammar_"
-CALLBACK_SHOW_LEXICON = "show_lexicon_"
-CALLBACK_LANGUAGE_RU = "lang_ru_"
-CALLBACK_LANGUAGE_KH = "lang_kh_"
-CALLBACK_BACK_TO_LANGUAGE = "back_to_lang_"
-CALLBACK_PLAY_AUDIO = "play_audio_"
-CALLBACK_ALPHABET = "alphabet"
-CALLBACK_ALPHABET_LETTERS = "alphabet_letters"
-CALLBACK_ALPHABET_VOWELS = "alphabet_vowels"
-CALLBACK_ALPHABET_CONSONANTS = "alphabet_consonants"
-CALLBACK_TALES_PAGE_PREFIX = "tales_page_"
-CALLBACK_TALES_PREV = "tales_prev"
-CALLBACK_TALES_NEXT = "tales_next"
-CALLBACK_ALPHABET_LETTERS_LIST = "alphabet_letters_list"
-CALLBACK_ALPHABET_LETTER_DETAIL = "alphabet_letter_detail:"
-CALLBACK_ALPHABET_DESCRIPTION = "alphabet_desc"
-CALLBACK_VOWELS_DESCRIPTION = "vowels_desc"
-CALLBACK_CONSONANTS_DESCRIPTION = "consonants_desc"
-CALLBACK_SHOW_ILLUSTRATIONS = "show_illustrations_"
-CALLBACK_PROGRESS = "show_progress"
-CALLBACK_SHOW_CULTURE = "show_culture_"
+# Коды действий для кнопок. Сама callback_data собирается через pack_callback:
+# версия формата + код + целые аргументы в base36 (например, "1s.k" — сказка 20).
+CALLBACK_TALES = "t"
+CALLBACK_VOCABULARY = "v"
+CALLBACK_GRAMMAR = "g"
+CALLBACK_LEXICON = "l"
+CALLBACK_BACK_TO_MAIN = "m"
+CALLBACK_BACK_TO_TALES = "bt"
+CALLBACK_BACK_TO_VOCABULARY = "bv"
+CALLBACK_SHOW_STORY = "s"
+CALLBACK_SHOW_GRAMMAR = "sg"
+CALLBACK_SHOW_LEXICON = "sl"
+CALLBACK_LANGUAGE_RU = "lr"
+CALLBACK_LANGUAGE_KH = "lk"
+CALLBACK_BACK_TO_LANGUAGE = "bl"
+CALLBACK_PLAY_AUDIO = "a"
+CALLBACK_PLAY_SEGMENT = "as"
+CALLBACK_ALPHABET = "ab"
+CALLBACK_ALPHABET_VOWELS = "av"
+CALLBACK_ALPHABET_CONSONANTS = "ac"
+CALLBACK_TALES_PAGE_PREFIX = "tp"
+CALLBACK_ALPHABET_LETTERS_LIST = "al"
+CALLBACK_ALPHABET_LETTER_DETAIL = "ad"
+CALLBACK_VOWELS_DESCRIPTION = "vd"
+CALLBACK_CONSONANTS_DESCRIPTION = "cd"
+CALLBACK_SHOW_ILLUSTRATIONS = "i"
+CALLBACK_ILLUSTRATION_PREV = "ip"
+CALLBACK_ILLUSTRATION_NEXT = "in"
+CALLBACK_PROGRESS = "p"
+CALLBACK_SHOW_CULTURE = "c"
+CALLBACK_READ_PAGE = "r"
+CALLBACK_GRAMMAR_PAGE = "gp"
+CALLBACK_GRAMMAR_TOC = "gt"
+CALLBACK_START_TEST = "ts"
+CALLBACK_TEST_ANSWER = "ta"
+CALLBACK_LEXICON_THEME = "lt"
+CALLBACK_LEXICON_PAGE = "lp"
+CALLBACK_LEXICON_RETURN = "lb"
+
+# --- Кодек callback_data ---
+# Версия формата: кнопки из сообщений, отправленных до смены формата, отклоняются
+CALLBACK_VERSION = "1"
+CALLBACK_MAX_BYTES = 64  # ограничение Telegram
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+# Языки текста сказки передаются в callback_data номером
+READER_LANGUAGES = ("ru", "kh")
+
+
+def to_base36(value: int) -> str:
+    if value < 0:
+        raise ValueError(f"Аргумент callback_data не может быть отрицательным: {value}")
+    digits = ""
+    while True:
+        value, rest = divmod(value, 36)
+        digits = BASE36_DIGITS[rest] + digits
+        if not value:
+            return digits
+
+
+def pack_callback(op: str, *args: int) -> str:
+    """Собирает callback_data из кода действия и целых аргументов"""
+    data = CALLBACK_VERSION + op
+    for arg in args:
+        data += "." + to_base36(arg)
+    if len(data.encode()) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"callback_data длиннее {CALLBACK_MAX_BYTES} байт: {data}")
+    return data
+
+
+def unpack_callback(data: Optional[str]) -> Optional[Tuple[str, Tuple[int, ...]]]:
+    """Разбирает callback_data; None, если формат чужой или устаревший"""
+    if not data or data[0] != CALLBACK_VERSION:
+        return None
+    op, *args = data[1:].split(".")
+    try:
+        return op, tuple(int(arg, 36) for arg in args)
+    except ValueError:
+        return None
+
+
+# --- Тексты меню ---
+# Шаблоны собраны один раз; в обработчиках подставляется только имя
+START_TEXT = (
+    "🌟 Вўща, <b>{name}</b> 🐾\n \n"
+    "Добро пожаловать в чат-бот для изучения казымского диалекта хантыйского языка!\n\n"
+    "<b>Здесь ты сможешь:</b>\n"
+    "   • 📖 Прочитать сказки на хантыйском и русском\n"
+    "   • 📚 Изучить слова и грамматику\n"
+    "   • 🔤 Познакомиться с алфавитом и фонетикой\n\n"
+    "<b>Выбери интересующий раздел:</b>"
+)
+MAIN_MENU_TEXT = (
+    "🌟 <b>{name}</b>, ты в главном меню! \n \n"
+    "Выбери <b>📖 Cказки</b>, если хочешь: \n"
+    " • почитать или послушать сказки на хантыйском,\n"
+    " • увидеть русский перевод сказки,\n"
+    " • пройти тест на знание материала,\n\n"
+    "Выбери <b>📚 Словарик</b>, если хочешь:\n"
+    " • услышать произношение букв хантыйского алфавита,\n"
+    " • увидеть список слов с переводом,\n"
+    " • узнать грамматические правила. \n\n"
+)
+FALLBACK_MENU_TEXT = (
+    "🌟 Добро пожаловать в бота для изучения хантыйского языка!\n"
+    "Пожалуйста, выбери раздел:"
+)
+VOCABULARY_MENU_TEXT = (
+    "📚 Выбери раздел словаря:\n\n"
+    "В <b>📝 Общей грамматике</b> можешь прочитать о грамматических правилах: \n"
+    " • Сколько чисел в хантыйском и как они образуются,\n "
+    " • Какие есть падежные суффиксы,\n"
+    " • Как ласково сказать белочка или рыбка.\n\n"
+    "В <b>🔤 Общей лексике</b> сможешь узнать слова из разных категорий:\n"
+    " • Еда,\n"
+    " • Животные,\n"
+    " • Природа и другие.\n\n"
+    "В <b>🔡 Алфавите</b> можешь увидеть:\n"
+    " • Названия букв\n"
+    " • Гласные звуки\n"
+    " • Согласные звуки.\n"
+)
+TALES_MENU_TEXT = "📖 Выбери сказку или воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:"
+LEXICON_MENU_TEXT = "📚 Выбери тематику словаря. Воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:"
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+# --- Метрики ---
+# Локальная страница /metrics в формате Prometheus; METRICS_PORT=0 — не поднимать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))
+# Верхние границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма задержек: число наблюдений по корзинам, сумма и общее число"""
+    __slots__ = ("counts", "total", "count")
 
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
 
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
 
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                return lower + (LATENCY_BUCKETS[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return LATENCY_BUCKETS[-1]
 
 
+def metric_labels(names: Tuple[str, ...], values: tuple) -> str:
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class MetricsRegistry:
+    """
+    Счётчики, гистограммы и снимки внешних метрик (очереди отправки, хранилище FSM).
+    Значения меток передаются кортежем в порядке, заданном при описании метрики.
+    """
+
+    def __init__(self):
+        self.descriptions: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = defaultdict(dict)
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = defaultdict(dict)
+        # префикс -> функция, возвращающая {имя: число или {значение метки: число}}
+        self.collectors: Dict[str, Callable[[], dict]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.descriptions[name] = (kind, help_text, labels)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        series = self.counters[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        series = self.histograms[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(seconds)
+
+    def add_collector(self, prefix: str, collect: Callable[[], dict]):
+        self.collectors[prefix] = collect
+
+    def render(self) -> str:
+        """Текст для /metrics в формате Prometheus exposition"""
+        lines = []
+        for name, (kind, help_text, label_names) in self.descriptions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for labels, histogram in self.histograms.get(name, {}).items():
+                    base = metric_labels(label_names, labels)
+                    prefix = f"{base}," if base else ""
+                    cumulative = 0
+                    for bound, bucket_count in zip(LATENCY_BUCKETS, histogram.counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+                    series = f"{{{base}}}" if base else ""
+                    lines.append(f"{name}_sum{series} {histogram.total:.6f}")
+                    lines.append(f"{name}_count{series} {histogram.count}")
+            else:
+                for labels, value in self.counters.get(name, {}).items():
+                    base = metric_labels(label_names, labels)
+                    lines.append(f"{name}{{{base}}} {value}" if base else f"{name} {value}")
+
+        for prefix, collect in self.collectors.items():
+            try:
+                snapshot = collect()
+            except Exception as e:
+                logger.warning(f"Не удалось снять метрики {prefix}: {e}")
+                continue
+            for key, value in snapshot.items():
+                name = f"{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                if isinstance(value, dict):
+                    for label, item in value.items():
+                        lines.append(f'{name}{{key="{label}"}} {item}')
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def latency_summary(self, name: str) -> Dict[tuple, Dict[str, float]]:
+        """p50/p99 по каждой серии гистограммы, секунды"""
+        return {
+            labels: {"p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99), "count": histogram.count}
+            for labels, histogram in self.histograms.get(name, {}).items()
+        }
+
+
+metrics = MetricsRegistry()
+metrics.describe("bot_handler_seconds", "histogram", "Время обработки обновления", ("handler", "callback"))
+metrics.describe("bot_handler_calls_total", "counter", "Вызовы обработчиков", ("handler", "callback"))
+metrics.describe("bot_handler_errors_total", "counter", "Исключения, вышедшие из обработчиков", ("handler", "callback"))
+metrics.describe("bot_logged_errors_total", "counter", "Ошибки, записанные в лог", ("function",))
+metrics.describe("bot_db_seconds", "histogram", "Время операций с базой прогресса", ("operation",))
+metrics.describe("bot_db_errors_total", "counter", "Ошибки операций с базой прогресса", ("operation",))
+metrics.describe("bot_db_locked_total", "counter", "Операции, не дождавшиеся блокировки SQLite", ("operation",))
+metrics.describe("bot_event_loop_lag_seconds", "histogram", "Задержка цикла событий относительно таймера", ())
+metrics.describe("bot_telegram_request_seconds", "histogram", "Время запросов к Bot API с ожиданием очереди", ("method",))
+metrics.describe("bot_telegram_errors_total", "counter", "Ошибки запросов к Bot API", ("method", "error"))
+
 
+class ErrorCountHandler(logging.Handler):
+    """Считает записи уровня ERROR и выше по имени функции: обработчики сами глушат исключения"""
 
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
 
+    def emit(self, record: logging.LogRecord):
+        metrics.inc("bot_logged_errors_total", (record.funcName,))
+
+
+logger.addHandler(ErrorCountHandler())
+metrics.add_collector("bot_logging", lambda: {
+    "records_total": dict(log_queue_handler.counts),
+    "suppressed_total": log_rate_limit.suppressed_total,
+    "queue_size": log_queue.qsize(),
+})
+
+
+def timed_db(func):
+    """Замеряет время синхронного метода Database"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_db_errors_total", (func.__name__,))
+            if isinstance(e, sqlite3.OperationalError) and "locked" in str(e):
+                metrics.inc("bot_db_locked_total", (func.__name__,))
+            raise
+        finally:
+            metrics.observe("bot_db_seconds", (func.__name__,), time.perf_counter() - started)
+    return wrapper
+
+
+def handler_labels(event: types.TelegramObject, data: dict) -> Tuple[str, str]:
+    """Имя обработчика и код кнопки; для кнопок обработчик ищется по коду из callback_data"""
+    handler_name = data["handler"].callback.__name__
+    if isinstance(event, types.CallbackQuery):
+        decoded = unpack_callback(event.data)
+        route = callback_router.routes.get(decoded[0]) if decoded else None
+        if route:
+            return route[0].__name__, decoded[0]
+    return handler_name, ""
+
+
+# Задача -> метки обработчика, который в ней выполняется (для профилировщика)
+active_handlers: Dict[asyncio.Task, Tuple[str, str]] = {}
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Время, число вызовов и ошибки каждого обработчика сообщений и кнопок.
+    Для кнопок обработчик определяется по коду из callback_data.
+    """
 
+    async def __call__(self, handler, event, data):
+        labels = handler_labels(event, data)
+        metrics.inc("bot_handler_calls_total", labels)
+        task = asyncio.current_task()
+        active_handlers[task] = labels
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", labels, time.perf_counter() - started)
+            active_handlers.pop(task, None)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Время запросов к Bot API по методам, включая ожидание в очереди отправки"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        api_method = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            result = await make_request(bot, method)
+            if startup_report["first_reply_s"] is None and getattr(method, "chat_id", None) is not None:
+                startup_report["first_reply_s"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+                logger.info(f"Первый ответ пользователю через {startup_report['first_reply_s']} с после старта")
+            return result
+        except Exception as e:
+            metrics.inc("bot_telegram_errors_total", (api_method, type(e).__name__))
+            raise
+        finally:
+            metrics.observe("bot_telegram_request_seconds", (api_method,), time.perf_counter() - started)
+
+
+async def monitor_event_loop_lag(interval: float = 0.1):
+    """Периодически замеряет, насколько позже срока просыпается таймер цикла событий"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.observe("bot_event_loop_lag_seconds", (), max(0.0, time.perf_counter() - started - interval))
+
+
+async def handle_metrics_request(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    """Поднимает /metrics и /health на METRICS_HOST:METRICS_PORT"""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics_request)
+    app.router.add_get("/debug/profile", handle_profile_request)
+    app.router.add_get("/health", handle_health_request)
+    app.router.add_get("/health/serving", handle_health_request)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+# --- Граф фаз запуска ---
+# Фаза — функция без аргументов (синхронная выполняется в потоке) с зависимостями.
+# Критические фазы завершаются до приёма обновлений, фоновые запускаются после.
+class StartupPhase:
+    __slots__ = ("name", "func", "requires", "critical")
+
+    def __init__(self, name: str, func: Callable, requires: Tuple[str, ...], critical: bool):
+        self.name = name
+        self.func = func
+        self.requires = requires
+        self.critical = critical
+
+
+startup_phases: Dict[str, StartupPhase] = {}
+startup_tasks: Dict[str, asyncio.Task] = {}
+# Длительность фаз, готовность к приёму обновлений, первый ответ и конец прогрева — секунды от старта процесса
+startup_report: Dict[str, object] = {"phases": {}, "ready_s": None, "first_reply_s": None, "warm_s": None}
+
+
+def startup_phase(name: str, requires: Tuple[str, ...] = (), critical: bool = True):
+    """Регистрирует функцию как фазу запуска"""
+    def decorator(func):
+        startup_phases[name] = StartupPhase(name, func, tuple(requires), critical)
+        return func
+    return decorator
+
+
+def phase_names(critical: bool) -> List[str]:
+    return [phase.name for phase in startup_phases.values() if phase.critical == critical]
+
+
+async def run_startup_phase(phase: StartupPhase):
+    for name in phase.requires:
+        try:
+            await startup_tasks[name]
+        except Exception:
+            startup_report["phases"][phase.name] = {"critical": phase.critical, "ok": False,
+                                                    "error": f"не выполнена фаза {name}", "seconds": 0.0}
+            raise
+    started = time.perf_counter()
+    record = {
+        "start_s": round(started - PROCESS_STARTED, 3),
+        "critical": phase.critical,
+    }
+    try:
+        if inspect.iscoroutinefunction(phase.func):
+            await phase.func()
+        else:
+            await asyncio.to_thread(phase.func)
+        record["ok"] = True
+    except Exception as e:
+        record.update(ok=False, error=str(e))
+        log = logger.critical if phase.critical else logger.error
+        log(f"Фаза запуска {phase.name} завершилась ошибкой: {e}")
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - started, 3)
+        startup_report["phases"][phase.name] = record
 
 
+def start_startup_phases(names: List[str]) -> List[asyncio.Task]:
+    """Запускает фазы одновременно; каждая ждёт только свои зависимости"""
+    for name in names:
+        for required in startup_phases[name].requires:
+            if required not in startup_tasks and required not in names:
+                raise ValueError(f"Фаза {name} зависит от незапущенной фазы {required}")
+    tasks = []
+    for name in names:
+        if name not in startup_tasks:
+            startup_tasks[name] = asyncio.create_task(run_startup_phase(startup_phases[name]), name=f"startup:{name}")
+        tasks.append(startup_tasks[name])
+    return tasks
 
 
+def log_startup_report():
+    logger.info(f"Отчёт о запуске: {json.dumps(startup_report, ensure_ascii=False)}")
 
 
+def startup_metrics() -> dict:
+    snapshot = {
+        "phase_seconds": {name: record["seconds"] for name, record in startup_report["phases"].items()},
+    }
+    for key, name in (("ready_s", "ready_seconds"), ("first_reply_s", "first_reply_seconds"),
+                      ("warm_s", "warm_seconds")):
+        if startup_report[key] is not None:
+            snapshot[name] = startup_report[key]
+    return snapshot
 
 
+metrics.add_collector("bot_startup", startup_metrics)
 
 
 # --- Класс для работы с базой данных ---
@@ -178,6 +770,7 @@ class Database:
             """)
             conn.commit()
 
+    @timed_db
     def add_user(self, user: types.User):
         """Добавление нового пользователя в базу данных"""
         with closing(sqlite3.connect(self.db_name)) as conn:
@@ -198,6 +791,7 @@ class Database:
             )
             conn.commit()
 
+    @timed_db
     def update_tale_progress(self, user_id: int, tale_id: int) -> bool:
         """Обновление прогресса по сказке. Возвращает True, если запись была обновлена, False если создана новая"""
         with closing(sqlite3.connect(self.db_name)) as conn:
@@ -232,6 +826,7 @@ class Database:
                 conn.commit()
                 return False
 
+    @timed_db
     def mark_tale_completed(self, user_id: int, tale_id: int):
         """Помечаем сказку как завершенную (пройден тест)"""
         with closing(sqlite3.connect(self.db_name)) as conn:
@@ -261,6 +856,7 @@ class Database:
                 )
             conn.commit()
 
+    @timed_db
     def save_test_result(self, user_id: int, tale_id: int, question_id: int, is_correct: bool):
         """Сохранение результата ответа на вопрос теста"""
         with closing(sqlite3.connect(self.db_name)) as conn:
@@ -281,6 +877,7 @@ class Database:
             )
             conn.commit()
 
+    @timed_db
     def get_user_progress(self, user_id: int) -> dict:
         """Получение прогресса пользователя"""
         with closing(sqlite3.connect(self.db_name)) as conn:
@@ -343,20 +940,105 @@ def load_phonetics():
         logger.error(f"Ошибка загрузки phonetics.json: {e}")
         return None
 
-# Загружаем данные
-try:
+# Данные загружаются фазами запуска
+tales_data: dict = {"stories": []}
+tests_data: dict = {"tests": []}
+
+
+@startup_phase("tales")
+def load_tales_phase():
+    global tales_data
     tales_data = load_tales_from_json("fairytales.json")
-except Exception as e:
-    logger.critical(f"Не удалось загрузить данные: {e}")
-    exit(1)
 
-try:
-    tests_data = load_tests_from_json("tests.json")
-except Exception as e:
-    logger.error(f"Не удалось загрузить тесты: {e}")
-    tests_data = {"tests": []}
 
-phonetics_data = load_phonetics()
+def normalize_answer(value) -> str:
+    return str(value).strip().lower()
+
+
+def compile_test_catalog(tests: list) -> Dict[int, dict]:
+    """
+    Готовит тесты к показу: индексы правильных вариантов, текст и клавиатура
+    каждого вопроса считаются один раз. Вопросы без правильного варианта
+    пропускаются с ошибкой в логе.
+    """
+    catalog = {}
+    for test in tests:
+        tale_id = test["fairytale_id"]
+        compiled = []
+        for question in test["questions"]:
+            variants = [normalize_answer(v) for v in question["variants"]]
+            right_answer = question["right answer"]
+            right_answers = right_answer if isinstance(right_answer, list) else [right_answer]
+
+            missing = [ans for ans in right_answers if normalize_answer(ans) not in variants]
+            if missing:
+                logger.warning(
+                    f"Тест {tale_id}, вопрос {question['q_id']}: ответов {missing} нет среди вариантов"
+                )
+            correct = frozenset(
+                i for i, variant in enumerate(variants)
+                if variant in {normalize_answer(ans) for ans in right_answers}
+            )
+            if not correct:
+                logger.error(f"Тест {tale_id}, вопрос {question['q_id']}: нет правильного варианта, вопрос пропущен")
+                continue
+
+            builder = InlineKeyboardBuilder()
+            for i, variant in enumerate(question["variants"]):
+                builder.button(text=variant, callback_data=pack_callback(CALLBACK_TEST_ANSWER, question['q_id'], i))
+            builder.adjust(1)
+
+            compiled.append({
+                "q_id": question["q_id"],
+                "question": question["question"],
+                "explanation": question.get("explanation", "Объяснение отсутствует."),
+                "correct": correct,
+                "markup": builder.as_markup(),
+            })
+
+        # Номер вопроса и общее число известны только после проверки всех вопросов
+        for index, question in enumerate(compiled):
+            question["prompt"] = f"📝 Вопрос {index + 1}/{len(compiled)}\n{question['question']}"
+
+        if compiled:
+            catalog[tale_id] = {"fairytale_id": tale_id, "questions": compiled}
+    logger.info(f"Каталог тестов: {len(catalog)} тестов, {sum(len(t['questions']) for t in catalog.values())} вопросов")
+    return catalog
+
+
+# Тесты по id сказки: в состоянии пользователя хранится только id
+tests_by_tale: Dict[int, dict] = {}
+
+
+@startup_phase("tests")
+def load_tests_phase():
+    global tests_data, tests_by_tale
+    try:
+        tests_data = load_tests_from_json("tests.json")
+    except Exception as e:
+        logger.error(f"Не удалось загрузить тесты: {e}")
+        tests_data = {"tests": []}
+    tests_by_tale = compile_test_catalog(tests_data["tests"])
+
+
+def load_alphabet() -> list:
+    try:
+        with open("alphabet.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки alphabet.json: {e}")
+        return []
+
+phonetics_data = None
+alphabet_data: list = []
+
+
+@startup_phase("alphabet")
+def load_alphabet_phase():
+    global phonetics_data, alphabet_data
+    phonetics_data = load_phonetics()
+    alphabet_data = load_alphabet()
+
 
 # Загрузка данных
 CULTURE_FILE = Path(__file__).parent / 'culture.json'
@@ -391,9 +1073,14 @@ def load_culture_data():
         logger.error(f"Критическая ошибка загрузки: {e}")
         return []
 
-# Явно инициализируем переменную
-culture_data = load_culture_data()
-logger.info(f"Загружено культурных фактов: {len(culture_data)}")
+culture_data: list = []
+
+
+@startup_phase("culture")
+def load_culture_phase():
+    global culture_data
+    culture_data = load_culture_data()
+    logger.info(f"Загружено культурных фактов: {len(culture_data)}")
 
 
 
@@ -433,7 +1120,7 @@ class MultiLabelClassifier(nn.Module):
 
 # 2. Инициализация устройства
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Используется устройство: {device}")
+logger.info(f"Используется устройство: {device}")
 
 # 3. Пути к файлам 
 MODEL_DIR = "models"  # Папка с моделями
@@ -451,20 +1138,18 @@ def load_models():
         # Загружаем Word2Vec модель
         try:
             model_emb = KeyedVectors.load(PATHS['word2vec'])
-            print("✔ Word2Vec модель загружена успешно!")
-            print(f"Размерность эмбеддингов: {model_emb.vector_size}")
+            logger.info(f"Word2Vec модель загружена, размерность эмбеддингов: {model_emb.vector_size}")
         except Exception as e:
-            print(f"❌ Ошибка загрузки Word2Vec: {e}")
+            logger.error(f"Ошибка загрузки Word2Vec: {e}")
             raise
 
         # Загружаем MultiLabelBinarizer
         try:
             with open(PATHS['mlb'], 'rb') as f:
                 mlb = pickle.load(f)
-            print("✔ MultiLabelBinarizer загружен успешно!")
-            print(f"Классы: {mlb.classes_}")
+            logger.info(f"MultiLabelBinarizer загружен, классы: {list(mlb.classes_)}")
         except Exception as e:
-            print(f"❌ Ошибка загрузки mlb.pkl: {e}")
+            logger.error(f"Ошибка загрузки mlb.pkl: {e}")
             raise
 
         # Инициализируем и загружаем PyTorch модель
@@ -472,63 +1157,71 @@ def load_models():
             model = MultiLabelClassifier(model_emb.vector_size, len(mlb.classes_)).to(device)
             model.load_state_dict(torch.load(PATHS['pytorch'], map_location=device))
             model.eval()
-            print("✔ PyTorch модель загружена успешно!")
+            logger.info("PyTorch модель загружена")
         except Exception as e:
-            print(f"❌ Ошибка загрузки модели PyTorch: {e}")
+            logger.error(f"Ошибка загрузки модели PyTorch: {e}")
             raise
 
         return model_emb, model, mlb
 
     except Exception as e:
-        print(f"⚠️ Критическая ошибка при загрузке моделей: {e}")
+        logger.error(f"Критическая ошибка при загрузке моделей: {e}")
         raise
 
-# 5. Загружаем модели и создаем классификатор
-try:
-    model_emb, model, mlb = load_models()
-    print("Все модели успешно загружены!")
-    
-    # Классификатор тем на основе нейросети
-    class NeuralThemeClassifier:
-        def __init__(self, word2vec_model, pytorch_model, mlb):
-            self.word2vec = word2vec_model
-            self.model = pytorch_model
-            self.mlb = mlb
-
-        @lru_cache(maxsize=5000)
-        def predict_themes(self, word: str) -> List[str]:
-            """Определение тем слова с помощью нейросети, возвращает список тем"""
-            try:
-                vec = torch.FloatTensor(np.copy(self.word2vec[word])).unsqueeze(0).to(device)
-                with torch.no_grad():
-                    out = self.model(vec)
-                    out_np = (out.cpu().numpy() > 0.5).astype(int)
-
-                labels = self.mlb.inverse_transform(out_np)[0]
-                if labels:
-                    return [label.capitalize() for label in labels]
-                else:
-                    return ["Общее"]
-            except KeyError:
-                return ["Общее"]  # Если слова нет в word2vec
-            except Exception as e:
-                print(f"Ошибка предсказания: {e}")
-                return ["Общее"]
+# 5. Классификаторы тем
+class NeuralThemeClassifier:
+    """Классификатор тем на основе нейросети"""
 
-    # Создаем экземпляр классификатора
-    theme_classifier = NeuralThemeClassifier(model_emb, model, mlb)
-    print("Нейросетевой классификатор тем инициализирован!")
+    def __init__(self, word2vec_model, pytorch_model, mlb):
+        self.word2vec = word2vec_model
+        self.model = pytorch_model
+        self.mlb = mlb
 
-except Exception as e:
-    print(f"❌ Ошибка загрузки нейросетевых моделей: {e}")
-    # Создаем заглушку для классификатора
-    class DummyThemeClassifier:
-        @lru_cache(maxsize=5000)
-        def predict_themes(self, word: str) -> List[str]:
+    @lru_cache(maxsize=5000)
+    def predict_themes(self, word: str) -> List[str]:
+        """Определение тем слова с помощью нейросети, возвращает список тем"""
+        try:
+            vec = torch.FloatTensor(np.copy(self.word2vec[word])).unsqueeze(0).to(device)
+            with torch.no_grad():
+                out = self.model(vec)
+                out_np = (out.cpu().numpy() > 0.5).astype(int)
+
+            labels = self.mlb.inverse_transform(out_np)[0]
+            if labels:
+                return [label.capitalize() for label in labels]
+            else:
+                return ["Общее"]
+        except KeyError:
+            return ["Общее"]  # Если слова нет в word2vec
+        except Exception as e:
+            hot_logger.warning(f"Ошибка предсказания для слова '{word}': {e}")
             return ["Общее"]
-    
-    theme_classifier = DummyThemeClassifier()
-    print("⚠️ Используется заглушечный классификатор тем")
+
+
+class DummyThemeClassifier:
+    """Заглушка: пока модели не загружены или если загрузка не удалась"""
+
+    @lru_cache(maxsize=5000)
+    def predict_themes(self, word: str) -> List[str]:
+        return ["Общее"]
+
+
+def build_theme_classifier():
+    """Загружает модели и создаёт классификатор; при ошибке — заглушка"""
+    try:
+        model_emb, model, mlb = load_models()
+        logger.info("Все модели загружены, нейросетевой классификатор тем инициализирован")
+        return NeuralThemeClassifier(model_emb, model, mlb)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки нейросетевых моделей, используется заглушка классификатора тем: {e}")
+        return DummyThemeClassifier()
+
+
+# До загрузки моделей (фоновый прогрев) темы определяет только ручной словарь
+theme_classifier = DummyThemeClassifier()
+# Версия моделей тем: 0 — заглушка, растёт при каждой загрузке нейросети.
+# Темы лексики в FSM помечаются версией и строятся заново, если она устарела
+theme_models_version = 0
 
 def load_manual_dictionary():
     try:
@@ -559,14 +1252,21 @@ def load_manual_dictionary():
                 if clean_word and clean_word not in manual_dict:
                     manual_dict[clean_word] = labels
         
-        print(f"Ручной словарь загружен: {len(manual_dict)} отдельных слов")
+        logger.info(f"Ручной словарь загружен: {len(manual_dict)} отдельных слов")
         return manual_dict
         
     except Exception as e:
-        print(f"❌ Ошибка загрузки ручного словаря: {e}")
+        logger.error(f"Ошибка загрузки ручного словаря: {e}")
         return {}
     
-manual_dictionary = load_manual_dictionary()
+manual_dictionary: Dict[str, List[str]] = {}
+
+
+@startup_phase("dictionary")
+def load_dictionary_phase():
+    global manual_dictionary
+    manual_dictionary = hybrid_classifier.manual_dict = load_manual_dictionary()
+
 
 class HybridThemeClassifier:
     def __init__(self, manual_dict, neural_classifier):
@@ -622,13 +1322,11 @@ class HybridThemeClassifier:
             return self.neural.predict_themes(word)
             
         except Exception as e:
-            print(f"Ошибка в гибридном классификаторе для слова '{word}': {e}")
+            hot_logger.warning(f"Ошибка в гибридном классификаторе для слова '{word}': {e}")
             return ["Общее"]
         
-# Создаем гибридный классификатор
+# Создаем гибридный классификатор; словарь подставляется фазой запуска, нейросеть — прогревом
 hybrid_classifier = HybridThemeClassifier(manual_dictionary, theme_classifier)
-print("Гибридный классификатор инициализирован!")
-
 
 
 def are_words_similar(self, word1: str, word2: str) -> bool:
@@ -678,7 +1376,7 @@ def smart_dict_search(self, word: str) -> Optional[List[str]]:
             clean_word_lower.replace(' ', '') == dict_word_lower.replace(' ', '') or  # без пробелов
             self.are_words_similar(clean_word_lower, dict_word_lower)):  # похожие слова
             
-            print(f"DEBUG: Найдено совпадение '{clean_word}' ~ '{dict_word}' -> {labels}")
+            hot_logger.debug("Найдено совпадение %r ~ %r -> %s", clean_word, dict_word, labels)
             return labels
     
     return None
@@ -695,12 +1393,849 @@ def smart_dict_search(self, word: str) -> Optional[List[str]]:
 
 
 
+# --- Планировщик исходящих запросов к Telegram ---
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду на чат
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "4"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Очереди: ответы пользователю идут раньше массовых отправок
+LANE_INTERACTIVE = 0
+LANE_BULK = 1
+LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_BULK: "bulk"}
+
+# Очередь, в которую попадают запросы текущей задачи
+send_lane: ContextVar[int] = ContextVar("send_lane", default=LANE_INTERACTIVE)
+
+
+@contextmanager
+def send_lane_scope(lane: int):
+    """Отправляет все запросы внутри блока через указанную очередь"""
+    token = send_lane.set(lane)
+    try:
+        yield
+    finally:
+        send_lane.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def try_acquire(self) -> float:
+        """Забирает токен. Возвращает 0 или сколько секунд ждать до следующего токена"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def block(self, seconds: float):
+        """Останавливает выдачу токенов (после RetryAfter от Telegram)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: все запросы с chat_id проходят через ведра токенов
+    (общее и на чат), при RetryAfter запрос повторяется после паузы.
+    """
+
+    # Запросы, которые не расходуют лимит сообщений
+    UNTHROTTLED_METHODS = {"SendChatAction"}
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: float = SEND_CHAT_BURST, max_retries: int = SEND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets: Dict[Union[int, str], TokenBucket] = {}
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.waiter_seq = 0
+        self.pump_task: Optional[asyncio.Task] = None
+        self.queue_depth: Dict[int, int] = defaultdict(int)
+        self.stats: Dict[str, float] = defaultdict(float)
+
+    def chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Убираем ведра чатов, которые давно ничего не отправляли
+                for key in [k for k, b in self.chat_buckets.items() if b.is_idle()]:
+                    del self.chat_buckets[key]
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire_global(self, lane: int):
+        """Ждёт токен общего ведра; ожидающие обслуживаются по приоритету очереди"""
+        if not self.waiters and self.global_bucket.try_acquire() == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiter_seq += 1
+        heapq.heappush(self.waiters, (lane, self.waiter_seq, future))
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.create_task(self.pump())
+        await future
+
+    async def pump(self):
+        """Раздаёт токены общего ведра ожидающим запросам"""
+        while self.waiters:
+            delay = self.global_bucket.try_acquire()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            while self.waiters:
+                _, _, future = heapq.heappop(self.waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+            else:
+                # Все ожидающие отменены — возвращаем токен
+                self.global_bucket.tokens += 1
+
+    async def acquire(self, chat_id: Union[int, str], lane: int):
+        bucket = self.chat_bucket(chat_id)
+        while (delay := bucket.try_acquire()) > 0:
+            await asyncio.sleep(delay)
+        await self.acquire_global(lane)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or type(method).__name__ in self.UNTHROTTLED_METHODS:
+            return await make_request(bot, method)
+
+        lane = send_lane.get()
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            self.queue_depth[lane] += 1
+            try:
+                await self.acquire(chat_id, lane)
+            finally:
+                self.queue_depth[lane] -= 1
+            waited = time.monotonic() - started
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+
+            try:
+                response = await make_request(bot, method)
+                self.stats[f"sent_{LANE_NAMES[lane]}"] += 1
+                return response
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                self.chat_bucket(chat_id).block(e.retry_after)
+                if attempt == self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                logger.warning(
+                    f"Flood control для чата {chat_id} ({type(method).__name__}), "
+                    f"повтор через {e.retry_after} с"
+                )
+
+    def metrics(self) -> dict:
+        """Текущее состояние очередей и счётчики отправок"""
+        return {
+            "queue_depth": {LANE_NAMES[lane]: depth for lane, depth in self.queue_depth.items()},
+            "global_waiters": len(self.waiters),
+            "chat_buckets": len(self.chat_buckets),
+            **self.stats
+        }
+
+
+# --- Защита от флуда ---
+# Входящие обновления пользователя: FLOOD_RATE в секунду, запас FLOOD_BURST (0 — без ограничения)
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "3"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "6"))
+# Повтор той же кнопки в течение этого времени после обработки тоже считается двойным нажатием, с
+FLOOD_DUPLICATE_WINDOW = float(os.getenv("FLOOD_DUPLICATE_WINDOW", "0.5"))
+
+metrics.describe("bot_flood_dropped_total", "counter", "Обновления, отброшенные защитой от флуда", ("kind", "reason"))
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """
+    Внешний middleware обновлений (стоит перед FSM, поэтому отброшенное обновление
+    не читает хранилище состояний): для сообщений и кнопок — ведро токенов на
+    пользователя и склейка повторных нажатий одной и той же кнопки, пока первое
+    ещё обрабатывается. Лишние нажатия получают только пустой answerCallbackQuery
+    (снимает «часики»), лишние сообщения отбрасываются — без записей в базу и отправок.
+    """
+
+    def __init__(self, rate: float = FLOOD_RATE, burst: float = FLOOD_BURST,
+                 duplicate_window: float = FLOOD_DUPLICATE_WINDOW):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.user_buckets: Dict[int, TokenBucket] = {}
+        # (пользователь, callback_data) -> None, пока обрабатывается, затем время окончания
+        self.callbacks: Dict[Tuple[int, str], Optional[float]] = {}
+
+    def user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            if len(self.user_buckets) > 10000:
+                # Убираем ведра пользователей, которые давно ничего не присылали
+                for key in [k for k, b in self.user_buckets.items() if b.is_idle()]:
+                    del self.user_buckets[key]
+            bucket = self.user_buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def is_duplicate(self, key: Tuple[int, str]) -> bool:
+        if key not in self.callbacks:
+            return False
+        finished = self.callbacks[key]
+        if finished is None or time.monotonic() - finished < self.duplicate_window:
+            return True
+        del self.callbacks[key]
+        return False
+
+    def forget_finished(self):
+        """Убирает завершённые нажатия старше окна"""
+        now = time.monotonic()
+        for key in [k for k, f in self.callbacks.items() if f is not None and now - f >= self.duplicate_window]:
+            del self.callbacks[key]
+
+    async def drop(self, event, kind: str, reason: str):
+        metrics.inc("bot_flood_dropped_total", (kind, reason))
+        hot_logger.info("Обновление отброшено защитой от флуда",
+                        extra={"user_id": event.from_user.id, "kind": kind, "reason": reason})
+        if isinstance(event, types.CallbackQuery):
+            try:
+                await event.answer()
+            except Exception as e:
+                hot_logger.warning(f"Не удалось ответить на повторное нажатие: {e}")
+
+    async def __call__(self, handler, update: types.Update, data):
+        event = update.callback_query or update.message
+        # Пользователя уже определил UserContextMiddleware aiogram
+        user = data.get("event_from_user")
+        if event is None or user is None:
+            return await handler(update, data)
+        kind = "callback" if isinstance(event, types.CallbackQuery) else "message"
+
+        key = (user.id, event.data or "") if kind == "callback" else None
+        if key and self.is_duplicate(key):
+            return await self.drop(event, kind, "duplicate")
+        if self.rate > 0 and self.user_bucket(user.id).try_acquire() > 0:
+            return await self.drop(event, kind, "throttled")
+
+        if key is None:
+            return await handler(update, data)
+        if len(self.callbacks) > 10000:
+            self.forget_finished()
+        self.callbacks[key] = None
+        try:
+            return await handler(update, data)
+        finally:
+            self.callbacks[key] = time.monotonic()
+
+    def metrics(self) -> dict:
+        return {
+            "user_buckets": len(self.user_buckets),
+            "callbacks_in_flight": sum(1 for finished in self.callbacks.values() if finished is None),
+        }
+
+
+# --- Хранилище состояний FSM ---
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")  # memory, sqlite или redis
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm_state.db")
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+# Локальный кэш поверх хранилища. Redis делят несколько процессов, и кэш одного
+# из них не видит чужих записей, поэтому для redis кэш по умолчанию выключен
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "0" if FSM_STORAGE == "redis" else "60"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Ограничения хранилища в памяти: время жизни записи с последнего обращения и общий объём
+FSM_MEMORY_TTL = float(os.getenv("FSM_MEMORY_TTL", str(6 * 3600)))
+FSM_MEMORY_MAX_ENTRIES = int(os.getenv("FSM_MEMORY_MAX_ENTRIES", "50000"))
+FSM_MEMORY_MAX_BYTES = int(os.getenv("FSM_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def fsm_json_default(value):
+    """Сериализация значений, которых нет в JSON (множества)"""
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(value)}
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в FSM")
+
+
+def fsm_json_hook(value: dict):
+    if len(value) == 1 and "__set__" in value:
+        return set(value["__set__"])
+    return value
+
+
+def fsm_dumps(data) -> str:
+    """Компактный JSON без пробелов и экранирования кириллицы"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=fsm_json_default)
+
+
+def fsm_loads(raw):
+    return json.loads(raw, object_hook=fsm_json_hook)
+
+
+def fsm_key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    FSM-хранилище в памяти с ограничениями: запись живёт ttl секунд после
+    последнего обращения, при превышении лимита записей или байт вытесняются
+    самые давно использованные.
+    """
+
+    # Примерные накладные расходы на одну запись (ключ, список, словарь)
+    RECORD_OVERHEAD = 256
+
+    def __init__(self, ttl: float = FSM_MEMORY_TTL, max_entries: int = FSM_MEMORY_MAX_ENTRIES,
+                 max_bytes: int = FSM_MEMORY_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # ключ -> [истекает, состояние, данные, размер]; порядок — от давних обращений к свежим
+        self.records: "OrderedDict[StorageKey, list]" = OrderedDict()
+        self.total_bytes = 0
+        self.stats: Dict[str, int] = defaultdict(int)
+
+    def _estimate_size(self, state: Optional[str], data: Dict) -> int:
+        try:
+            data_size = len(fsm_dumps(data).encode("utf-8")) if data else 0
+        except TypeError:
+            data_size = len(repr(data))
+        return self.RECORD_OVERHEAD + len(state or "") + data_size
+
+    def _drop(self, key: StorageKey, reason: Optional[str] = None):
+        record = self.records.pop(key)
+        self.total_bytes -= record[3]
+        if reason:
+            self.stats[f"evicted_{reason}"] += 1
+
+    def _expire(self):
+        """Удаляет просроченные записи (они всегда в начале очереди)"""
+        now = time.monotonic()
+        while self.records:
+            key, record = next(iter(self.records.items()))
+            if record[0] > now:
+                break
+            self._drop(key, "ttl")
+
+    def _get(self, key: StorageKey) -> Optional[list]:
+        self._expire()
+        record = self.records.get(key)
+        if record is not None:
+            record[0] = time.monotonic() + self.ttl
+            self.records.move_to_end(key)
+        return record
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict):
+        if key in self.records:
+            self._drop(key)
+        # Пустые записи не храним
+        if state is None and not data:
+            return
+        size = self._estimate_size(state, data)
+        self.records[key] = [time.monotonic() + self.ttl, state, data, size]
+        self.total_bytes += size
+        while len(self.records) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._drop(next(iter(self.records)), "lru")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        value = state.state if isinstance(state, State) else state
+        self._put(key, value, record[2] if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record[1] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict) -> None:
+        record = self._get(key)
+        self._put(key, record[1] if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict:
+        record = self._get(key)
+        return record[2].copy() if record else {}
+
+    def metrics(self) -> dict:
+        """Число записей, занятый объём и счётчики вытеснений"""
+        return {
+            "entries": len(self.records),
+            "bytes": self.total_bytes,
+            "evicted_ttl": self.stats["evicted_ttl"],
+            "evicted_lru": self.stats["evicted_lru"],
+        }
+
+    async def close(self) -> None:
+        self.records.clear()
+        self.total_bytes = 0
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite (режим WAL): переживает перезапуск и может
+    использоваться несколькими процессами на одной машине.
+    """
+
+    def __init__(self, db_name: str = FSM_SQLITE_PATH):
+        self.db_name = db_name
+        # Одно соединение и один поток: запросы выполняются последовательно вне цикла событий
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+        self.conn = sqlite3.connect(db_name, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated REAL
+            )
+        """)
+        self.conn.commit()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _read(self, key: str, column: str):
+        row = self.conn.execute(f"SELECT {column} FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, key: str, column: str, value):
+        self.conn.execute(
+            f"""
+            INSERT INTO fsm (key, {column}, updated) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated = excluded.updated
+            """,
+            (key, value, time.time())
+        )
+        self.conn.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self.run(self._write, fsm_key(key), "state", value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self.run(self._read, fsm_key(key), "state")
+
+    async def set_data(self, key: StorageKey, data: Dict) -> None:
+        await self.run(self._write, fsm_key(key), "data", fsm_dumps(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict:
+        raw = await self.run(self._read, fsm_key(key), "data")
+        return fsm_loads(raw) if raw else {}
+
+    async def close(self) -> None:
+        await self.run(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+
+class WriteThroughCacheStorage(BaseStorage):
+    """Кэш в памяти процесса поверх другого хранилища: запись сразу уходит в хранилище"""
+
+    def __init__(self, backend: BaseStorage, ttl: float = FSM_CACHE_TTL, max_size: int = FSM_CACHE_SIZE):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+        # ключ -> (время записи в кэш, состояние, данные)
+        self.cache: "OrderedDict[StorageKey, list]" = OrderedDict()
+
+    def _cached(self, key: StorageKey) -> Optional[list]:
+        entry = self.cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        self.cache.move_to_end(key)
+        return entry
+
+    def _store(self, key: StorageKey, state, data):
+        if self.ttl <= 0:
+            return
+        self.cache[key] = [time.monotonic(), state, data]
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def _entry(self, key: StorageKey) -> list:
+        entry = self._cached(key)
+        if entry is None:
+            state = await self.backend.get_state(key)
+            data = await self.backend.get_data(key)
+            self._store(key, state, data)
+            entry = [time.monotonic(), state, data]
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self.backend.set_state(key, value)
+        entry = self._cached(key)
+        if entry is not None:
+            self._store(key, value, entry[2])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key))[1]
+
+    async def set_data(self, key: StorageKey, data: Dict) -> None:
+        await self.backend.set_data(key, data)
+        entry = self._cached(key)
+        if entry is not None:
+            self._store(key, entry[1], copy.deepcopy(data))
+        else:
+            self.cache.pop(key, None)
+
+    async def get_data(self, key: StorageKey) -> Dict:
+        return copy.deepcopy((await self._entry(key))[2])
+
+    async def close(self) -> None:
+        self.cache.clear()
+        await self.backend.close()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Создаёт FSM-хранилище по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "sqlite":
+        backend = SQLiteStorage(FSM_SQLITE_PATH)
+    elif FSM_STORAGE == "redis":
+        # Необязательная зависимость: pip install redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        backend = RedisStorage.from_url(FSM_REDIS_URL, json_loads=fsm_loads, json_dumps=fsm_dumps)
+    else:
+        return BoundedMemoryStorage()
+    logger.info(f"FSM-хранилище: {FSM_STORAGE}")
+    return WriteThroughCacheStorage(backend) if FSM_CACHE_TTL > 0 else backend
+
+
+# --- HTTP-сессия Bot API ---
+# Пул соединений к api.telegram.org: общий лимит, лимит на хост, keep-alive и кэш DNS
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "0"))  # 0 — без лимита на хост
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_TRACE = os.getenv("HTTP_TRACE", "1") == "1"
+
+metrics.describe(
+    "bot_http_phase_seconds", "histogram",
+    "Фазы запроса к Bot API: queue — ожидание соединения в пуле, dns, connect — TCP и TLS, "
+    "send — отправка тела, server — от отправки до заголовков ответа, total — целиком",
+    ("method", "phase")
+)
+metrics.describe("bot_http_connections_total", "counter", "Соединения для запросов к Bot API", ("method", "kind"))
+metrics.describe("bot_http_dns_cache_total", "counter", "Обращения к кэшу DNS", ("result",))
+metrics.describe("bot_http_request_bytes_total", "counter", "Отправлено байт в Bot API", ("method",))
+metrics.describe("bot_http_response_bytes_total", "counter", "Получено байт от Bot API", ("method",))
+metrics.describe("bot_http_errors_total", "counter", "Сетевые ошибки запросов к Bot API", ("method", "error"))
+
+
+def api_method_from_url(url) -> str:
+    # В пути запроса есть токен, поэтому берём только имя метода
+    return url.path.rsplit("/", 1)[-1]
+
+
+def build_trace_config() -> TraceConfig:
+    """TraceConfig, раскладывающий время каждого запроса к Bot API по фазам"""
+    trace_config = TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.method = api_method_from_url(params.url)
+        ctx.started = ctx.ready = ctx.sent = time.perf_counter()
+
+    async def on_connection_queued_start(session, ctx, params):
+        ctx.queued = time.perf_counter()
+
+    async def on_connection_queued_end(session, ctx, params):
+        metrics.observe("bot_http_phase_seconds", (ctx.method, "queue"), time.perf_counter() - ctx.queued)
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.resolving = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        metrics.observe("bot_http_phase_seconds", (ctx.method, "dns"), time.perf_counter() - ctx.resolving)
+
+    async def on_dns_cache_hit(session, ctx, params):
+        metrics.inc("bot_http_dns_cache_total", ("hit",))
+
+    async def on_dns_cache_miss(session, ctx, params):
+        metrics.inc("bot_http_dns_cache_total", ("miss",))
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connecting = time.perf_counter()
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.ready = time.perf_counter()
+        metrics.observe("bot_http_phase_seconds", (ctx.method, "connect"), ctx.ready - ctx.connecting)
+        metrics.inc("bot_http_connections_total", (ctx.method, "new"))
+
+    async def on_connection_reuseconn(session, ctx, params):
+        ctx.ready = time.perf_counter()
+        metrics.inc("bot_http_connections_total", (ctx.method, "reused"))
+
+    async def on_request_headers_sent(session, ctx, params):
+        ctx.sent = time.perf_counter()
+
+    async def on_request_chunk_sent(session, ctx, params):
+        ctx.sent = time.perf_counter()
+        metrics.inc("bot_http_request_bytes_total", (ctx.method,), len(params.chunk))
+
+    async def on_request_end(session, ctx, params):
+        now = time.perf_counter()
+        metrics.observe("bot_http_phase_seconds", (ctx.method, "send"), max(0.0, ctx.sent - ctx.ready))
+        metrics.observe("bot_http_phase_seconds", (ctx.method, "server"), now - ctx.sent)
+        metrics.observe("bot_http_phase_seconds", (ctx.method, "total"), now - ctx.started)
+
+    async def on_response_chunk_received(session, ctx, params):
+        metrics.inc("bot_http_response_bytes_total", (ctx.method,), len(params.chunk))
+
+    async def on_request_exception(session, ctx, params):
+        metrics.inc("bot_http_errors_total", (ctx.method, type(params.exception).__name__))
+
+    for signal, callback in (
+        (trace_config.on_request_start, on_request_start),
+        (trace_config.on_connection_queued_start, on_connection_queued_start),
+        (trace_config.on_connection_queued_end, on_connection_queued_end),
+        (trace_config.on_dns_resolvehost_start, on_dns_resolvehost_start),
+        (trace_config.on_dns_resolvehost_end, on_dns_resolvehost_end),
+        (trace_config.on_dns_cache_hit, on_dns_cache_hit),
+        (trace_config.on_dns_cache_miss, on_dns_cache_miss),
+        (trace_config.on_connection_create_start, on_connection_create_start),
+        (trace_config.on_connection_create_end, on_connection_create_end),
+        (trace_config.on_connection_reuseconn, on_connection_reuseconn),
+        (trace_config.on_request_headers_sent, on_request_headers_sent),
+        (trace_config.on_request_chunk_sent, on_request_chunk_sent),
+        (trace_config.on_request_end, on_request_end),
+        (trace_config.on_response_chunk_received, on_response_chunk_received),
+        (trace_config.on_request_exception, on_request_exception),
+    ):
+        signal.append(callback)
+    return trace_config
+
+
+class InstrumentedAiohttpSession(AiohttpSession):
+    """
+    Сессия aiogram с настраиваемым пулом соединений и трассировкой запросов.
+    Вместе с bot_handler_seconds и bot_telegram_request_seconds фазы запроса
+    показывают, где теряется время: в нашем коде, в очереди отправки, в сети или у Telegram.
+    """
+
+    def __init__(self, trace: bool = HTTP_TRACE, **kwargs):
+        super().__init__(**kwargs)
+        self.trace = trace
+        self._connector_init.update(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+
+    async def create_session(self) -> ClientSession:
+        if self._should_reset_connector:
+            await self.close()
+
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+                trace_configs=[build_trace_config()] if self.trace else None,
+            )
+            self._should_reset_connector = False
+
+        return self._session
+
+
+# --- Запись обновлений для воспроизведения ---
+# UPDATE_LOG_PATH — файл, в который дописываются входящие обновления (пусто — не записывать).
+# Формат — строка JSON на обновление: {"t": время, "u": обезличенный id, "k": "m"|"c", "d": данные}.
+# Для сообщений сохраняются только команды, остальной текст заменяется пустой строкой.
+UPDATE_LOG_PATH = os.getenv("UPDATE_LOG_PATH", "")
+# Соль для обезличивания id; без неё id согласованы только в пределах одного запуска
+UPDATE_LOG_SALT = os.getenv("UPDATE_LOG_SALT") or secrets.token_hex(16)
+UPDATE_LOG_FLUSH_INTERVAL = float(os.getenv("UPDATE_LOG_FLUSH_INTERVAL", "1"))
+
+
+def anonymize_id(user_id: int, salt: str = UPDATE_LOG_SALT) -> int:
+    """Стабильный обезличенный id (48 бит HMAC-SHA256), пригодный как id чата при воспроизведении"""
+    digest = hmac.new(salt.encode(), str(user_id).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:6], "big") or 1
+
+
+def update_record(update: types.Update) -> Optional[dict]:
+    """Запись журнала для обновления; None для типов, которые бот не обрабатывает"""
+    if update.message and update.message.from_user:
+        text = update.message.text or ""
+        return {
+            "u": anonymize_id(update.message.from_user.id),
+            "k": "m",
+            "d": text if text.startswith("/") else "",
+        }
+    if update.callback_query:
+        return {
+            "u": anonymize_id(update.callback_query.from_user.id),
+            "k": "c",
+            "d": update.callback_query.data or "",
+        }
+    return None
+
+
+class UpdateRecorder(BaseMiddleware):
+    """
+    Внешний middleware диспетчера: дописывает каждое обновление в журнал.
+    Строки копятся в буфере файла и сбрасываются на диск не чаще раза в интервал.
+    """
+
+    def __init__(self, path: str, flush_interval: float = UPDATE_LOG_FLUSH_INTERVAL):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.recorded = 0
+
+    async def __call__(self, handler, event: types.Update, data):
+        try:
+            record = update_record(event)
+            if record:
+                self.file.write(json.dumps({"t": round(time.time(), 3), **record},
+                                           ensure_ascii=False, separators=(",", ":")) + "\n")
+                self.recorded += 1
+                if time.monotonic() - self.flushed >= self.flush_interval:
+                    self.file.flush()
+                    self.flushed = time.monotonic()
+        except Exception as e:
+            logger.warning(f"Не удалось записать обновление в журнал: {e}")
+        return await handler(event, data)
+
+    def close(self):
+        self.file.close()
+        logger.info(f"В журнал {self.path} записано обновлений: {self.recorded}")
+
+
 # --- Инициализация бота и диспетчера ---
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot = Bot(
+    token=TOKEN,
+    session=InstrumentedAiohttpSession(
+        **({"api": TelegramAPIServer.from_base(TELEGRAM_API_URL)} if TELEGRAM_API_URL else {})
+    ),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+dp = Dispatcher(storage=create_fsm_storage())
+
+
+class CallbackRouter:
+    """
+    Маршрутизация callback-запросов: код действия из callback_data ищется в словаре,
+    аргументы передаются обработчику позиционно, FSMContext — если он его принимает.
+    """
+
+    def __init__(self):
+        # код -> (обработчик, число аргументов, нужен ли state)
+        self.routes: Dict[str, Tuple[Callable, int, bool]] = {}
+
+    def route(self, op: str):
+        def decorator(handler):
+            if op in self.routes:
+                raise ValueError(f"Код callback_data '{op}' уже занят обработчиком {self.routes[op][0].__name__}")
+            params = list(inspect.signature(handler).parameters)[1:]
+            wants_state = "state" in params
+            self.routes[op] = (handler, len(params) - wants_state, wants_state)
+            return handler
+        return decorator
+
+    async def dispatch(self, callback: types.CallbackQuery, state: FSMContext):
+        decoded = unpack_callback(callback.data)
+        route = self.routes.get(decoded[0]) if decoded else None
+        if route is None or len(decoded[1]) != route[1]:
+            hot_logger.info("Неизвестная или устаревшая callback_data", extra={"callback_data": callback.data})
+            await callback.answer("⚠️ Кнопка устарела. Открой меню заново: /menu", show_alert=True)
+            return
+        handler, _, wants_state = route
+        if wants_state:
+            return await handler(callback, *decoded[1], state=state)
+        return await handler(callback, *decoded[1])
+
+
+callback_router = CallbackRouter()
+
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Единая точка входа для всех inline-кнопок"""
+    return await callback_router.dispatch(callback, state)
+
+
+# Все исходящие запросы проходят через планировщик; замер снаружи, чтобы учесть ожидание в очереди
+send_scheduler = SendScheduler()
+bot.session.middleware(TelegramRequestMetrics())
+bot.session.middleware(send_scheduler)
+
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
 
-# Инициализация базы данных
-db = Database()
+metrics.add_collector("bot_send_scheduler", send_scheduler.metrics)
+if hasattr(dp.storage, "metrics"):
+    metrics.add_collector("bot_fsm_storage", dp.storage.metrics)
+
+update_recorder = UpdateRecorder(UPDATE_LOG_PATH) if UPDATE_LOG_PATH else None
+if update_recorder:
+    dp.update.outer_middleware(update_recorder)
+
+# Защита от флуда до фильтров и чтения состояния FSM: Dispatcher регистрирует
+# FSMContextMiddleware внешним middleware обновлений, поэтому переносим его
+# после защиты (запись обновлений стоит раньше и видит весь трафик)
+anti_flood = AntiFloodMiddleware()
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(anti_flood)
+dp.update.outer_middleware(dp.fsm)
+metrics.add_collector("bot_anti_flood", anti_flood.metrics)
+
+# Инициализация базы данных (фаза запуска)
+db: Optional[Database] = None
+
+
+@startup_phase("database")
+def init_database_phase():
+    global db
+    db = Database(os.getenv("DB_PATH", "user_progress.db"))
+
+
+@startup_phase("fsm_storage")
+async def check_fsm_storage_phase():
+    """
+    Для общего хранилища проверяет, что второй экземпляр (как в другом процессе)
+    видит записи первого и наоборот — без устаревших данных из локального кэша.
+    """
+    if FSM_STORAGE == "memory":
+        return
+    key = StorageKey(bot_id=0, chat_id=0, user_id=0, destiny="startup_check")
+    other = create_fsm_storage()
+    try:
+        token = secrets.token_hex(8)
+        await dp.storage.set_data(key, {"token": token})
+        await dp.storage.get_data(key)  # как обработчик, прочитавший состояние до чужой записи
+        if (await other.get_data(key)).get("token") != token:
+            raise RuntimeError(f"экземпляры хранилища {FSM_STORAGE} не видят записи друг друга")
+        await other.set_data(key, {"token": f"{token}:other"})
+        if (await dp.storage.get_data(key)).get("token") != f"{token}:other":
+            # SQLite обычно открывает один процесс, Redis — всегда общий
+            log = logger.warning if FSM_STORAGE == "redis" else logger.info
+            log(f"Кэш FSM (FSM_CACHE_TTL={FSM_CACHE_TTL}) отдаёт устаревшие данные, "
+                f"если обновления пользователя попадают в разные процессы")
+        await dp.storage.set_data(key, {})
+    finally:
+        await other.close()
 
 
 
@@ -716,40 +2251,20 @@ async def set_bot_commands(bot: Bot):
     ]
     await bot.set_my_commands(commands)
 
+
+@startup_phase("bot_commands", critical=False)
+async def set_bot_commands_phase():
+    await set_bot_commands(bot)
+
 @dp.message(Command("menu"))
 async def cmd_menu(message: types.Message):
     """Обработчик команды /menu с улучшенным персональным приветствием"""
     try:
         user = message.from_user
-        name = ""
-        # Формируем обращение в зависимости от доступных данных
-        if user.first_name and user.last_name:
-            name = f"{user.first_name} {user.last_name}"
-        elif user.first_name:
-            name = user.first_name
-        elif user.last_name:
-            name = user.last_name
-        elif user.username:
-            name = f"@{user.username}"
-        else:
-            name = "друг"
         # Регистрируем пользователя в базе данных
         db.add_user(user)
-        # Форматируем текст с учетом возможного HTML-форматирования
-        welcome_text = (
-            f"🌟 <b>{html.escape(user.first_name)}</b>, ты в главном меню! \n \n"
-            "Выбери <b>📖 Cказки</b>, если хочешь: \n"
-            " • почитать или послушать сказки на хантыйском,\n"
-            " • увидеть русский перевод сказки,\n"
-            " • пройти тест на знание материала,\n\n"
-             
-            "Выбери <b>📚 Словарик</b>, если хочешь:\n"
-            " • услышать произношение букв хантыйского алфавита,\n"
-            " • увидеть список слов с переводом,\n"
-            " • узнать грамматические правила. \n\n"
-        )
         await message.answer(
-            welcome_text,
+            MAIN_MENU_TEXT.format(name=html.escape(user.first_name)),
             reply_markup=await main_menu_kb(),
             parse_mode=ParseMode.HTML
         )
@@ -757,14 +2272,204 @@ async def cmd_menu(message: types.Message):
         logger.error(f"Ошибка в cmd_menu: {e}", exc_info=True)
         try:
             await message.answer(
-                "🌟 Добро пожаловать в бота для изучения хантыйского языка!\n"
-                "Пожалуйста, выбери раздел:",
+                FALLBACK_MENU_TEXT,
                 reply_markup=await main_menu_kb()
             )
         except Exception as fallback_error:
             logger.critical(f"Критическая ошибка в cmd_menu: {fallback_error}")
 
 
+# --- Профилирование по запросу ---
+# Администраторы, которым доступна команда /profile (id через запятую)
+ADMIN_IDS = {int(value) for value in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if value}
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # период выборки стека, с
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+
+def profile_frame_label(code) -> str:
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def profile_root(task: Optional[asyncio.Task]) -> str:
+    """Корень стека: обработчик (как в bot_handler_seconds) или корутина задачи"""
+    labels = active_handlers.get(task)
+    if labels:
+        return f"handler:{labels[0]}[{labels[1]}]" if labels[1] else f"handler:{labels[0]}"
+    return f"task:{task.get_coro().__qualname__}"
+
+
+class SamplingProfiler:
+    """
+    Статистический профилировщик цикла событий.
+    Отдельный поток раз в interval снимает стек потока цикла (sys._current_frames)
+    и относит его к обработчику текущей задачи — цикл при этом не останавливается.
+    Раз в task_interval на самом цикле снимаются цепочки ожидания всех задач,
+    а по задержке этого вызова оценивается лаг цикла.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, task_interval: float = 0.1):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.interval = interval
+        self.task_interval = task_interval
+        self.stacks: Counter = Counter()       # выполнение на цикле
+        self.task_stacks: Counter = Counter()  # где ждут задачи
+        self.lags: List[float] = []
+        self.samples = 0
+        self.idle = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def run(self):
+        next_tasks = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.debug(f"Профилировщик пропустил выборку: {e}")
+            if time.perf_counter() >= next_tasks:
+                next_tasks += self.task_interval
+                self.loop.call_soon_threadsafe(self.sample_tasks, time.perf_counter())
+
+    def sample(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return
+        task = asyncio.current_task(self.loop)
+        coro_frame = getattr(task.get_coro(), "cr_frame", None) if task else None
+        frames = []
+        while frame is not None:
+            frames.append(frame.f_code)
+            if frame is coro_frame:
+                break  # выше — только механика asyncio
+            frame = frame.f_back
+        frames.reverse()
+        self.samples += 1
+        if task is None:
+            # Колбэки цикла или ожидание в select
+            if frames[-1].co_name in ("select", "poll", "epoll", "kqueue", "control"):
+                self.idle += 1
+                self.stacks["(idle)"] += 1
+                return
+            names = [code.co_name for code in frames]
+            start = len(names) - names[::-1].index("_run_once") if "_run_once" in names else 0
+            root = "(loop)"
+            frames = frames[start:]
+        else:
+            root = profile_root(task)
+        self.stacks[";".join([root, *map(profile_frame_label, frames)])] += 1
+
+    def sample_tasks(self, scheduled: float):
+        """Выполняется на цикле: лаг и цепочки await всех задач"""
+        self.lags.append(time.perf_counter() - scheduled)
+        for task in asyncio.all_tasks(self.loop):
+            chain = [profile_root(task)]
+            awaitable = task.get_coro()
+            while awaitable is not None and len(chain) < 64:
+                code = getattr(awaitable, "cr_code", None) or getattr(awaitable, "gi_code", None)
+                if code is None:
+                    chain.append(type(awaitable).__name__)
+                    break
+                chain.append(profile_frame_label(code))
+                awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+            self.task_stacks[";".join(chain)] += 1
+
+    def collapsed(self, view: str = "cpu") -> str:
+        """Стеки в формате collapsed (flamegraph.pl, speedscope)"""
+        stacks = self.task_stacks if view == "tasks" else self.stacks
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def summary(self, top: int = 10) -> dict:
+        handlers = Counter()
+        for stack, count in self.stacks.items():
+            handlers[stack.split(";", 1)[0]] += count
+        lags = sorted(self.lags)
+        return {
+            "seconds": round(self.elapsed, 3),
+            "samples": self.samples,
+            "busy_share": round(1 - self.idle / self.samples, 3) if self.samples else 0.0,
+            "top": [(name, round(count / self.samples, 3)) for name, count in handlers.most_common(top)]
+            if self.samples else [],
+            "loop_lag_ms": {
+                "p50": round(lags[len(lags) // 2] * 1000, 2) if lags else 0.0,
+                "p99": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 2) if lags else 0.0,
+                "max": round(lags[-1] * 1000, 2) if lags else 0.0,
+            },
+        }
+
+
+profile_lock = asyncio.Lock()
+
+
+async def run_profile(seconds: float, interval: float = PROFILE_INTERVAL) -> SamplingProfiler:
+    """Профилирует работающий бот seconds секунд; одновременно идёт только один профиль"""
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    async with profile_lock:
+        profiler = SamplingProfiler(max(interval, 0.001))
+        logger.info(f"Профилирование на {seconds:.1f} с, период {profiler.interval * 1000:.1f} мс")
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+        return profiler
+
+
+async def handle_profile_request(request: web.Request) -> web.Response:
+    """
+    GET /debug/profile?seconds=10&interval=0.005&view=cpu|tasks|summary
+    Отдаёт стеки в формате collapsed или сводку в JSON.
+    """
+    if profile_lock.locked():
+        return web.Response(status=409, text="Профилирование уже идёт\n")
+    try:
+        seconds = float(request.query.get("seconds", "10"))
+        interval = float(request.query.get("interval", PROFILE_INTERVAL))
+    except ValueError:
+        return web.Response(status=400, text="seconds и interval должны быть числами\n")
+    profiler = await run_profile(seconds, interval)
+    view = request.query.get("view", "cpu")
+    if view == "summary":
+        return web.json_response(profiler.summary())
+    return web.Response(text=profiler.collapsed(view), content_type="text/plain", charset="utf-8")
+
+
+@dp.message(Command("profile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: types.Message):
+    """/profile [секунды] — профиль работающего бота для администраторов"""
+    if profile_lock.locked():
+        await message.answer("⏳ Профилирование уже идёт")
+        return
+    parts = (message.text or "").split()
+    seconds = float(parts[1]) if len(parts) > 1 and parts[1].replace(".", "", 1).isdigit() else 10.0
+    await message.answer(f"🔬 Профилирую {min(seconds, PROFILE_MAX_SECONDS):.0f} с...")
+    profiler = await run_profile(seconds)
+    summary = profiler.summary()
+    top = "\n".join(f"{share:.0%} {html.escape(name)}" for name, share in summary["top"][:5])
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    await message.answer_document(
+        types.BufferedInputFile(profiler.collapsed("cpu").encode(), filename=f"profile-cpu-{stamp}.folded"),
+        caption=(
+            f"Выборок: {summary['samples']}, занятость цикла: {summary['busy_share']:.0%}\n"
+            f"Лаг цикла p50/p99/max: {summary['loop_lag_ms']['p50']}/{summary['loop_lag_ms']['p99']}/"
+            f"{summary['loop_lag_ms']['max']} мс\n{top}"
+        )[:1024]
+    )
+    await message.answer_document(
+        types.BufferedInputFile(profiler.collapsed("tasks").encode(), filename=f"profile-tasks-{stamp}.folded"),
+        caption="Цепочки ожидания задач (collapsed, для flamegraph.pl или speedscope)"
+    )
+
+
 
 
 
@@ -787,17 +2492,184 @@ async def cmd_menu(message: types.Message):
 
 
 # --- Вспомогательные функции ---
-async def split_long_message(text: str, max_length: int = 4096) -> List[str]:
-    if len(text) <= max_length:
+# Лексемы HTML: тег, сущность, перевод строки, слово вместе с пробелом после него
+HTML_TOKEN_RE = re.compile(r'<[^>]*>|&#?\w+;|\n|[^<&\n ]+ ?| +|[<&]')
+# Запас в первой части под отметку «(прочитано N раз(а))»
+READ_COUNT_RESERVE = 40
+
+
+def html_tag_name(tag: str) -> str:
+    return re.split(r'[\s/>]', tag.lstrip('</'), 1)[0].lower()
+
+
+def split_html_message(text: str, max_length: int = 4096, first_reserve: int = 0) -> List[str]:
+    """
+    Делит HTML-текст на части не длиннее max_length.
+    Режет по переводу строки, а если строка не помещается — между словами;
+    теги и сущности не разрываются. Незакрытые теги закрываются в конце
+    части и открываются заново в начале следующей. В каждой части есть текст:
+    Telegram не принимает сообщения из одних тегов.
+    first_reserve — сколько символов оставить свободными в первой части.
+    """
+    if len(text) + first_reserve <= max_length:
         return [text]
-    parts = []
-    while text:
-        part = text[:max_length]
-        split_pos = part.rfind('\n') if '\n' in part else max_length
-        parts.append(text[:split_pos])
-        text = text[split_pos:].lstrip()
+
+    tokens = HTML_TOKEN_RE.findall(text)
+    parts: List[str] = []
+    open_tags: List[str] = []  # открывающие теги, ещё не закрытые
+    i = 0
+    while i < len(tokens):
+        limit = max_length - (first_reserve if not parts else 0)
+        closing = sum(len(html_tag_name(tag)) + 3 for tag in open_tags)
+        if sum(map(len, open_tags)) + closing >= limit:
+            # Теги, открытые заново, не оставляют места тексту — часть идёт без них
+            open_tags = []
+            closing = 0
+        chunk = list(open_tags)
+        length = sum(map(len, chunk))
+        tags = list(open_tags)
+        body_start = len(chunk)
+        has_text = False
+        # (число лексем в части, индекс следующей лексемы, открытые теги, есть ли текст)
+        last_break = None
+        while i < len(tokens):
+            token = tokens[i]
+            if len(chunk) == body_start and token.isspace():
+                i += 1
+                continue
+            is_tag = token.startswith('<') and len(token) > 1
+            new_tags, new_closing = tags, closing
+            if token.startswith('</'):
+                name = html_tag_name(token)
+                for j in range(len(tags) - 1, -1, -1):
+                    if html_tag_name(tags[j]) == name:
+                        new_tags = tags[:j] + tags[j + 1:]
+                        new_closing = closing - len(name) - 3
+                        break
+                else:
+                    # Закрывающий тег без пары (например, открытие было отброшено)
+                    i += 1
+                    continue
+            elif is_tag and not token.endswith('/>'):
+                new_tags = tags + [token]
+                new_closing = closing + len(html_tag_name(token)) + 3
+
+            if length + len(token) + new_closing > limit:
+                if has_text:
+                    break
+                if is_tag:
+                    # Тег не помещается даже в часть без текста — пропускаем его
+                    i += 1
+                    continue
+                # Слово длиннее части — режем его как есть внутри текущей части
+                room = max(1, limit - length - closing)
+                tokens[i:i + 1] = [token[:room], token[room:]]
+                continue
+            chunk.append(token)
+            length += len(token)
+            tags, closing = new_tags, new_closing
+            has_text = has_text or not (is_tag or token.isspace())
+            i += 1
+            if token == '\n':
+                last_break = (len(chunk), i, tags, has_text)
+
+        if i < len(tokens) and last_break is not None:
+            size, i, tags, has_text = last_break
+            chunk = chunk[:size]
+        if has_text:
+            parts.append(''.join(chunk).rstrip() + ''.join(f'</{html_tag_name(tag)}>' for tag in reversed(tags)))
+        open_tags = tags
     return parts
 
+
+async def split_long_message(text: str, max_length: int = 4096) -> List[str]:
+    return split_html_message(text, max_length)
+
+
+def with_read_count(parts: List[str], header: str, read_count: Optional[int]) -> List[str]:
+    """Добавляет отметку о числе прочтений после заголовка в первой части"""
+    if not read_count:
+        return parts
+    first = parts[0].replace(header, f"{header} (прочитано {read_count} раз(а))", 1)
+    return [first] + parts[1:]
+
+
+async def reading_page(state: FSMContext, story_id: int, lang: str, total: int) -> int:
+    """Страница, на которой пользователь остановился в этой сказке (иначе первая)"""
+    position = (await state.get_data()).get('read_pos')
+    if position and position[0] == story_id and position[1] == lang:
+        return min(position[2], total - 1)
+    return 0
+
+
+def build_story_texts(stories: list) -> Dict[Tuple[int, str], List[str]]:
+    """Заранее делит тексты сказок, грамматику и лексику на части для отправки"""
+    texts = {}
+    for story in stories:
+        texts[(story['id'], 'ru')] = split_html_message(
+            f"📖 <b>{story['rus_title']}</b>\n{story['rus_text']}",
+            first_reserve=READ_COUNT_RESERVE
+        )
+        texts[(story['id'], 'kh')] = split_html_message(
+            f"📖 <b>{story['han_title']}</b>\n"
+            f"<i>({story['rus_title']})</i>\n"
+            f"{story['han_text']}",
+            first_reserve=READ_COUNT_RESERVE
+        )
+        if story.get('grammar') and story['grammar'].strip():
+            texts[(story['id'], 'grammar')] = split_html_message(
+                f"📝 <b>Грамматика для сказки '{story['rus_title']}':</b>\n{story['grammar']}"
+            )
+        if story.get('han_words') and story.get('rus_words'):
+            word_pairs = [f"• <b>{han}</b> - {rus}" for han, rus in zip(story['han_words'], story['rus_words'])]
+            texts[(story['id'], 'lexicon')] = split_html_message(
+                f"🔤 <b>Лексика для сказки '{story['rus_title']}':</b>\n" + "\n".join(word_pairs)
+            )
+    return texts
+
+
+def build_grammar_digest(stories: list, max_length: int = 4096) -> dict:
+    """
+    Собирает общую грамматику из всех сказок в страницы.
+    Разделы сказок укладываются на страницы подряд; для оглавления
+    запоминается страница, с которой начинается раздел каждой сказки.
+    """
+    pages: List[str] = []
+    toc: List[Tuple[str, int]] = []
+    current = ""
+    for story in stories:
+        if not story.get('grammar'):
+            continue
+        section = split_html_message(f"📝 <b>{story['rus_title']}</b>\n{story['grammar']}\n", max_length)
+        if current and len(current) + 2 + len(section[0]) <= max_length:
+            toc.append((story['rus_title'], len(pages)))
+            current = f"{current}\n\n{section[0]}"
+        else:
+            if current:
+                pages.append(current)
+            toc.append((story['rus_title'], len(pages)))
+            current = section[0]
+        for part in section[1:]:
+            pages.append(current)
+            current = part
+    if current:
+        pages.append(current)
+    return {'pages': pages, 'toc': toc}
+
+
+# Готовые части текстов: (id сказки, раздел) -> список сообщений; разделы ru, kh, grammar, lexicon
+story_texts: Dict[Tuple[int, str], List[str]] = {}
+# Общая грамматика: страницы и оглавление (меняются только вместе с fairytales.json)
+grammar_digest: dict = {'pages': [], 'toc': []}
+
+
+@startup_phase("story_texts", requires=("tales",))
+def build_story_texts_phase():
+    global story_texts, grammar_digest
+    story_texts = build_story_texts(tales_data['stories'])
+    grammar_digest = build_grammar_digest(tales_data['stories'])
+
+
 def build_menu(buttons: List[Tuple[str, str]], 
               back_button: Optional[Tuple[str, str]] = None,
               additional_buttons: List[Tuple[str, str]] = None,
@@ -848,17 +2720,96 @@ def build_menu(buttons: List[Tuple[str, str]],
     
     return builder.as_markup()
 
+# Разметка aiogram изменяема (MutableTelegramObject). Реестр хранит замороженные
+# копии: ряды — списки только для чтения, разметка и кнопки — frozen-модели,
+# поэтому один объект безопасно отдаётся всем пользователям без копирования.
+class ReadOnlyList(list):
+    """Список, который нельзя изменить; копии (copy, pickle) — обычные списки"""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("клавиатура из реестра только для чтения")
+
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
 
 
+class FrozenInlineKeyboardButton(InlineKeyboardButton):
+    model_config = ConfigDict(frozen=True)
 
 
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
 
-@dp.callback_query(F.data.startswith("show_culture_"))
-async def show_culture_fact(callback: types.CallbackQuery, state: FSMContext):
+
+# Модели aiogram собираются отложенно (defer_build), подклассы — тоже
+FrozenInlineKeyboardButton.model_rebuild()
+FrozenInlineKeyboardMarkup.model_rebuild()
+
+
+def freeze_keyboard(markup: InlineKeyboardMarkup) -> FrozenInlineKeyboardMarkup:
+    """Копия разметки только для чтения: её можно отдавать всем пользователям"""
+    rows = ReadOnlyList(
+        ReadOnlyList(
+            FrozenInlineKeyboardButton.model_construct(_fields_set=button.model_fields_set, **dict(button))
+            for button in row
+        )
+        for row in markup.inline_keyboard
+    )
+    return FrozenInlineKeyboardMarkup.model_construct(inline_keyboard=rows)
+
+
+# Готовые клавиатуры: (функция, именованные аргументы) -> разметка, вытеснение по LRU.
+# Клавиатуры зависят только от контента, который загружается при старте;
+# при его перезагрузке реестр нужно очистить.
+KEYBOARD_REGISTRY_SIZE = int(os.getenv("KEYBOARD_REGISTRY_SIZE", "4096"))
+keyboard_registry: "OrderedDict[tuple, FrozenInlineKeyboardMarkup]" = OrderedDict()
+
+
+def registry_keyboard(key: tuple) -> Optional[FrozenInlineKeyboardMarkup]:
+    markup = keyboard_registry.get(key)
+    if markup is not None:
+        keyboard_registry.move_to_end(key)
+    return markup
+
+
+def register_keyboard(key: tuple, markup: InlineKeyboardMarkup) -> FrozenInlineKeyboardMarkup:
+    frozen = keyboard_registry[key] = freeze_keyboard(markup)
+    while len(keyboard_registry) > KEYBOARD_REGISTRY_SIZE:
+        keyboard_registry.popitem(last=False)
+    return frozen
+
+
+def registered_keyboard(func):
+    """
+    Строит клавиатуру один раз для каждого набора аргументов (с учётом значений
+    по умолчанию). Если построение упало, в реестр ничего не попадает.
+    """
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func, *bound.arguments.items())
+        markup = registry_keyboard(key)
+        if markup is None:
+            markup = register_keyboard(key, await func(*args, **kwargs))
+        return markup
+    return wrapper
+
+
+
+
+
+
+
+@callback_router.route(CALLBACK_SHOW_CULTURE)
+async def show_culture_fact(callback: types.CallbackQuery, story_id: int, state: FSMContext):
     """Показывает культурный факт для сказки с возвратом к исходной версии"""
     try:
-        story_id = int(callback.data.split("_")[-1])
-        
         # Получаем текущее состояние (из какого языка пришли)
         user_data = await state.get_data()
         lang = user_data.get('last_lang', 'ru')  # По умолчанию русский
@@ -876,11 +2827,11 @@ async def show_culture_fact(callback: types.CallbackQuery, state: FSMContext):
             caption += f"\n\n🔗 Источник: {culture_fact['source']}"
         
         # Создаем кнопку возврата в зависимости от языка
-        back_callback = f"{CALLBACK_LANGUAGE_RU}{story_id}" if lang == 'ru' else f"{CALLBACK_LANGUAGE_KH}{story_id}"
+        back_callback = pack_callback(CALLBACK_LANGUAGE_RU, story_id) if lang == 'ru' else pack_callback(CALLBACK_LANGUAGE_KH, story_id)
         
         kb = InlineKeyboardBuilder()
         kb.button(text="🔙 Назад к сказке", callback_data=back_callback)
-        kb.button(text="🗂️ Главное меню", callback_data=CALLBACK_BACK_TO_MAIN)
+        kb.button(text="🗂️ Главное меню", callback_data=pack_callback(CALLBACK_BACK_TO_MAIN))
         kb.adjust(2)
         
         if culture_fact.get("photo"):
@@ -932,48 +2883,40 @@ async def send_audio_if_exists(chat_id: int, story: dict):
     return False
 
 
-async def send_question(message: types.Message, question: dict, current: int, total: int):
-    """Отправляет вопрос теста"""
-    builder = InlineKeyboardBuilder()
-    for i, variant in enumerate(question["variants"]):
-        builder.button(text=variant, callback_data=f"test_answer_{question['q_id']}_{i}")
-    builder.adjust(1)
-    await message.answer(
-        f"📝 Вопрос {current + 1}/{total}\n"
-        f"{question['question']}",
-        reply_markup=builder.as_markup()
-    )
+async def send_question(message: types.Message, question: dict):
+    """Отправляет вопрос теста (текст и клавиатура заготовлены в каталоге)"""
+    await message.answer(question["prompt"], reply_markup=question["markup"])
 
 
-async def alphabet_menu_kb() -> InlineKeyboardMarkup:
-    """Меню раздела алфавита"""
-    buttons = [
-        ("🔠 Названия букв", CALLBACK_ALPHABET_LETTERS),
-        ("🔡 Гласные звуки", CALLBACK_ALPHABET_VOWELS),
-        ("🔣 Согласные звуки", CALLBACK_ALPHABET_CONSONANTS)
-    ]
-    return build_menu(buttons, ("🔙 Назад", CALLBACK_BACK_TO_VOCABULARY), columns=1)
+# --- Клавиатуры ---
+TALES_PAGE_SIZE = 5
+LEXICON_PAGE_SIZE = 8
 
 
-# --- Клавиатуры ---
+def page_count(total: int, page_size: int) -> int:
+    return (total + page_size - 1) // page_size
+
+
+@registered_keyboard
 async def main_menu_kb() -> InlineKeyboardMarkup:
     """Главное меню"""
     buttons = [
-        ("📖 Сказки", CALLBACK_TALES),
-        ("📚 Словарик", CALLBACK_VOCABULARY),
-        ("📊 Мой прогресс", CALLBACK_PROGRESS)
+        ("📖 Сказки", pack_callback(CALLBACK_TALES)),
+        ("📚 Словарик", pack_callback(CALLBACK_VOCABULARY)),
+        ("📊 Мой прогресс", pack_callback(CALLBACK_PROGRESS))
     ]
     return build_menu(buttons, columns=2)
 
 
+@registered_keyboard
 async def vocabulary_menu_kb() -> InlineKeyboardMarkup:
     """Меню словаря"""
     buttons = [
-        ("📝 Общая грамматика", CALLBACK_GRAMMAR),
-        ("🔤 Общая лексика", CALLBACK_LEXICON),
-        ("🔡 Алфавит", CALLBACK_ALPHABET)
+        ("📝 Общая грамматика", pack_callback(CALLBACK_GRAMMAR)),
+        ("🔤 Общая лексика", pack_callback(CALLBACK_LEXICON)),
+        ("🔡 Алфавит", pack_callback(CALLBACK_ALPHABET))
     ]
-    return build_menu(buttons, ("🗂️ Главное меню", CALLBACK_BACK_TO_MAIN), columns=2)
+    return build_menu(buttons, ("🗂️ Главное меню", pack_callback(CALLBACK_BACK_TO_MAIN)), columns=2)
 
 
 
@@ -996,7 +2939,8 @@ async def vocabulary_menu_kb() -> InlineKeyboardMarkup:
 
 
 
-async def tales_menu_kb(page: int = 0, page_size: int = 5) -> InlineKeyboardMarkup:
+@registered_keyboard
+async def tales_menu_kb(page: int = 0, page_size: int = TALES_PAGE_SIZE) -> InlineKeyboardMarkup:
     """Меню сказок с пагинацией"""
     stories = tales_data['stories']
     total_pages = (len(stories) + page_size - 1) // page_size
@@ -1004,29 +2948,30 @@ async def tales_menu_kb(page: int = 0, page_size: int = 5) -> InlineKeyboardMark
     end_idx = start_idx + page_size
     paginated_stories = stories[start_idx:end_idx]
     buttons = [
-        (story['rus_title'], f"{CALLBACK_SHOW_STORY}{story['id']}") 
+        (story['rus_title'], pack_callback(CALLBACK_SHOW_STORY, story['id'])) 
         for story in paginated_stories
     ]
     navigation_buttons = []
     if page > 0:
-        navigation_buttons.append(("◀️ Назад", f"{CALLBACK_TALES_PAGE_PREFIX}{page-1}"))
+        navigation_buttons.append(("◀️ Назад", pack_callback(CALLBACK_TALES_PAGE_PREFIX, page-1)))
     if end_idx < len(stories):
-        navigation_buttons.append(("Вперёд ▶️", f"{CALLBACK_TALES_PAGE_PREFIX}{page+1}"))
+        navigation_buttons.append(("Вперёд ▶️", pack_callback(CALLBACK_TALES_PAGE_PREFIX, page+1)))
     return build_menu(
         buttons, 
-        back_button=("🗂️ Главное меню", CALLBACK_BACK_TO_MAIN),
+        back_button=("🗂️ Главное меню", pack_callback(CALLBACK_BACK_TO_MAIN)),
         additional_buttons=navigation_buttons,
         columns=1
     )
 
 
+@registered_keyboard
 async def language_menu_kb(story_id: int) -> InlineKeyboardMarkup:
     """Меню выбора языка для сказки"""
     buttons = [
-        ("🇷🇺 Русский", f"{CALLBACK_LANGUAGE_RU}{story_id}"),
-        ("🦦 Хантыйский", f"{CALLBACK_LANGUAGE_KH}{story_id}")
+        ("🇷🇺 Русский", pack_callback(CALLBACK_LANGUAGE_RU, story_id)),
+        ("🦦 Хантыйский", pack_callback(CALLBACK_LANGUAGE_KH, story_id))
     ]
-    return build_menu(buttons, ("🔙 Назад", CALLBACK_BACK_TO_TALES), columns=2)
+    return build_menu(buttons, ("🔙 Назад", pack_callback(CALLBACK_BACK_TO_TALES)), columns=2)
 
 
 
@@ -1037,51 +2982,86 @@ async def language_menu_kb(story_id: int) -> InlineKeyboardMarkup:
 
 
 
-async def story_menu_kb(story_id: int) -> InlineKeyboardMarkup:
+@registered_keyboard
+async def story_buttons_kb(story_id: int) -> InlineKeyboardMarkup:
     """Меню для конкретной сказки - кнопки только если есть данные"""
-    try:
-        story = next(s for s in tales_data['stories'] if s['id'] == story_id)
-        buttons = []
-        has_illustrations = os.path.exists(f"illustraciones/{story['rus_title']}") and any(os.scandir(f"illustraciones/{story['rus_title']}"))
-        has_audio = story.get('audio') and os.path.exists(f"audio/{story['audio']}")
-        has_grammar = bool(story.get('grammar', '').strip())
-        has_lexicon = bool(story.get('han_words')) and bool(story.get('rus_words'))
-        # Детальная проверка культурного факта с логированием
-        has_culture = False
-        for cf in culture_data:
-            try:
-                cf_id = int(cf.get('id', -1))
-                cf_fact = cf.get('fact', '').strip()
-                if cf_id == story_id and cf_fact:
-                    has_culture = True
-                    logger.info(f"Найден культурный факт для story_id={story_id}: {cf_fact[:50]}...")
-                    break
-            except Exception as e:
-                logger.warning(f"Ошибка обработки культурного факта: {e}")
-        
-        logger.info(f"Итог проверки для story_id={story_id}: has_culture={has_culture}")
-        
-     
-         # Формирование кнопок
-        if has_illustrations:
-            buttons.append(("🖼️ Иллюстрации", f"{CALLBACK_SHOW_ILLUSTRATIONS}{story_id}"))
-        if has_audio:
-            buttons.append(("🎧 Аудио", f"{CALLBACK_PLAY_AUDIO}{story_id}"))
-        if has_grammar:
-            buttons.append(("📖 Грамматика", f"{CALLBACK_SHOW_GRAMMAR}{story_id}"))
-        if has_lexicon:
-            buttons.append(("🔤 Лексика", f"{CALLBACK_SHOW_LEXICON}{story_id}"))
-        if any(t["fairytale_id"] == story_id for t in tests_data["tests"]):
-            buttons.append(("📝 Пройти тест", f"start_test_{story_id}"))
-        if has_culture:
-            buttons.append(("🌿 Культура", f"show_culture_{story_id}"))
-        
-        
-        return build_menu(buttons, ("🔙 Назад", CALLBACK_BACK_TO_TALES), columns=2)
+    story = next((s for s in tales_data['stories'] if s['id'] == story_id), None)
+    if story is None:
+        raise ValueError(f"сказка {story_id} не найдена")
+    buttons = []
+    has_illustrations = os.path.exists(f"illustraciones/{story['rus_title']}") and any(os.scandir(f"illustraciones/{story['rus_title']}"))
+    has_audio = story.get('audio') and os.path.exists(f"audio/{story['audio']}")
+    has_grammar = bool(story.get('grammar', '').strip())
+    has_lexicon = bool(story.get('han_words')) and bool(story.get('rus_words'))
+    # Детальная проверка культурного факта с логированием
+    has_culture = False
+    for cf in culture_data:
+        try:
+            cf_id = int(cf.get('id', -1))
+            cf_fact = cf.get('fact', '').strip()
+            if cf_id == story_id and cf_fact:
+                has_culture = True
+                logger.debug("Найден культурный факт для story_id=%s: %.50s...", story_id, cf_fact)
+                break
+        except Exception as e:
+            logger.warning(f"Ошибка обработки культурного факта: {e}")
     
+    logger.debug("Итог проверки для story_id=%s: has_culture=%s", story_id, has_culture)
+    
+ 
+     # Формирование кнопок
+    if has_illustrations:
+        buttons.append(("🖼️ Иллюстрации", pack_callback(CALLBACK_SHOW_ILLUSTRATIONS, story_id)))
+    if has_audio:
+        buttons.append(("🎧 Аудио", pack_callback(CALLBACK_PLAY_AUDIO, story_id)))
+    if has_grammar:
+        buttons.append(("📖 Грамматика", pack_callback(CALLBACK_SHOW_GRAMMAR, story_id)))
+    if has_lexicon:
+        buttons.append(("🔤 Лексика", pack_callback(CALLBACK_SHOW_LEXICON, story_id)))
+    if story_id in tests_by_tale:
+        buttons.append(("📝 Пройти тест", pack_callback(CALLBACK_START_TEST, story_id)))
+    if has_culture:
+        buttons.append(("🌿 Культура", pack_callback(CALLBACK_SHOW_CULTURE, story_id)))
+    
+    
+    return build_menu(buttons, ("🔙 Назад", pack_callback(CALLBACK_BACK_TO_TALES)), columns=2)
+
+
+async def story_menu_kb(story_id: int) -> InlineKeyboardMarkup:
+    """Меню сказки; при ошибке — одна кнопка «Назад», которая не попадает в реестр"""
+    try:
+        return await story_buttons_kb(story_id)
     except Exception as e:
         logger.error(f"Ошибка в story_menu_kb: {e}")
-        return build_menu([], ("🔙 Назад", CALLBACK_BACK_TO_TALES))
+        return build_menu([], ("🔙 Назад", pack_callback(CALLBACK_BACK_TO_TALES)))
+
+
+@registered_keyboard
+async def reader_page_kb(story_id: int, lang: str, page: int, total: int) -> InlineKeyboardMarkup:
+    """Меню сказки с кнопками листания страниц (если страниц больше одной)"""
+    menu = await story_buttons_kb(story_id)
+    if total < 2:
+        return menu
+    lang_code = READER_LANGUAGES.index(lang)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(
+            text="◀️", callback_data=pack_callback(CALLBACK_READ_PAGE, story_id, lang_code, page - 1)))
+    navigation.append(InlineKeyboardButton(
+        text=f"📄 {page + 1}/{total}", callback_data=pack_callback(CALLBACK_READ_PAGE, story_id, lang_code, page)))
+    if page < total - 1:
+        navigation.append(InlineKeyboardButton(
+            text="▶️", callback_data=pack_callback(CALLBACK_READ_PAGE, story_id, lang_code, page + 1)))
+    return InlineKeyboardMarkup(inline_keyboard=[navigation] + menu.inline_keyboard)
+
+
+async def reader_kb(story_id: int, lang: str, page: int, total: int) -> InlineKeyboardMarkup:
+    """Меню чтения; при ошибке — запасное меню сказки, которое не попадает в реестр"""
+    try:
+        return await reader_page_kb(story_id, lang, page, total)
+    except Exception as e:
+        logger.error(f"Ошибка в reader_kb: {e}")
+        return await story_menu_kb(story_id)
 
 
 
@@ -1122,18 +3102,8 @@ async def cmd_start(message: types.Message):
             name = "друг"
         # Регистрируем пользователя в базе данных
         db.add_user(user)
-        # Форматируем текст с учетом возможного HTML-форматирования
-        welcome_text = (
-            f"🌟 Вўща, <b>{html.escape(name)}</b> 🐾\n \n"
-            "Добро пожаловать в чат-бот для изучения казымского диалекта хантыйского языка!\n\n"
-            "<b>Здесь ты сможешь:</b>\n"
-            "   • 📖 Прочитать сказки на хантыйском и русском\n"
-            "   • 📚 Изучить слова и грамматику\n"
-            "   • 🔤 Познакомиться с алфавитом и фонетикой\n\n"
-            "<b>Выбери интересующий раздел:</b>"
-        )
         await message.answer(
-            welcome_text,
+            START_TEXT.format(name=html.escape(name)),
             reply_markup=await main_menu_kb(),
             parse_mode=ParseMode.HTML
         )
@@ -1141,15 +3111,14 @@ async def cmd_start(message: types.Message):
         logger.error(f"Ошибка в cmd_start: {e}", exc_info=True)
         try:
             await message.answer(
-                "🌟 Добро пожаловать в бота для изучения хантыйского языка!\n"
-                "Пожалуйста, выбери раздел:",
+                FALLBACK_MENU_TEXT,
                 reply_markup=await main_menu_kb()
             )
         except Exception as fallback_error:
             logger.critical(f"Критическая ошибка в cmd_start: {fallback_error}")
 
 
-@dp.callback_query(F.data == CALLBACK_PROGRESS)
+@callback_router.route(CALLBACK_PROGRESS)
 @dp.message(Command("progress"))
 async def show_progress(update: Union[types.Message, types.CallbackQuery]):
     """Универсальный обработчик для команды /progress и кнопки прогресса"""
@@ -1237,7 +3206,7 @@ async def show_progress(update: Union[types.Message, types.CallbackQuery]):
 
         # Создаем клавиатуру
         builder = InlineKeyboardBuilder()
-        builder.button(text="🗂️ Главное меню", callback_data=CALLBACK_BACK_TO_MAIN)
+        builder.button(text="🗂️ Главное меню", callback_data=pack_callback(CALLBACK_BACK_TO_MAIN))
         
         # Отправляем сообщение
         if is_callback:
@@ -1284,7 +3253,7 @@ async def show_progress(update: Union[types.Message, types.CallbackQuery]):
 
 
 # --- Обработчики сказок ---
-@dp.callback_query(F.data == CALLBACK_TALES)
+@callback_router.route(CALLBACK_TALES)
 async def handle_tales_first(callback: types.CallbackQuery):
     """Первый вход в меню сказок — создает новое сообщение"""
     try:
@@ -1299,13 +3268,15 @@ async def handle_tales_first(callback: types.CallbackQuery):
         await callback.answer("⚠️ Ошибка при загрузке меню", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_TALES_PAGE_PREFIX))
-async def handle_tales_pagination(callback: types.CallbackQuery):
+@callback_router.route(CALLBACK_TALES_PAGE_PREFIX)
+async def handle_tales_pagination(callback: types.CallbackQuery, page: int):
     """Обработчик пагинации в меню сказок — редактирует текущее сообщение"""
     try:
-        page = int(callback.data.replace(CALLBACK_TALES_PAGE_PREFIX, ""))
+        if not 0 <= page < page_count(len(tales_data['stories']), TALES_PAGE_SIZE):
+            await callback.answer("⚠️ Страница не найдена", show_alert=True)
+            return
         await callback.message.edit_text(
-            "📖 Выбери сказку или воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:",
+            TALES_MENU_TEXT,
             reply_markup=await tales_menu_kb(page=page)
         )
         await callback.answer()
@@ -1314,11 +3285,10 @@ async def handle_tales_pagination(callback: types.CallbackQuery):
         await callback.answer("⚠️ Ошибка при загрузке меню", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_SHOW_STORY))
-async def handle_show_story(callback: types.CallbackQuery):
+@callback_router.route(CALLBACK_SHOW_STORY)
+async def handle_show_story(callback: types.CallbackQuery, story_id: int):
     """Выбор языка для сказки"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_SHOW_STORY, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         await callback.message.answer(
             f"📖 <b>{story['rus_title']}</b>\nВыбери язык:",
@@ -1330,40 +3300,32 @@ async def handle_show_story(callback: types.CallbackQuery):
         await callback.answer("⚠️ Ошибка при загрузке сказки", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_LANGUAGE_RU))
-async def handle_language_ru(callback: types.CallbackQuery, state: FSMContext):
-    story_id = int(callback.data.replace(CALLBACK_LANGUAGE_RU, ""))
+@callback_router.route(CALLBACK_LANGUAGE_RU)
+async def handle_language_ru(callback: types.CallbackQuery, story_id: int, state: FSMContext):
     await state.update_data(last_lang='ru')
     """Показ сказки на русском (только русское название)"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_LANGUAGE_RU, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         
         # Обновляем прогресс пользователя и получаем статус обновления
         was_updated = db.update_tale_progress(callback.from_user.id, story_id)
         
-        # Только русское название
-        message = f"📖 <b>{story['rus_title']}</b>\n{story['rus_text']}"
-        parts = await split_long_message(message)
+        # Только русское название; части текста подготовлены при загрузке
+        parts = story_texts[(story_id, 'ru')]
         
         # Добавляем сообщение о прогрессе, если это не первое прочтение
         if was_updated:
             progress = db.get_user_progress(callback.from_user.id)
             for tale in progress["recent_tales"]:
                 if tale[0] == story_id:
-                    read_count = tale[2]
-                    message = f"📖 <b>{story['rus_title']}</b> (прочитано {read_count} раз(а))\n{story['rus_text']}"
-                    parts = await split_long_message(message)
+                    parts = with_read_count(parts, f"📖 <b>{story['rus_title']}</b>", tale[2])
                     break
         
-        # Отправляем первую часть без кнопок
-        for part in parts[:-1]:
-            await callback.message.answer(part)
-        
-        # Отправляем остальные части
+        # Одно сообщение со страницей текста; дальше листаем его редактированием
+        page = await reading_page(state, story_id, 'ru', len(parts))
         await callback.message.answer(
-            parts[-1],
-            reply_markup=await story_menu_kb(story_id))
+            parts[page],
+            reply_markup=await reader_kb(story_id, 'ru', page, len(parts)))
 
                 
         await callback.answer()
@@ -1371,85 +3333,155 @@ async def handle_language_ru(callback: types.CallbackQuery, state: FSMContext):
         logger.error(f"Ошибка в handle_language_ru: {e}")
         await callback.answer("⚠️ Ошибка при загрузке сказки", show_alert=True)
 
-@dp.callback_query(F.data.startswith(CALLBACK_LANGUAGE_KH))
-async def handle_language_kh(callback: types.CallbackQuery, state: FSMContext):
-    story_id = int(callback.data.replace(CALLBACK_LANGUAGE_KH, ""))
+@callback_router.route(CALLBACK_LANGUAGE_KH)
+async def handle_language_kh(callback: types.CallbackQuery, story_id: int, state: FSMContext):
     await state.update_data(last_lang='kh')
     """Показ сказки на хантыйском (с хантыйским и русским названием)"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_LANGUAGE_KH, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         
         # Обновляем прогресс пользователя и получаем статус обновления
         was_updated = db.update_tale_progress(callback.from_user.id, story_id)
         
-        # Хантыйское + русское название
-        message = (
-            f"📖 <b>{story['han_title']}</b>\n"
-            f"<i>({story['rus_title']})</i>\n"
-            f"{story['han_text']}"
-        )
-        parts = await split_long_message(message)
+        # Хантыйское + русское название; части текста подготовлены при загрузке
+        parts = story_texts[(story_id, 'kh')]
         
         # Добавляем сообщение о прогрессе, если это не первое прочтение
         if was_updated:
             progress = db.get_user_progress(callback.from_user.id)
             for tale in progress["recent_tales"]:
                 if tale[0] == story_id:
-                    read_count = tale[2]
-                    message = (
-                        f"📖 <b>{story['han_title']}</b> (прочитано {read_count} раз(а))\n"
-                        f"<i>({story['rus_title']})</i>\n"
-                        f"{story['han_text']}"
-                    )
-                    parts = await split_long_message(message)
+                    parts = with_read_count(parts, f"📖 <b>{story['han_title']}</b>", tale[2])
                     break
         
-        # Отправляем первую часть без кнопок
-        for part in parts[:-1]:
-            await callback.message.answer(part)
-        
-        # Отправляем остальные части
+        # Одно сообщение со страницей текста; дальше листаем его редактированием
+        page = await reading_page(state, story_id, 'kh', len(parts))
         await callback.message.answer(
-            parts[-1],
-            reply_markup=await story_menu_kb(story_id))
+            parts[page],
+            reply_markup=await reader_kb(story_id, 'kh', page, len(parts)))
                 
         await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка в handle_language_kh: {e}")
-        await callback.answer("⚠️ Ошибка при загрузке сказки", show_alert=True)
+        logger.error(f"Ошибка в handle_language_kh: {e}")
+        await callback.answer("⚠️ Ошибка при загрузке сказки", show_alert=True)
+
+@callback_router.route(CALLBACK_READ_PAGE)
+async def handle_read_page(callback: types.CallbackQuery, story_id: int, lang_code: int, page: int,
+                           state: FSMContext):
+    """Листание сказки: редактирует текст текущего сообщения"""
+    try:
+        lang = READER_LANGUAGES[lang_code] if lang_code < len(READER_LANGUAGES) else None
+        parts = story_texts.get((story_id, lang))
+        if not parts or not 0 <= page < len(parts):
+            await callback.answer("⚠️ Страница не найдена", show_alert=True)
+            return
+
+        await state.update_data(read_pos=[story_id, lang, page])
+        try:
+            await callback.message.edit_text(
+                parts[page],
+                reply_markup=await reader_kb(story_id, lang, page, len(parts))
+            )
+        except TelegramBadRequest as e:
+            # Нажатие на номер текущей страницы — текст не меняется
+            if "message is not modified" not in str(e):
+                raise
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка в handle_read_page: {e}")
+        await callback.answer("⚠️ Ошибка при загрузке страницы", show_alert=True)
+
+async def answer_before_audio_prepared(callback: types.CallbackQuery, story: dict) -> bool:
+    """
+    Если озвучку ещё предстоит перекодировать, сразу отвечает на callback и
+    показывает «отправляет аудио»: ffmpeg может работать дольше, чем живёт callback.
+    """
+    if story['id'] in story_audio_cache or not story_audio_source(story) or not FFMPEG_PATH or not FFPROBE_PATH:
+        return False
+    await callback.answer("⏳ Готовлю аудио…")
+    await bot.send_chat_action(chat_id=callback.message.chat.id, action=ChatAction.UPLOAD_VOICE)
+    return True
+
+
+async def report_audio_error(callback: types.CallbackQuery, text: str, answered: bool):
+    """Сообщает об ошибке всплывающим окном или, если callback уже закрыт, сообщением"""
+    if answered:
+        await callback.message.answer(text)
+    else:
+        await callback.answer(text, show_alert=True)
+
 
-@dp.callback_query(F.data.startswith(CALLBACK_PLAY_AUDIO))
-async def handle_play_audio(callback: types.CallbackQuery):
+@callback_router.route(CALLBACK_PLAY_AUDIO)
+async def handle_play_audio(callback: types.CallbackQuery, story_id: int):
     """Обработчик кнопки аудио - отправляет ТОЛЬКО аудио"""
+    answered = False
     try:
-        story_id = int(callback.data.replace(CALLBACK_PLAY_AUDIO, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         if story.get('audio') and story['audio'] != "pass":
             audio_path = Path(__file__).parent / "audio" / story['audio']
             if audio_path.exists():
-                await bot.send_audio(
-                    chat_id=callback.message.chat.id,
-                    audio=types.FSInputFile(audio_path),
-                    title=f"{story['rus_title']} | {story['han_title']}",
-                    performer="Хантыйская сказка",
-                    caption=f"🎧 {story['rus_title']}"
-                )
+                answered = await answer_before_audio_prepared(callback, story)
+                prepared = await prepare_story_audio(story)
+                if prepared:
+                    # Компактная Opus-версия с кнопками фрагментов
+                    await send_cached_voice(
+                        callback.message.chat.id,
+                        prepared['full'],
+                        caption=f"🎧 {story['rus_title']} | {story['han_title']}",
+                        reply_markup=audio_segments_kb(story_id, prepared['segments'])
+                    )
+                else:
+                    await bot.send_audio(
+                        chat_id=callback.message.chat.id,
+                        audio=types.FSInputFile(audio_path),
+                        title=f"{story['rus_title']} | {story['han_title']}",
+                        performer="Хантыйская сказка",
+                        caption=f"🎧 {story['rus_title']}",
+                        thumbnail=await story_audio_thumbnail(story)
+                    )
             else:
                 await callback.answer("⚠️ Аудиофайл не найден", show_alert=True)
         else:
             await callback.answer("⚠️ Для этой сказки нет аудио", show_alert=True)
-        await callback.answer()
+        if not answered:
+            await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_play_audio: {e}")
-        await callback.answer("⚠️ Ошибка при загрузке аудио", show_alert=True)
+        await report_audio_error(callback, "⚠️ Ошибка при загрузке аудио", answered)
+
+
+@callback_router.route(CALLBACK_PLAY_SEGMENT)
+async def handle_play_audio_segment(callback: types.CallbackQuery, story_id: int, segment_idx: int):
+    """Отправляет один фрагмент озвучки вместе с его текстом"""
+    answered = False
+    try:
+        story = next(s for s in tales_data['stories'] if s['id'] == story_id)
+        answered = await answer_before_audio_prepared(callback, story)
+        prepared = await prepare_story_audio(story)
+        if not prepared or segment_idx >= len(prepared['segments']):
+            await report_audio_error(callback, "⚠️ Фрагмент не найден", answered)
+            return
+
+        segment = prepared['segments'][segment_idx]
+        text = html.escape(segment['text'])
+        if len(text) > 900:
+            text = text[:900].rsplit(' ', 1)[0] + "…"
+        await send_cached_voice(
+            callback.message.chat.id,
+            segment['path'],
+            caption=f"🎧 <b>{story['han_title']}</b> — часть {segment_idx + 1}/{len(prepared['segments'])}\n\n{text}"
+        )
+        if not answered:
+            await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка в handle_play_audio_segment: {e}")
+        await report_audio_error(callback, "⚠️ Ошибка при загрузке аудио", answered)
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_SHOW_GRAMMAR))
-async def handle_show_grammar(callback: types.CallbackQuery):
+@callback_router.route(CALLBACK_SHOW_GRAMMAR)
+async def handle_show_grammar(callback: types.CallbackQuery, story_id: int):
     """Показ грамматики для конкретной сказки (с проверкой)"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_SHOW_GRAMMAR, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
 
         # Проверяем наличие грамматики
@@ -1457,25 +3489,24 @@ async def handle_show_grammar(callback: types.CallbackQuery):
             await callback.answer("❌ Для этой сказки нет грамматики", show_alert=True)
             return
 
-        message = f"📝 <b>Грамматика для сказки '{story['rus_title']}':</b>\n{story['grammar']}"
-        parts = await split_long_message(message)
+        parts = story_texts[(story_id, 'grammar')]
         await callback.message.answer(
             parts[0],
             reply_markup=await story_menu_kb(story_id)
         )
-        for part in parts[1:]:
-            await callback.message.answer(part)
+        with send_lane_scope(LANE_BULK):
+            for part in parts[1:]:
+                await callback.message.answer(part)
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_show_grammar: {e}")
         await callback.answer("⚠️ Ошибка при загрузке грамматики", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_SHOW_LEXICON))
-async def handle_show_lexicon(callback: types.CallbackQuery):
+@callback_router.route(CALLBACK_SHOW_LEXICON)
+async def handle_show_lexicon(callback: types.CallbackQuery, story_id: int):
     """Показ лексики для конкретной сказки (с проверкой)"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_SHOW_LEXICON, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
 
         # Проверяем наличие лексики
@@ -1488,29 +3519,24 @@ async def handle_show_lexicon(callback: types.CallbackQuery):
         if len(story['han_words']) != len(story['rus_words']):
             logger.warning(f"Несоответствие количества слов в сказке {story_id}")
 
-        word_pairs = []
-        for han, rus in zip(story['han_words'], story['rus_words']):
-            word_pairs.append(f"• <b>{han}</b> - {rus}")
-
-        message = f"🔤 <b>Лексика для сказки '{story['rus_title']}':</b>\n" + "\n".join(word_pairs)
-        parts = await split_long_message(message)
+        parts = story_texts[(story_id, 'lexicon')]
         await callback.message.answer(
             parts[0],
             reply_markup=await story_menu_kb(story_id)
         )
-        for part in parts[1:]:
-            await callback.message.answer(part)
+        with send_lane_scope(LANE_BULK):
+            for part in parts[1:]:
+                await callback.message.answer(part)
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_show_lexicon: {e}")
         await callback.answer("⚠️ Ошибка при загрузке лексики", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_BACK_TO_LANGUAGE))
-async def handle_back_to_language(callback: types.CallbackQuery):
+@callback_router.route(CALLBACK_BACK_TO_LANGUAGE)
+async def handle_back_to_language(callback: types.CallbackQuery, story_id: int):
     """Возврат к выбору языка"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_BACK_TO_LANGUAGE, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         await callback.message.answer(
             f"📖 <b>{story['rus_title']}</b>\nВыберите язык:",
@@ -1528,25 +3554,27 @@ async def handle_back_to_language(callback: types.CallbackQuery):
 
 
 # --- Обработчики тестов ---
-@dp.callback_query(F.data.startswith("start_test_"))
-async def handle_start_test(callback: types.CallbackQuery, state: FSMContext):
+# Состояние теста в FSM: id сказки, номер вопроса, баллы в половинках
+# (2 — верно с первого раза, 1 — после ошибки) и битовая маска вопросов с ошибками
+@callback_router.route(CALLBACK_START_TEST)
+async def handle_start_test(callback: types.CallbackQuery, tale_id: int, state: FSMContext):
     """Начало теста по сказке"""
     try:
-        tale_id = int(callback.data.replace("start_test_", ""))
-        test = next((t for t in tests_data["tests"] if t["fairytale_id"] == tale_id), None)
+        test = tests_by_tale.get(tale_id)
         if not test or not test["questions"]:
             await callback.answer("Для этой сказки пока нет теста", show_alert=True)
             return
 
-        # Сохраняем текущий тест в состоянии пользователя
-        await state.set_data({
-            "current_test": test,
-            "current_question": 0,
-            "test_score": 0
+        # Сохраняем в состоянии пользователя только ссылку на тест и прогресс
+        await state.update_data({
+            "test_tale": tale_id,
+            "test_q": 0,
+            "test_pts": 0,
+            "test_err": 0
         })
 
         # Отправляем первый вопрос
-        await send_question(callback.message, test["questions"][0], 0, len(test["questions"]))
+        await send_question(callback.message, test["questions"][0])
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_start_test: {e}", exc_info=True)
@@ -1560,35 +3588,32 @@ async def handle_start_test(callback: types.CallbackQuery, state: FSMContext):
 
 
 
-@dp.callback_query(F.data.startswith("test_answer_"))
-async def handle_test_answer(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route(CALLBACK_TEST_ANSWER)
+async def handle_test_answer(callback: types.CallbackQuery, q_id: int, answer_idx: int, state: FSMContext):
     """Обработка ответа на вопрос теста"""
     try:
-        parts = callback.data.split("_")
-        q_id = int(parts[2])
-        answer_idx = int(parts[3])
-        
         # Получаем данные из FSMContext
         user_data = await state.get_data()
-        test = user_data.get("current_test")
-        current_question = user_data.get("current_question", 0)
-        test_score = user_data.get("test_score", 0)
-        answered_with_mistake = user_data.get("answered_with_mistake", set())
+        test = tests_by_tale.get(user_data.get("test_tale"))
+        current_question = user_data.get("test_q", 0)
+        test_points = user_data.get("test_pts", 0)
+        mistakes_mask = user_data.get("test_err", 0)
 
         if not test:
             await callback.answer("Тест не найден", show_alert=True)
             return
 
+        if current_question >= len(test["questions"]):
+            await callback.answer("Тест уже завершён", show_alert=True)
+            return
+
         question = test["questions"][current_question]
-        selected_answer = question["variants"][answer_idx]
-        right_answer = question["right answer"]
+        if question["q_id"] != q_id:
+            await callback.answer("Этот вопрос уже пройден")
+            return
 
-        # Поддержка нескольких правильных ответов (список или строка)
-        if isinstance(right_answer, list):
-            right_answers = [str(ans).strip().lower() for ans in right_answer]
-            is_correct = str(selected_answer).strip().lower() in right_answers
-        else:
-            is_correct = str(selected_answer).strip().lower() == str(right_answer).strip().lower()
+        # Индексы правильных вариантов посчитаны при загрузке каталога
+        is_correct = answer_idx in question["correct"]
 
         # Сохраняем результат в базу данных
         db.save_test_result(
@@ -1598,47 +3623,41 @@ async def handle_test_answer(callback: types.CallbackQuery, state: FSMContext):
             is_correct=is_correct
         )
 
-        explanation = question.get('explanation', 'Объяснение отсутствует.')
+        explanation = question['explanation']
+        question_bit = 1 << current_question
 
         # Если ответ неверный
         if not is_correct:
             # Запоминаем, что была ошибка
-            answered_with_mistake.add(current_question)
-            await state.update_data(answered_with_mistake=answered_with_mistake)
+            await state.update_data(test_err=mistakes_mask | question_bit)
             
             # Показываем алёрт с ошибкой
             await callback.answer(f"❌ Неверно.\nПопробуйте снова.", show_alert=True)
             return
 
         # Если ответ верный
-        if current_question not in answered_with_mistake:
+        if not mistakes_mask & question_bit:
             # Ответ верный с первого раза - засчитываем полный балл
-            test_score += 1
+            test_points += 2
             # Показываем сообщение с пояснением
             await callback.message.answer(f"✅ Верно!\n{explanation}")
         else:
             # Ответ верный, но после ошибки - засчитываем 0.5 балла
-            test_score += 0.5
+            test_points += 1
             # Показываем сообщение с пояснением
             await callback.message.answer(f"✅ Теперь верно.\n{explanation}")
 
         # Обновляем данные пользователя
         await state.update_data({
-            "current_test": test,
-            "current_question": current_question + 1,
-            "test_score": test_score,
-            "answered_with_mistake": set()  # Сбрасываем для нового вопроса
+            "test_q": current_question + 1,
+            "test_pts": test_points
         })
 
         # Переход к следующему вопросу или завершение
         if current_question + 1 < len(test["questions"]):
-            await send_question(
-                callback.message,
-                test["questions"][current_question + 1],
-                current_question + 1,
-                len(test["questions"])
-            )
+            await send_question(callback.message, test["questions"][current_question + 1])
         else:
+            test_score = test_points / 2
             score_percent = int((test_score / len(test["questions"])) * 100)
             tale = next(t for t in tales_data["stories"] if t["id"] == test["fairytale_id"])
             
@@ -1678,26 +3697,12 @@ async def handle_test_answer(callback: types.CallbackQuery, state: FSMContext):
 
 
 # --- Обработчики словаря ---
-@dp.callback_query(F.data == CALLBACK_VOCABULARY)
+@callback_router.route(CALLBACK_VOCABULARY)
 async def handle_vocabulary(callback: types.CallbackQuery):
     """Обработчик раздела словаря"""
     try:
         await callback.message.answer(
-            "📚 Выбери раздел словаря:\n\n"
-            "В <b>📝 Общей грамматике</b> можешь прочитать о грамматических правилах: \n" 
-            " • Сколько чисел в хантыйском и как они образуются,\n "
-            " • Какие есть падежные суффиксы,\n"
-            " • Как ласково сказать белочка или рыбка.\n\n"
-
-            "В <b>🔤 Общей лексике</b> сможешь узнать слова из разных категорий:\n" 
-            " • Еда,\n" 
-            " • Животные,\n"
-            " • Природа и другие.\n\n"
-
-            "В <b>🔡 Алфавите</b> можешь увидеть:\n" 
-            " • Названия букв\n" 
-            " • Гласные звуки\n" 
-            " • Согласные звуки.\n",
+            VOCABULARY_MENU_TEXT,
             reply_markup=await vocabulary_menu_kb()
         )
         await callback.answer()
@@ -1706,33 +3711,48 @@ async def handle_vocabulary(callback: types.CallbackQuery):
         await callback.answer("⚠️ Ошибка при загрузке меню", show_alert=True)
 
 
-@dp.callback_query(F.data == CALLBACK_GRAMMAR)
-async def handle_grammar(callback: types.CallbackQuery):
-    """Показ общей грамматики"""
-    try:
-        grammar_parts = []
-        for story in tales_data['stories']:
-            if story.get('grammar'):
-                grammar_parts.append(f"📝 <b>{story['rus_title']}</b>\n{story['grammar']}\n")
+@registered_keyboard
+async def grammar_page_kb(page: int) -> InlineKeyboardMarkup:
+    """Листание общей грамматики, оглавление и возврат в словарь"""
+    total = len(grammar_digest['pages'])
+    builder = InlineKeyboardBuilder()
+    navigation = 0
+    if page > 0:
+        builder.button(text="◀️", callback_data=pack_callback(CALLBACK_GRAMMAR_PAGE, page - 1))
+        navigation += 1
+    if total > 1:
+        builder.button(text=f"📄 {page + 1}/{total}", callback_data=pack_callback(CALLBACK_GRAMMAR_PAGE, page))
+        navigation += 1
+    if page < total - 1:
+        builder.button(text="▶️", callback_data=pack_callback(CALLBACK_GRAMMAR_PAGE, page + 1))
+        navigation += 1
+    # Оглавление нужно, только если разделы сказок лежат на разных страницах
+    if len({start for _, start in grammar_digest['toc']}) > 1:
+        builder.button(text="📑 Оглавление", callback_data=pack_callback(CALLBACK_GRAMMAR_TOC))
+    builder.button(text="🔙 Назад", callback_data=pack_callback(CALLBACK_BACK_TO_VOCABULARY))
+    builder.adjust(*([navigation] if navigation else []), 1, 1)
+    return builder.as_markup()
 
-        if not grammar_parts:
-            await callback.message.answer("❌ Информация по грамматике не найдена")
-            return
 
-        full_message = "\n".join(grammar_parts)
-        parts = await split_long_message(full_message)
+@registered_keyboard
+async def grammar_toc_kb() -> InlineKeyboardMarkup:
+    """Оглавление общей грамматики: переход к разделу нужной сказки"""
+    buttons = [(title, pack_callback(CALLBACK_GRAMMAR_PAGE, page)) for title, page in grammar_digest['toc']]
+    return build_menu(buttons, ("🔙 Назад", pack_callback(CALLBACK_BACK_TO_VOCABULARY)), columns=1)
 
-        # Редактируем текущее сообщение (вместо удаления)
-        if len(parts) > 0:
-            await callback.message.answer(
-                parts[0],
-                reply_markup=build_menu([], ("🔙 Назад", CALLBACK_BACK_TO_VOCABULARY))
-            )
 
-        # Отправляем остальные части как новые сообщения
-        for part in parts[1:]:
-            await callback.message.answer(part)
+@callback_router.route(CALLBACK_GRAMMAR)
+async def handle_grammar(callback: types.CallbackQuery):
+    """Показ общей грамматики (первая страница заранее собранного свода)"""
+    try:
+        if not grammar_digest['pages']:
+            await callback.message.answer("❌ Информация по грамматике не найдена")
+            return
 
+        await callback.message.answer(
+            grammar_digest['pages'][0],
+            reply_markup=await grammar_page_kb(0)
+        )
         await callback.answer()
     except AiogramError as e:
         logger.error(f"Aiogram ошибка в handle_grammar: {e}")
@@ -1742,6 +3762,41 @@ async def handle_grammar(callback: types.CallbackQuery):
         await callback.answer("⚠️ Произошла внутренняя ошибка", show_alert=True)
 
 
+@callback_router.route(CALLBACK_GRAMMAR_PAGE)
+async def handle_grammar_page(callback: types.CallbackQuery, page: int):
+    """Листание общей грамматики редактированием текущего сообщения"""
+    try:
+        if not 0 <= page < len(grammar_digest['pages']):
+            await callback.answer("⚠️ Страница не найдена", show_alert=True)
+            return
+        try:
+            await callback.message.edit_text(
+                grammar_digest['pages'][page],
+                reply_markup=await grammar_page_kb(page)
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка в handle_grammar_page: {e}")
+        await callback.answer("⚠️ Ошибка при отображении грамматики", show_alert=True)
+
+
+@callback_router.route(CALLBACK_GRAMMAR_TOC)
+async def handle_grammar_toc(callback: types.CallbackQuery):
+    """Оглавление общей грамматики"""
+    try:
+        await callback.message.edit_text(
+            "📑 <b>Общая грамматика</b>\nВыбери сказку:",
+            reply_markup=await grammar_toc_kb()
+        )
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка в handle_grammar_toc: {e}")
+        await callback.answer("⚠️ Ошибка при отображении грамматики", show_alert=True)
+
+
 
 
 
@@ -1755,83 +3810,119 @@ async def handle_grammar(callback: types.CallbackQuery):
 
 
 
-async def lexicon_menu_kb(all_themes: list, page: int, page_size: int = 8) -> InlineKeyboardMarkup:
+async def lexicon_menu_kb(all_themes: list, page: int, page_size: int = LEXICON_PAGE_SIZE) -> InlineKeyboardMarkup:
     """Клавиатура для меню лексики с пагинацией"""
+    # Темы приходят из FSM списком, поэтому ключ реестра собирается вручную
+    key = ('lexicon', *all_themes, page, page_size)
+    return registry_keyboard(key) or register_keyboard(key, build_lexicon_menu(all_themes, page, page_size))
+
+
+def build_lexicon_menu(all_themes: list, page: int, page_size: int) -> InlineKeyboardMarkup:
+    """Строит страницу меню лексики"""
     start_idx = page * page_size
     end_idx = start_idx + page_size
     page_themes = all_themes[start_idx:end_idx]
     
+    # Тема передаётся номером в списке тем, страница — чтобы вернуться на неё
     buttons = []
-    for theme in page_themes:
-        buttons.append((theme, f"lexicon_theme_{theme}_{page}"))  # Добавляем номер страницы
+    for theme_idx, theme in enumerate(page_themes, start_idx):
+        buttons.append((theme, pack_callback(CALLBACK_LEXICON_THEME, theme_idx, page)))
     
     navigation_buttons = []
     total_pages = (len(all_themes) + page_size - 1) // page_size
     
     if page > 0:
-        navigation_buttons.append(("◀️ Назад", f"lexicon_page_{page-1}"))
+        navigation_buttons.append(("◀️ Назад", pack_callback(CALLBACK_LEXICON_PAGE, page - 1)))
     if end_idx < len(all_themes):
-        navigation_buttons.append(("Вперёд ▶️", f"lexicon_page_{page+1}"))
+        navigation_buttons.append(("Вперёд ▶️", pack_callback(CALLBACK_LEXICON_PAGE, page + 1)))
     
     return build_menu(
         buttons,
-        back_button=("🔙 Назад в словарь", CALLBACK_BACK_TO_VOCABULARY),
+        back_button=("🔙 Назад в словарь", pack_callback(CALLBACK_BACK_TO_VOCABULARY)),
         additional_buttons=navigation_buttons,
         columns=2
     )
 
-@dp.callback_query(F.data == CALLBACK_LEXICON)
-async def handle_lexicon_first(callback: types.CallbackQuery, state: FSMContext):
-    """Первый вход в меню лексики — создает новое сообщение"""
-    try:
-        themes_dict = defaultdict(list)
-        has_lexicon = False
-        stats = {'manual': 0, 'neural': 0}
+# Сколько первый вход в лексику ждёт моделей тем, пока они грузятся в фоне, с
+LEXICON_MODELS_WAIT = float(os.getenv("LEXICON_MODELS_WAIT", "3"))
 
 
-        for story in tales_data['stories']:
-            if (story.get('han_words') and story.get('rus_words') and
-                    len(story['han_words']) > 0 and len(story['rus_words']) > 0):
-                has_lexicon = True
-                min_length = min(len(story['han_words']), len(story['rus_words']))
-                for i in range(min_length):
-                    han_word = story['han_words'][i].strip()
-                    rus_word = story['rus_words'][i].strip()
-                    
-                    rus_lower = rus_word.lower().strip()
-                    if rus_lower in manual_dictionary:
-                        stats['manual'] += 1
-                    else:
-                        stats['neural'] += 1
-                    
-                    # Используем predict_themes, который возвращает список тем
-                    themes = hybrid_classifier.predict_themes(rus_word)
-                    for theme in themes:
-                        themes_dict[theme].append((han_word, rus_word))
+def build_lexicon_themes() -> Tuple[Dict[str, list], List[str], Dict[str, int]]:
+    """Слова всех сказок по темам, темы по убыванию числа слов и источники тем"""
+    themes_dict = defaultdict(list)
+    stats = {'manual': 0, 'neural': 0}
+    for story in tales_data['stories']:
+        if (story.get('han_words') and story.get('rus_words') and
+                len(story['han_words']) > 0 and len(story['rus_words']) > 0):
+            min_length = min(len(story['han_words']), len(story['rus_words']))
+            for i in range(min_length):
+                han_word = story['han_words'][i].strip()
+                rus_word = story['rus_words'][i].strip()
+
+                rus_lower = rus_word.lower().strip()
+                if rus_lower in manual_dictionary:
+                    stats['manual'] += 1
+                else:
+                    stats['neural'] += 1
 
-        if not has_lexicon:
-            await callback.answer("❌ В словаре нет доступной лексики", show_alert=True)
-            return
+                # Используем predict_themes, который возвращает список тем
+                themes = hybrid_classifier.predict_themes(rus_word)
+                for theme in themes:
+                    themes_dict[theme].append((han_word, rus_word))
 
+    sorted_themes = sorted(themes_dict.keys(),
+                           key=lambda x: len(themes_dict[x]),
+                           reverse=True)
+    return dict(themes_dict), sorted_themes, stats
 
-        print(f"Классификация: {stats['manual']} слов из ручного словаря, {stats['neural']} слов нейросетью")
+
+async def store_lexicon(state: FSMContext, themes_dict: dict, all_themes: list, **extra):
+    """
+    Сохраняет темы в FSM с версией моделей. Темы заглушки не сохраняются:
+    пока моделей нет, они строятся при каждом обращении.
+    """
+    update = {'lexicon_models_version': theme_models_version, **extra}
+    if theme_models_version:
+        update.update(themes_dict=themes_dict, all_themes=all_themes)
+    await state.update_data(update)
 
 
-        sorted_themes = sorted(themes_dict.keys(),
-                               key=lambda x: len(themes_dict[x]),
-                               reverse=True)
+async def lexicon_data(state: FSMContext) -> Tuple[dict, bool]:
+    """
+    Данные FSM с актуальными темами лексики. Второе значение — True, если
+    пользователь видит меню, построенное прежней версией моделей.
+    """
+    data = await state.get_data()
+    if 'themes_dict' in data and data.get('lexicon_models_version') == theme_models_version:
+        return data, False
+    themes_dict, all_themes, _ = build_lexicon_themes()
+    changed = data.get('lexicon_models_version') not in (None, theme_models_version)
+    await store_lexicon(state, themes_dict, all_themes)
+    return {**data, 'themes_dict': themes_dict, 'all_themes': all_themes}, changed
 
 
-        await state.update_data({
-            'themes_dict': dict(themes_dict),
-            'all_themes': sorted_themes,
-            'lexicon_page': 0
-        })
+@callback_router.route(CALLBACK_LEXICON)
+async def handle_lexicon_first(callback: types.CallbackQuery, state: FSMContext):
+    """Первый вход в меню лексики — создает новое сообщение"""
+    try:
+        if not theme_models_version:
+            # До загрузки моделей темы определяет заглушка: поднимаем модели
+            # в очереди прогрева и недолго ждём их
+            warmup.promote("models", "themes")
+            await warmup.wait("models", "themes", LEXICON_MODELS_WAIT)
+
+        themes_dict, sorted_themes, stats = build_lexicon_themes()
+        if not themes_dict:
+            await callback.answer("❌ В словаре нет доступной лексики", show_alert=True)
+            return
 
+        hot_logger.debug("Классификация лексики", extra=stats)
+
+        await store_lexicon(state, themes_dict, sorted_themes, lexicon_page=0)
 
         # Отправляем первое сообщение
         message = await callback.message.answer(
-            "📚 Выбери тематику словаря. Воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:",
+            LEXICON_MENU_TEXT,
             reply_markup=await lexicon_menu_kb(sorted_themes, 0)
         )
         # Сохраняем message_id, чтобы потом редактировать
@@ -1843,23 +3934,23 @@ async def handle_lexicon_first(callback: types.CallbackQuery, state: FSMContext)
         await callback.answer("⚠️ Ошибка при загрузке словаря", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith("lexicon_theme_"))
-async def handle_lexicon_theme(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route(CALLBACK_LEXICON_THEME)
+async def handle_lexicon_theme(callback: types.CallbackQuery, theme_idx: int, page: int, state: FSMContext):
     """Показывает слова по выбранной теме в НОВОМ сообщении"""
     try:
-        parts = callback.data.split('_', 2)
-        theme_and_page = parts[2]
-        theme_parts = theme_and_page.rsplit('_', 1)
-        
-        if len(theme_parts) == 2:
-            theme = theme_parts[0]
-            page = int(theme_parts[1])
-        else:
-            theme = theme_and_page
-            page = 0
-        
-        data = await state.get_data()
-        themes_dict = data.get('themes_dict', {})
+        data, changed = await lexicon_data(state)
+        themes_dict = data['themes_dict']
+        all_themes = data['all_themes']
+        if changed:
+            # Меню построено прежними темами: номер темы мог указывать на другую
+            message = await callback.message.answer(
+                LEXICON_MENU_TEXT,
+                reply_markup=await lexicon_menu_kb(all_themes, 0)
+            )
+            await state.update_data({'lexicon_message_id': message.message_id, 'lexicon_page': 0})
+            await callback.answer("🔄 Темы обновились, выбери тему ещё раз")
+            return
+        theme = all_themes[theme_idx] if theme_idx < len(all_themes) else None
         
         if theme not in themes_dict:
             await callback.answer("Тема не найдена", show_alert=True)
@@ -1871,7 +3962,7 @@ async def handle_lexicon_theme(callback: types.CallbackQuery, state: FSMContext)
         message_text = f"📚 <b>{theme}</b> ({len(words)} слов/а)\n\n{word_list}"
 
         builder = InlineKeyboardBuilder()
-        builder.button(text="🔙 Назад к темам", callback_data=f"lexicon_return_to_page_{page}")
+        builder.button(text="🔙 Назад к темам", callback_data=pack_callback(CALLBACK_LEXICON_RETURN, page))
         builder.adjust(1)
         
         
@@ -1890,14 +3981,16 @@ async def handle_lexicon_theme(callback: types.CallbackQuery, state: FSMContext)
         logger.error(f"Ошибка в handle_lexicon_theme: {e}", exc_info=True)
         await callback.answer("⚠️ Ошибка при загрузке темы", show_alert=True)
 
-@dp.callback_query(F.data.startswith("lexicon_page_"))
-async def handle_lexicon_pagination(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route(CALLBACK_LEXICON_PAGE)
+async def handle_lexicon_pagination(callback: types.CallbackQuery, page: int, state: FSMContext):
     """Обработчик пагинации в меню лексики — редактирует существующее сообщение"""
     try:
-        page = int(callback.data.replace("lexicon_page_", ""))
-        data = await state.get_data()
-        all_themes = data.get('all_themes', [])
+        data, _ = await lexicon_data(state)
+        all_themes = data['all_themes']
         message_id = data.get('lexicon_message_id')
+        if not 0 <= page < page_count(len(all_themes), LEXICON_PAGE_SIZE):
+            await callback.answer("⚠️ Страница не найдена", show_alert=True)
+            return
         
         await state.update_data({'lexicon_page': page})
 
@@ -1905,7 +3998,7 @@ async def handle_lexicon_pagination(callback: types.CallbackQuery, state: FSMCon
         await callback.bot.edit_message_text(
             chat_id=callback.message.chat.id,
             message_id=message_id,
-            text="📚 Выбери тематику словаря. Воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:",
+            text=LEXICON_MENU_TEXT,
             reply_markup=await lexicon_menu_kb(all_themes, page)
         )
         await callback.answer()
@@ -1919,20 +4012,22 @@ async def handle_lexicon_pagination(callback: types.CallbackQuery, state: FSMCon
 
 
 
-@dp.callback_query(F.data.startswith("lexicon_return_to_page_"))
-async def handle_lexicon_return_to_themes(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route(CALLBACK_LEXICON_RETURN)
+async def handle_lexicon_return_to_themes(callback: types.CallbackQuery, page: int, state: FSMContext):
     """Возвращает к списку тем, создавая новое сообщение"""
     try:
-        page = int(callback.data.replace("lexicon_return_to_page_", ""))
-        data = await state.get_data()
-        all_themes = data.get('all_themes', [])
+        data, _ = await lexicon_data(state)
+        all_themes = data['all_themes']
+        if not 0 <= page < page_count(len(all_themes), LEXICON_PAGE_SIZE):
+            await callback.answer("⚠️ Страница не найдена", show_alert=True)
+            return
         
         # Обновляем страницу в состоянии
         await state.update_data({'lexicon_page': page})
         
         # Создаем НОВОЕ сообщение с темами
         message = await callback.message.answer(
-            "📚 Выбери тематику словаря. Воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:",
+            LEXICON_MENU_TEXT,
             reply_markup=await lexicon_menu_kb(all_themes, page)
         )
         
@@ -1962,8 +4057,10 @@ async def handle_lexicon_return_to_themes(callback: types.CallbackQuery, state:
 # --- Обработчики алфавита ---
 VOWELS = {'А', 'Ӑ', 'И', 'Й', 'О', 'Ө', 'У', 'Ў', 'Ы', 'Э', 'Є', 'Ә'}
 
-@dp.callback_query(F.data == CALLBACK_ALPHABET)
+@callback_router.route(CALLBACK_ALPHABET)
 async def handle_alphabet(callback: types.CallbackQuery):
+    # Пользователь идёт к буквам — их картинки и аудио читаются вне очереди
+    warmup.promote_many("alphabet", range(len(alphabet_data)))
     try:
         await callback.message.answer(
             "🔤 Выбери раздел хантыйского алфавита:\n\n"
@@ -1974,31 +4071,29 @@ async def handle_alphabet(callback: types.CallbackQuery):
     except Exception as e:
         await callback.answer("⚠️ Ошибка при загрузке меню", show_alert=True)
 
+@registered_keyboard
 async def alphabet_menu_kb() -> InlineKeyboardMarkup:
     buttons = [
-        ("🔠 Все буквы", CALLBACK_ALPHABET_LETTERS_LIST),
-        ("🔡 Гласные", CALLBACK_ALPHABET_VOWELS),
-        ("🔣 Согласные", CALLBACK_ALPHABET_CONSONANTS)
+        ("🔠 Все буквы", pack_callback(CALLBACK_ALPHABET_LETTERS_LIST)),
+        ("🔡 Гласные", pack_callback(CALLBACK_ALPHABET_VOWELS)),
+        ("🔣 Согласные", pack_callback(CALLBACK_ALPHABET_CONSONANTS))
     ]
-    return build_menu(buttons, ("🔙 Назад", CALLBACK_BACK_TO_VOCABULARY), columns=1)
+    return build_menu(buttons, ("🔙 Назад", pack_callback(CALLBACK_BACK_TO_VOCABULARY)), columns=1)
 
-@dp.callback_query(F.data == CALLBACK_ALPHABET_LETTERS_LIST)
+@callback_router.route(CALLBACK_ALPHABET_LETTERS_LIST)
 async def handle_alphabet_letters_list(callback: types.CallbackQuery):
     try:
-        with open('alphabet.json', 'r', encoding='utf-8') as f:
-            alphabet_data = json.load(f)
-        
         buttons = []
-        for letter in alphabet_data:
+        for letter_idx, letter in enumerate(alphabet_data):
             letter_char = Path(letter['photo']).stem
-            callback_data = f"{CALLBACK_ALPHABET_LETTER_DETAIL}{letter['name']}"
+            callback_data = pack_callback(CALLBACK_ALPHABET_LETTER_DETAIL, letter_idx)
             buttons.append((letter_char, callback_data))
         
         await callback.message.answer(
             "Все буквы алфавита:",
             reply_markup=build_menu(
                 buttons,
-                back_button=("🔙 Назад", CALLBACK_ALPHABET),
+                back_button=("🔙 Назад", pack_callback(CALLBACK_ALPHABET)),
                 columns=4
             )
         )
@@ -2006,66 +4101,84 @@ async def handle_alphabet_letters_list(callback: types.CallbackQuery):
     except Exception as e:
         await callback.answer("⚠️ Ошибка при загрузке списка букв", show_alert=True)
 
-@dp.callback_query(F.data.startswith(CALLBACK_ALPHABET_LETTER_DETAIL))
-async def handle_letter_detail(callback: types.CallbackQuery):
+# Предзагруженные файлы алфавита (путь -> байты) и их file_id в Telegram
+alphabet_media_cache: Dict[str, bytes] = {}
+alphabet_file_ids: Dict[str, str] = {}
+
+
+def alphabet_media(path: str) -> Optional[Union[str, types.InputFile]]:
+    """file_id, если файл уже загружен в Telegram, иначе файл из кэша или с диска"""
+    if path in alphabet_file_ids:
+        return alphabet_file_ids[path]
+    if path in alphabet_media_cache:
+        return types.BufferedInputFile(alphabet_media_cache[path], filename=Path(path).name)
+    full_path = Path(__file__).parent / path
+    if full_path.exists():
+        return types.FSInputFile(full_path)
+    return None
+
+
+@callback_router.route(CALLBACK_ALPHABET_LETTER_DETAIL)
+async def handle_letter_detail(callback: types.CallbackQuery, letter_idx: int):
     try:
-        letter_name = callback.data.replace(CALLBACK_ALPHABET_LETTER_DETAIL, "")
-        
-        with open('alphabet.json', 'r', encoding='utf-8') as f:
-            alphabet_data = json.load(f)
-        
-        letter = next((item for item in alphabet_data if item['name'] == letter_name), None)
+        letter = alphabet_data[letter_idx] if letter_idx < len(alphabet_data) else None
         
         if not letter:
             await callback.answer("❌ Буква не найдена", show_alert=True)
             return
         
-        # Отправляем фото буквы
-        photo_path = Path(__file__).parent / letter['photo']
-        if photo_path.exists():
-            photo = types.FSInputFile(photo_path)
-            await callback.message.answer_photo(
-                photo,
-                caption=f"{letter['name']}\n\nНажми на аудио ниже, чтобы прослушать произношение"
-            )
-        else:
-            await callback.message.answer(f"⚠️ Изображение для {letter['name']} не найдено")
-        
-        # Отправляем аудио с произношением
-        audio_path = Path(__file__).parent / letter['sound']
-        if audio_path.exists():
-            audio = types.FSInputFile(audio_path)
-            await callback.message.answer_audio(audio)
-        else:
-            await callback.message.answer(f"⚠️ Аудио для {letter['name']} не найдено")
-        
         # Определяем откуда пришли
         letter_char = Path(letter['photo']).stem.upper()
-        back_callback = CALLBACK_ALPHABET_LETTERS_LIST
+        back_callback = pack_callback(CALLBACK_ALPHABET_LETTERS_LIST)
         if letter_char in VOWELS:
-            back_callback = CALLBACK_ALPHABET_VOWELS
+            back_callback = pack_callback(CALLBACK_ALPHABET_VOWELS)
         else:
-            back_callback = CALLBACK_ALPHABET_CONSONANTS
-        
-        await callback.message.answer(
-            "Выбери действие:",
-            reply_markup=build_menu([], (("🔙 Назад", back_callback)))
-        )
+            back_callback = pack_callback(CALLBACK_ALPHABET_CONSONANTS)
+        back_kb = build_menu([], (("🔙 Назад", back_callback)))
+
+        # Фото с подписью и кнопкой в одном сообщении
+        photo = alphabet_media(letter['photo'])
+        if photo:
+            photo_request = callback.message.answer_photo(
+                photo,
+                caption=f"{letter['name']}\n\nНажми на аудио, чтобы прослушать произношение",
+                reply_markup=back_kb
+            )
+        else:
+            photo_request = callback.message.answer(
+                f"⚠️ Изображение для {letter['name']} не найдено",
+                reply_markup=back_kb
+            )
+
+        # Аудио с произношением отправляем одновременно с фото
+        audio = alphabet_media(letter['sound'])
+        if audio:
+            audio_request = callback.message.answer_audio(audio)
+        else:
+            audio_request = callback.message.answer(f"⚠️ Аудио для {letter['name']} не найдено")
+
+        photo_sent, audio_sent = await asyncio.gather(photo_request, audio_request, return_exceptions=True)
+        # file_id запоминаем для каждой успешной отправки, даже если вторая не удалась
+        if isinstance(photo_sent, Message) and photo_sent.photo:
+            alphabet_file_ids[letter['photo']] = photo_sent.photo[-1].file_id
+        if isinstance(audio_sent, Message) and audio_sent.audio:
+            alphabet_file_ids[letter['sound']] = audio_sent.audio.file_id
+        for sent in (photo_sent, audio_sent):
+            if isinstance(sent, Exception):
+                raise sent
+
         await callback.answer()
     except Exception as e:
         await callback.answer("⚠️ Ошибка при загрузке информации о букве", show_alert=True)
 
-@dp.callback_query(F.data == CALLBACK_ALPHABET_VOWELS)
+@callback_router.route(CALLBACK_ALPHABET_VOWELS)
 async def handle_alphabet_vowels(callback: types.CallbackQuery):
     try:
-        with open('alphabet.json', 'r', encoding='utf-8') as f:
-            alphabet_data = json.load(f)
-        
         buttons = []
-        for letter in alphabet_data:
+        for letter_idx, letter in enumerate(alphabet_data):
             letter_char = Path(letter['photo']).stem.upper()
             if letter_char in VOWELS:
-                callback_data = f"{CALLBACK_ALPHABET_LETTER_DETAIL}{letter['name']}"
+                callback_data = pack_callback(CALLBACK_ALPHABET_LETTER_DETAIL, letter_idx)
                 buttons.append((letter_char, callback_data))
         
         # Сортируем по порядку гласных
@@ -2078,8 +4191,8 @@ async def handle_alphabet_vowels(callback: types.CallbackQuery):
             "⬅️ Чтобы вернуться к меню алфавита, используй кнопку «🔙 Назад».",
             reply_markup=build_menu(
                 buttons,
-                additional_buttons=[("📝 Описание гласных", CALLBACK_VOWELS_DESCRIPTION)],
-                back_button=("🔙 Назад", CALLBACK_ALPHABET),
+                additional_buttons=[("📝 Описание гласных", pack_callback(CALLBACK_VOWELS_DESCRIPTION))],
+                back_button=("🔙 Назад", pack_callback(CALLBACK_ALPHABET)),
                 columns=4
             )
         )
@@ -2087,17 +4200,14 @@ async def handle_alphabet_vowels(callback: types.CallbackQuery):
     except Exception as e:
         await callback.answer("⚠️ Ошибка при загрузке гласных букв", show_alert=True)
 
-@dp.callback_query(F.data == CALLBACK_ALPHABET_CONSONANTS)
+@callback_router.route(CALLBACK_ALPHABET_CONSONANTS)
 async def handle_alphabet_consonants(callback: types.CallbackQuery):
     try:
-        with open('alphabet.json', 'r', encoding='utf-8') as f:
-            alphabet_data = json.load(f)
-        
         buttons = []
-        for letter in alphabet_data:
+        for letter_idx, letter in enumerate(alphabet_data):
             letter_char = Path(letter['photo']).stem.upper()
             if letter_char not in VOWELS:
-                callback_data = f"{CALLBACK_ALPHABET_LETTER_DETAIL}{letter['name']}"
+                callback_data = pack_callback(CALLBACK_ALPHABET_LETTER_DETAIL, letter_idx)
                 buttons.append((letter_char, callback_data))
         
         await callback.message.answer(
@@ -2107,8 +4217,8 @@ async def handle_alphabet_consonants(callback: types.CallbackQuery):
             "⬅️ Чтобы вернуться к меню алфавита, используй кнопку «🔙 Назад».",
             reply_markup=build_menu(
                 buttons,
-                additional_buttons=[("📝 Описание согласных", CALLBACK_CONSONANTS_DESCRIPTION)],
-                back_button=("🔙 Назад", CALLBACK_ALPHABET),
+                additional_buttons=[("📝 Описание согласных", pack_callback(CALLBACK_CONSONANTS_DESCRIPTION))],
+                back_button=("🔙 Назад", pack_callback(CALLBACK_ALPHABET)),
                 columns=4
             )
         )
@@ -2116,7 +4226,7 @@ async def handle_alphabet_consonants(callback: types.CallbackQuery):
     except Exception as e:
         await callback.answer("⚠️ Ошибка при загрузке согласных букв", show_alert=True)
 
-@dp.callback_query(F.data == CALLBACK_VOWELS_DESCRIPTION)
+@callback_router.route(CALLBACK_VOWELS_DESCRIPTION)
 async def handle_vowels_description(callback: types.CallbackQuery):
     try:
         with open('phonetics.json', 'r', encoding='utf-8') as f:
@@ -2124,13 +4234,13 @@ async def handle_vowels_description(callback: types.CallbackQuery):
         
         await callback.message.answer(
             data["гласные"],
-            reply_markup=build_menu([], ("🔙 Назад", CALLBACK_ALPHABET_VOWELS))
+            reply_markup=build_menu([], ("🔙 Назад", pack_callback(CALLBACK_ALPHABET_VOWELS)))
         )
         await callback.answer()
     except Exception as e:
         await callback.answer("⚠️ Ошибка при загрузке описания", show_alert=True)
 
-@dp.callback_query(F.data == CALLBACK_CONSONANTS_DESCRIPTION)
+@callback_router.route(CALLBACK_CONSONANTS_DESCRIPTION)
 async def handle_consonants_description(callback: types.CallbackQuery):
     try:
         with open('phonetics.json', 'r', encoding='utf-8') as f:
@@ -2138,7 +4248,7 @@ async def handle_consonants_description(callback: types.CallbackQuery):
         
         await callback.message.answer(
             data["согласные"],
-            reply_markup=build_menu([], ("🔙 Назад", CALLBACK_ALPHABET_CONSONANTS))
+            reply_markup=build_menu([], ("🔙 Назад", pack_callback(CALLBACK_ALPHABET_CONSONANTS)))
         )
         await callback.answer()
     except Exception as e:
@@ -2161,92 +4271,309 @@ async def handle_consonants_description(callback: types.CallbackQuery):
 
 
 
+# --- Подготовка аудио (Opus/OGG) ---
+AUDIO_DIR = Path(__file__).parent / "audio"
+AUDIO_CACHE_DIR = Path(__file__).parent / "cache" / "audio"
+FFMPEG_PATH = os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg")
+FFPROBE_PATH = os.getenv("FFPROBE_PATH") or shutil.which("ffprobe")
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "32k")
+# Примерная длина фрагмента озвучки в символах han_text (0 — без фрагментов).
+# Разметки времени нет: границы оцениваются по доле символов и могут резать слова,
+# поэтому фрагменты включаются только явно
+AUDIO_SEGMENT_CHARS = int(os.getenv("AUDIO_SEGMENT_CHARS", "0"))
+
+# Подготовленная озвучка по id сказки: {"full": путь, "segments": [...]}
+story_audio_cache: Dict[int, dict] = {}
+# file_id уже загруженных в Telegram голосовых сообщений
+audio_file_ids: Dict[str, str] = {}
+# Блокировки, чтобы одна сказка не перекодировалась дважды одновременно
+audio_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def story_audio_source(story: dict) -> Optional[Path]:
+    """Путь к исходному MP3 сказки, если он есть"""
+    if not story.get('audio') or story['audio'] == "pass":
+        return None
+    audio_path = AUDIO_DIR / story['audio']
+    return audio_path if audio_path.exists() else None
+
+
+async def run_audio_tool(*args: str) -> bytes:
+    """Запускает ffmpeg/ffprobe и возвращает stdout"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', errors='replace').strip())
+    return stdout
+
+
+async def probe_audio_duration(audio_path: Path) -> float:
+    """Длительность аудиофайла в секундах"""
+    output = await run_audio_tool(
+        FFPROBE_PATH, "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(audio_path)
+    )
+    return float(output.decode().strip())
+
+
+async def encode_opus(source: Path, target: Path, start: Optional[float] = None, duration: Optional[float] = None):
+    """Кодирует MP3 (или его фрагмент) в моно Opus/OGG"""
+    tmp_path = target.with_suffix(".tmp.ogg")
+    args = [FFMPEG_PATH, "-y", "-v", "error"]
+    if start is not None:
+        args += ["-ss", f"{start:.2f}"]
+    args += ["-i", str(source)]
+    if duration is not None:
+        args += ["-t", f"{duration:.2f}"]
+    args += ["-vn", "-ac", "1", "-c:a", "libopus", "-b:a", AUDIO_BITRATE, "-application", "voip", str(tmp_path)]
+    await run_audio_tool(*args)
+    tmp_path.replace(target)
+
+
+def split_text_segments(text: str, max_chars: int) -> List[str]:
+    """Разбивает текст на фрагменты из целых строк длиной около max_chars"""
+    segments = []
+    current = []
+    current_len = 0
+    for line in text.strip().splitlines():
+        if current and current_len + len(line) > max_chars:
+            segments.append("\n".join(current))
+            current = []
+            current_len = 0
+        current.append(line)
+        current_len += len(line) + 1
+    if current:
+        segments.append("\n".join(current))
+    return segments
+
+
+async def prepare_story_audio(story: dict) -> Optional[dict]:
+    """
+    Перекодирует озвучку сказки в Opus/OGG и, если задан AUDIO_SEGMENT_CHARS,
+    режет её на фрагменты по han_text.
+    Результат хранится на диске в cache/audio и переиспользуется между запусками.
+    """
+    if story['id'] in story_audio_cache:
+        return story_audio_cache[story['id']]
+
+    source = story_audio_source(story)
+    if not source or not FFMPEG_PATH or not FFPROBE_PATH:
+        return None
+
+    async with audio_locks[story['id']]:
+        if story['id'] in story_audio_cache:
+            return story_audio_cache[story['id']]
+
+        AUDIO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        index_path = AUDIO_CACHE_DIR / f"{story['id']}.json"
+        source_mtime = source.stat().st_mtime
+
+        # Пробуем взять готовый результат с диска
+        if index_path.exists():
+            try:
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                files = [index['full']] + [seg['path'] for seg in index['segments']]
+                if (index.get('source_mtime') == source_mtime and index.get('bitrate') == AUDIO_BITRATE
+                        and index.get('segment_chars') == AUDIO_SEGMENT_CHARS
+                        and all(Path(p).exists() for p in files)):
+                    story_audio_cache[story['id']] = index
+                    return index
+            except Exception as e:
+                logger.warning(f"Повреждён индекс аудио {index_path.name}: {e}")
+
+        full_path = AUDIO_CACHE_DIR / f"{story['id']}.ogg"
+        await encode_opus(source, full_path)
+
+        # Время фрагментов оценивается пропорционально длине текста
+        segments = []
+        texts = split_text_segments(story.get('han_text', ''), AUDIO_SEGMENT_CHARS) if AUDIO_SEGMENT_CHARS > 0 else []
+        if len(texts) > 1:
+            duration = await probe_audio_duration(source)
+            total_chars = sum(len(t) for t in texts)
+            start = 0.0
+            for i, text in enumerate(texts):
+                length = duration * len(text) / total_chars
+                segment_path = AUDIO_CACHE_DIR / f"{story['id']}_{i}.ogg"
+                await encode_opus(source, segment_path, start=start, duration=length)
+                segments.append({
+                    "path": str(segment_path),
+                    "start": round(start, 2),
+                    "end": round(start + length, 2),
+                    "text": text
+                })
+                start += length
+
+        index = {
+            "full": str(full_path),
+            "segments": segments,
+            "source_mtime": source_mtime,
+            "bitrate": AUDIO_BITRATE,
+            "segment_chars": AUDIO_SEGMENT_CHARS
+        }
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+
+        story_audio_cache[story['id']] = index
+        return index
+
+
+async def send_cached_voice(chat_id: int, voice_path: str, caption: str,
+                            reply_markup: Optional[InlineKeyboardMarkup] = None) -> Message:
+    """Отправляет голосовое сообщение, используя file_id после первой загрузки"""
+    file_id = audio_file_ids.get(voice_path)
+    sent = await bot.send_voice(
+        chat_id=chat_id,
+        voice=file_id or types.FSInputFile(voice_path),
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    if sent.voice:
+        audio_file_ids[voice_path] = sent.voice.file_id
+    return sent
+
+
+def audio_segments_kb(story_id: int, segments: List[dict]) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки для прослушивания отдельных фрагментов сказки"""
+    if len(segments) < 2:
+        return None
+    buttons = [(f"▶️ Часть {i + 1}", pack_callback(CALLBACK_PLAY_SEGMENT, story_id, i)) for i in range(len(segments))]
+    return build_menu(buttons, columns=4)
+
+
 # Включаем возможность загрузки усечённых изображений (временное решение)
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-# Глобальный кэш изображений
-image_cache: Dict[str, bytes] = {}
+# Глобальный кэш изображений: (путь, вариант, формат) -> байты
+image_cache: Dict[Tuple[str, str, str], bytes] = {}
 
+# Кэш списков иллюстраций по id сказки
+story_images_cache: Dict[int, List[Path]] = {}
 
+# file_id уже загруженных в Telegram иллюстраций (повторная отправка без загрузки файла)
+illustration_file_ids: Dict[str, str] = {}
 
-async def compress_image(image_path: Path, quality=75) -> bytes:
-    """Сжимает изображение с проверкой целостности и более агрессивной оптимизацией"""
+# Варианты размеров иллюстраций: имя -> (максимальная сторона, качество)
+IMAGE_VARIANTS: Dict[str, Tuple[int, int]] = {
+    "thumb": (320, 70),    # превью и обложки аудио (Telegram требует не больше 320px)
+    "medium": (800, 75),   # альбомы и медленные соединения
+    "full": (1280, 75),    # просмотр иллюстрации
+}
+# Формат вариантов по умолчанию (ILLUSTRATION_WEBP=1 включает WebP)
+IMAGE_FORMAT = "WEBP" if os.getenv("ILLUSTRATION_WEBP", "0") == "1" else "JPEG"
+
+# Пул потоков для сжатия изображений, чтобы не блокировать цикл событий
+image_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IMAGE_WORKERS", "2")),
+    thread_name_prefix="image"
+)
+# Незавершённые задачи сжатия (чтобы один вариант не считался дважды)
+image_variant_tasks: Dict[Tuple[str, str, str], asyncio.Future] = {}
+
+
+def pick_image_variant(max_side: int) -> str:
+    """Выбирает наименьший вариант, который не меньше нужного размера"""
+    for name, (size, _) in sorted(IMAGE_VARIANTS.items(), key=lambda item: item[1][0]):
+        if size >= max_side:
+            return name
+    return "full"
+
+
+def render_image_variant(image_path: Path, max_size: int, quality: int, image_format: str = "JPEG") -> bytes:
+    """Сжимает изображение до заданного размера (выполняется в пуле потоков)"""
     try:
         with Image.open(image_path) as img:
             # Быстрая проверка целостности
             img.verify()
             
         with Image.open(image_path) as img:
+            # Для JPEG декодируем сразу в уменьшенном масштабе
+            if img.format == "JPEG":
+                img.draft("RGB", (max_size, max_size))
+
             # Конвертируем в RGB и уменьшаем размер
             img = img.convert("RGB")
             
-            # Определяем оптимальный размер для Telegram (до 1280px по большей стороне)
-            max_size = 1280
             if max(img.size) > max_size:
                 img.thumbnail((max_size, max_size), Image.LANCZOS)
                 
             buffer = io.BytesIO()
             
-            # Более агрессивная оптимизация
-            img.save(
-                buffer, 
-                format="JPEG", 
-                quality=quality, 
-                optimize=True, 
-                progressive=True
-            )
+            if image_format == "WEBP":
+                img.save(buffer, format="WEBP", quality=quality, method=4)
+            else:
+                img.save(
+                    buffer, 
+                    format="JPEG", 
+                    quality=quality, 
+                    optimize=True, 
+                    progressive=True
+                )
             
             return buffer.getvalue()
     except Exception as e:
         raise ValueError(f"Ошибка при обработке изображения {image_path.name}: {str(e)}")
 
 
-async def preload_images():
-    """Предзагружает и сжимает все изображения при старте с обработкой ошибок"""
-    loaded_count = 0
-    for story in tales_data['stories']:
-        illustr_dir = Path(__file__).parent / "illustraciones" / story['rus_title']
-        if not illustr_dir.exists():
-            continue
-            
-        try:
-            images = sorted(
-                [img for img in illustr_dir.iterdir() 
-                 if img.is_file() and img.suffix.lower() in ('.jpg', '.jpeg', '.png')],
-                key=lambda x: x.name
-            )
-            
-            for img in images:
-                try:
-                    # Сжимаем с более агрессивными настройками
-                    image_cache[str(img)] = await compress_image(img, quality=75)
-                    loaded_count += 1
-                except Exception as e:
-                    logger.warning(f"Не удалось загрузить {img.name}: {str(e)}")
-                    
-        except Exception as e:
-            logger.error(f"Ошибка при обработке папки {illustr_dir}: {str(e)}")
-    
-    logger.info(f"Успешно предзагружено {loaded_count} изображений")
+async def get_image_variant(image_path: Path, variant: str = "full", image_format: Optional[str] = None) -> bytes:
+    """Возвращает вариант иллюстрации, при необходимости создавая его в пуле потоков"""
+    image_format = image_format or IMAGE_FORMAT
+    key = (str(image_path), variant, image_format)
+    if key in image_cache:
+        return image_cache[key]
+
+    task = image_variant_tasks.get(key)
+    if task is None:
+        max_size, quality = IMAGE_VARIANTS[variant]
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(image_executor, render_image_variant, image_path, max_size, quality, image_format)
+        image_variant_tasks[key] = task
+    try:
+        data = await task
+    finally:
+        image_variant_tasks.pop(key, None)
+    image_cache[key] = data
+    return data
+
+
+def image_variant_file(data: bytes, name: str, image_format: Optional[str] = None) -> types.BufferedInputFile:
+    """Оборачивает байты варианта в файл для отправки"""
+    extension = "webp" if (image_format or IMAGE_FORMAT) == "WEBP" else "jpg"
+    return types.BufferedInputFile(data, filename=f"{name}.{extension}")
+
+
+async def compress_image(image_path: Path, quality=75) -> bytes:
+    """Сжимает изображение до полного размера (1280px) в JPEG"""
+    max_size, _ = IMAGE_VARIANTS["full"]
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, render_image_variant, image_path, max_size, quality, "JPEG")
 
 
 async def send_multiple_photos(chat_id: int, photos: List[Path]):
     """Отправляет несколько фото параллельно"""
+    variant = pick_image_variant(800)
     tasks = []
-    for photo in photos:
-        if str(photo) in image_cache:
-            tasks.append(
-                bot.send_photo(
-                    chat_id=chat_id,
-                    photo=types.BufferedInputFile(image_cache[str(photo)], filename=photo.name),
-                    caption=f"Иллюстрация {photos.index(photo)+1}/{len(photos)}"
-                )
+    for index, photo in enumerate(photos):
+        data = await get_image_variant(photo, variant)
+        tasks.append(
+            bot.send_photo(
+                chat_id=chat_id,
+                photo=image_variant_file(data, photo.stem),
+                caption=f"Иллюстрация {index+1}/{len(photos)}"
             )
-    await asyncio.gather(*tasks)
+        )
+    with send_lane_scope(LANE_BULK):
+        await asyncio.gather(*tasks)
 
 
-def get_story_images(story: dict) -> list:
-    """Возвращает список изображений для сказки"""
+def scan_story_images(story: dict) -> list:
+    """Сканирует папку с иллюстрациями сказки"""
     illustr_dir = Path(__file__).parent / "illustraciones" / story['rus_title']
     if not illustr_dir.exists():
         return []
@@ -2256,11 +4583,19 @@ def get_story_images(story: dict) -> list:
     )
 
 
-@dp.callback_query(F.data.startswith(CALLBACK_SHOW_ILLUSTRATIONS))
-async def handle_show_illustrations(callback: CallbackQuery, state: FSMContext):
+def get_story_images(story: dict) -> list:
+    """Возвращает список изображений для сказки (папка сканируется один раз)"""
+    images = story_images_cache.get(story['id'])
+    if images is None:
+        images = scan_story_images(story)
+        story_images_cache[story['id']] = images
+    return images
+
+
+@callback_router.route(CALLBACK_SHOW_ILLUSTRATIONS)
+async def handle_show_illustrations(callback: CallbackQuery, story_id: int, state: FSMContext):
     """Показ иллюстраций к сказке"""
     try:
-        story_id = int(callback.data.replace(CALLBACK_SHOW_ILLUSTRATIONS, ""))
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         images = get_story_images(story)
 
@@ -2268,6 +4603,8 @@ async def handle_show_illustrations(callback: CallbackQuery, state: FSMContext):
             await callback.answer("❌ Иллюстрации не найдены", show_alert=True)
             return
 
+        # Пока показывается первая, остальные иллюстрации сказки сжимаются вне очереди
+        warmup.promote_many("illustrations", [str(img) for img in images[1:]])
         await send_illustration_page(callback.message, story, images, 0, state)
         await callback.answer()
 
@@ -2276,8 +4613,38 @@ async def handle_show_illustrations(callback: CallbackQuery, state: FSMContext):
         await callback.answer("⚠️ Ошибка при загрузке иллюстраций", show_alert=True)
 
 
-async def send_illustration_page(message: Message, story: dict, images: list, page: int, state: FSMContext):
-    """Отправляет одну иллюстрацию с навигацией"""
+async def illustration_media(image_path: Path, page: int) -> Union[str, types.BufferedInputFile]:
+    """Возвращает file_id иллюстрации, если она уже загружена в Telegram, иначе сжатый файл"""
+    file_id = illustration_file_ids.get(str(image_path))
+    if file_id:
+        return file_id
+
+    data = await get_image_variant(image_path, pick_image_variant(1280))
+    return image_variant_file(data, f"illustration_{page}")
+
+
+async def story_audio_thumbnail(story: dict) -> Optional[types.BufferedInputFile]:
+    """Обложка для аудио: самый маленький вариант первой иллюстрации"""
+    images = get_story_images(story)
+    if not images:
+        return None
+    try:
+        data = await get_image_variant(images[0], pick_image_variant(320), image_format="JPEG")
+        return image_variant_file(data, f"cover_{story['id']}", image_format="JPEG")
+    except Exception as e:
+        logger.warning(f"Не удалось подготовить обложку для сказки {story['id']}: {e}")
+        return None
+
+
+def remember_illustration_file_id(image_path: Path, sent: Union[Message, bool]):
+    """Запоминает file_id отправленной иллюстрации"""
+    if isinstance(sent, Message) and sent.photo:
+        illustration_file_ids[str(image_path)] = sent.photo[-1].file_id
+
+
+async def send_illustration_page(message: Message, story: dict, images: list, page: int, state: FSMContext,
+                                 edit: bool = False):
+    """Отправляет одну иллюстрацию с навигацией (при edit=True заменяет фото в текущем сообщении)"""
     try:
         if page < 0 or page >= len(images):
             raise IndexError("Некорректный номер страницы")
@@ -2285,54 +4652,51 @@ async def send_illustration_page(message: Message, story: dict, images: list, pa
         image_path = images[page]
         caption = f"🖼️ Иллюстрация {page+1}/{len(images)}\n<b>{story['rus_title']}</b>"
 
-        # Получаем сжатое изображение
-        if str(image_path) not in image_cache:
-            image_cache[str(image_path)] = await compress_image(image_path)
-
         # Получаем сохраненный язык
         user_data = await state.get_data()
         lang = user_data.get('last_lang', 'ru')
-        back_callback = f"{CALLBACK_LANGUAGE_RU}{story['id']}" if lang == 'ru' else f"{CALLBACK_LANGUAGE_KH}{story['id']}"
+        back_callback = pack_callback(CALLBACK_LANGUAGE_RU, story['id']) if lang == 'ru' else pack_callback(CALLBACK_LANGUAGE_KH, story['id'])
 
         # Создаем клавиатуру
         builder = InlineKeyboardBuilder()
         
         if page > 0:
-            builder.button(text="◀️ Назад", callback_data=f"illustr_prev_{story['id']}_{page}")
+            builder.button(text="◀️ Назад", callback_data=pack_callback(CALLBACK_ILLUSTRATION_PREV, story['id'], page))
         if page < len(images) - 1:
-            builder.button(text="Вперёд ▶️", callback_data=f"illustr_next_{story['id']}_{page}")
+            builder.button(text="Вперёд ▶️", callback_data=pack_callback(CALLBACK_ILLUSTRATION_NEXT, story['id'], page))
             
         builder.button(text="🔙 Назад к сказке", callback_data=back_callback)
         builder.adjust(2)
-        
-        # Отправляем фото
-        await message.answer_photo(
-            types.BufferedInputFile(
-                image_cache[str(image_path)],
-                filename=f"illustration_{page}.jpg"
-            ),
-            caption=caption,
-            reply_markup=builder.as_markup()
-        )
+
+        media = await illustration_media(image_path, page)
+
+        if edit:
+            # Листание: одно редактирование вместо удаления и повторной отправки
+            sent = await message.edit_media(
+                types.InputMediaPhoto(media=media, caption=caption),
+                reply_markup=builder.as_markup()
+            )
+        else:
+            sent = await message.answer_photo(
+                media,
+                caption=caption,
+                reply_markup=builder.as_markup()
+            )
+        remember_illustration_file_id(image_path, sent)
 
     except Exception as e:
         logger.error(f"Ошибка при отправке иллюстрации: {e}")
         raise
 
 
-@dp.callback_query(F.data.startswith("illustr_prev_"))
-async def handle_illustr_prev(callback: CallbackQuery, state: FSMContext):
+@callback_router.route(CALLBACK_ILLUSTRATION_PREV)
+async def handle_illustr_prev(callback: CallbackQuery, story_id: int, current_page: int, state: FSMContext):
     """Переход к предыдущей иллюстрации"""
     try:
-        parts = callback.data.split('_')
-        story_id = int(parts[2])
-        current_page = int(parts[3])
-
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         images = get_story_images(story)
 
-        await callback.message.delete()
-        await send_illustration_page(callback.message, story, images, current_page - 1, state)
+        await send_illustration_page(callback.message, story, images, current_page - 1, state, edit=True)
         await callback.answer()
 
     except Exception as e:
@@ -2340,19 +4704,14 @@ async def handle_illustr_prev(callback: CallbackQuery, state: FSMContext):
         await callback.answer("⚠️ Ошибка при переходе", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith("illustr_next_"))
-async def handle_illustr_next(callback: CallbackQuery, state: FSMContext):
+@callback_router.route(CALLBACK_ILLUSTRATION_NEXT)
+async def handle_illustr_next(callback: CallbackQuery, story_id: int, current_page: int, state: FSMContext):
     """Переход к следующей иллюстрации"""
     try:
-        parts = callback.data.split('_')
-        story_id = int(parts[2])
-        current_page = int(parts[3])
-
         story = next(s for s in tales_data['stories'] if s['id'] == story_id)
         images = get_story_images(story)
 
-        await callback.message.delete()
-        await send_illustration_page(callback.message, story, images, current_page + 1, state)
+        await send_illustration_page(callback.message, story, images, current_page + 1, state, edit=True)
         await callback.answer()
 
     except Exception as e:
@@ -2360,22 +4719,12 @@ async def handle_illustr_next(callback: CallbackQuery, state: FSMContext):
         await callback.answer("⚠️ Ошибка при переходе", show_alert=True)
 
 # --- Обработчики навигации ---
-@dp.callback_query(F.data == CALLBACK_BACK_TO_MAIN)
+@callback_router.route(CALLBACK_BACK_TO_MAIN)
 async def handle_back_to_main(callback: types.CallbackQuery):
     """Возврат в главное меню"""
     try:
         await callback.message.answer(
-            f"🌟 <b>{html.escape(callback.from_user.first_name)}</b>, ты в главном меню! \n \n"
-            "Выбери <b>📖 Cказки</b>, если хочешь: \n"
-            " • почитать или послушать сказки на хантыйском,\n"
-            " • увидеть русский перевод сказки,\n"
-            " • пройти тест на знание материала,\n\n"
-             
-            "Выбери <b>📚 Словарик</b>, если хочешь:\n"
-            " • услышать произношение букв хантыйского алфавита,\n"
-            " • увидеть список слов с переводом,\n"
-            " • узнать грамматические правила. \n\n",
-            
+            MAIN_MENU_TEXT.format(name=html.escape(callback.from_user.first_name)),
             reply_markup=await main_menu_kb(),
             parse_mode=ParseMode.HTML
         )
@@ -2385,12 +4734,12 @@ async def handle_back_to_main(callback: types.CallbackQuery):
         await callback.answer("⚠️ Ошибка при возврате в меню", show_alert=True)
 
 
-@dp.callback_query(F.data == CALLBACK_BACK_TO_TALES)
+@callback_router.route(CALLBACK_BACK_TO_TALES)
 async def handle_back_to_tales(callback: types.CallbackQuery):
     """Возврат в меню сказок"""
     try:
         await callback.message.answer(
-            "📖 Выбери сказку или воспользуйся кнопками <b>Вперёд ▶️</b> и <b>◀️ Назад</b> для перехода по меню:",
+            TALES_MENU_TEXT,
             reply_markup=await tales_menu_kb()
         )
         await callback.answer()
@@ -2399,27 +4748,12 @@ async def handle_back_to_tales(callback: types.CallbackQuery):
         await callback.answer("⚠️ Ошибка при возврате в меню", show_alert=True)
 
 
-@dp.callback_query(F.data == CALLBACK_BACK_TO_VOCABULARY)
+@callback_router.route(CALLBACK_BACK_TO_VOCABULARY)
 async def handle_back_to_vocabulary(callback: types.CallbackQuery):
     """Возврат в меню словаря"""
     try:
         await callback.message.answer(
-           "📚 Выбери раздел словаря:\n\n"
-            "В <b>📝 Общей грамматике</b> можешь прочитать о грамматических правилах: \n" 
-            " • Сколько чисел в хантыйском и как они образуются,\n "
-            " • Какие есть падежные суффиксы,\n"
-            " • Как ласково сказать белочка или рыбка.\n\n"
-
-            "В <b>🔤 Общей лексике</b> сможешь узнать слова из разных категорий:\n" 
-            " • Еда,\n" 
-            " • Животные,\n"
-            " • Природа и другие.\n\n"
-
-            "В <b>🔡 Алфавите</b> можешь увидеть:\n" 
-            " • Названия букв\n" 
-            " • Гласные звуки\n" 
-            " • Согласные звуки.\n"
-            ,
+            VOCABULARY_MENU_TEXT,
             reply_markup=await vocabulary_menu_kb()
         )
         await callback.answer()
@@ -2462,22 +4796,328 @@ async def errors_handler(event: types.ErrorEvent):
     )
     return True
 
+# --- Фоновый прогрев ---
+# Обновления принимаются сразу после критических фаз, кэши прогреваются в фоне
+# по приоритету категорий. Обработчик, попавший на холодный кэш, поднимает
+# свой элемент в начало очереди.
+WARMUP_WORKERS = max(1, int(os.getenv("WARMUP_WORKERS", "2")))
+# Сначала дешёвое и нужное почти каждому пользователю, модели — в конце
+WARMUP_ORDER = ("menus", "stories", "alphabet", "illustrations", "audio", "models")
+
+
+class WarmupOrchestrator:
+    """
+    Очередь прогрева: элемент — (категория, ключ) и корутина, которая его прогревает.
+    Поднятый элемент кладётся в кучу повторно с наивысшим приоритетом,
+    устаревшие записи кучи пропускаются при извлечении.
+    """
+
+    PROMOTED = -1
+
+    def __init__(self, order: Tuple[str, ...] = WARMUP_ORDER, workers: int = WARMUP_WORKERS):
+        self.order = order
+        self.workers = workers
+        self.items: Dict[Tuple[str, object], Callable] = {}
+        self.state: Dict[Tuple[str, object], str] = {}
+        self.queue: List[Tuple[int, int, Tuple[str, object]]] = []
+        self.seq = 0
+        self.progress: Dict[str, Dict[str, int]] = {
+            category: {"total": 0, "done": 0, "failed": 0} for category in order
+        }
+        self.promoted = 0
+        # элемент -> событие для тех, кто ждёт его прогрева
+        self.waiters: Dict[Tuple[str, object], asyncio.Event] = {}
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def push(self, priority: int, item: Tuple[str, object]):
+        self.seq += 1
+        heapq.heappush(self.queue, (priority, self.seq, item))
+
+    def add(self, category: str, key, warm: Callable):
+        """warm — функция без аргументов, возвращающая корутину"""
+        item = (category, key)
+        if item in self.items:
+            return
+        self.items[item] = warm
+        self.state[item] = "pending"
+        self.progress[category]["total"] += 1
+        self.push(self.order.index(category), item)
+
+    def promote(self, category: str, key) -> bool:
+        """Переносит ещё не прогретый элемент в начало очереди"""
+        item = (category, key)
+        if self.state.get(item) != "pending":
+            return False
+        self.push(self.PROMOTED, item)
+        self.promoted += 1
+        return True
+
+    def promote_many(self, category: str, keys) -> int:
+        return sum(self.promote(category, key) for key in keys)
+
+    async def wait(self, category: str, key, timeout: float) -> bool:
+        """Ждёт прогрева элемента не дольше timeout; True, если он прогрет"""
+        item = (category, key)
+        if self.state.get(item) not in ("pending", "running"):
+            return self.state.get(item) == "done"
+        event = self.waiters.setdefault(item, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.state.get(item) == "done"
+
+    async def worker(self):
+        while self.queue:
+            _, _, item = heapq.heappop(self.queue)
+            if self.state[item] != "pending":
+                continue
+            self.state[item] = "running"
+            category, key = item
+            try:
+                await self.items[item]()
+                self.state[item] = "done"
+                self.progress[category]["done"] += 1
+            except Exception as e:
+                self.state[item] = "failed"
+                self.progress[category]["failed"] += 1
+                logger.warning(f"Не удалось прогреть {category}:{key}: {e}")
+            event = self.waiters.pop(item, None)
+            if event:
+                event.set()
+            # Между элементами отдаём цикл событий обработчикам обновлений
+            await asyncio.sleep(0)
+
+    async def run(self):
+        self.started = time.perf_counter()
+        await asyncio.gather(*(self.worker() for _ in range(self.workers)))
+        self.finished = time.perf_counter()
+        done = sum(progress["done"] for progress in self.progress.values())
+        failed = sum(progress["failed"] for progress in self.progress.values())
+        logger.info(f"Прогрев завершён за {self.finished - self.started:.2f} с: "
+                    f"готово {done}, ошибок {failed}, поднято по запросу {self.promoted}")
+
+    @property
+    def is_warm(self) -> bool:
+        return self.finished is not None
+
+    def snapshot(self) -> dict:
+        categories = {}
+        for category, progress in self.progress.items():
+            handled = progress["done"] + progress["failed"]
+            percent = round(100 * handled / progress["total"], 1) if progress["total"] else 100.0
+            categories[category] = {**progress, "percent": percent}
+        return {
+            "started": self.started is not None,
+            "finished": self.is_warm,
+            "pending": sum(1 for state in self.state.values() if state == "pending"),
+            "promoted": self.promoted,
+            "categories": categories,
+        }
+
+    def metrics(self) -> dict:
+        return {
+            "items": {category: progress["total"] for category, progress in self.progress.items()},
+            "done": {category: progress["done"] for category, progress in self.progress.items()},
+            "failed": {category: progress["failed"] for category, progress in self.progress.items()},
+            "promoted_total": self.promoted,
+            "ready": int(self.is_warm),
+        }
+
+
+warmup = WarmupOrchestrator()
+metrics.add_collector("bot_warmup", warmup.metrics)
+
+
+def load_theme_models():
+    global theme_classifier, theme_models_version
+    theme_classifier = hybrid_classifier.neural = build_theme_classifier()
+    # Темы, определённые заглушкой до загрузки моделей, больше не годятся
+    HybridThemeClassifier.predict_themes.cache_clear()
+    theme_models_version += 1
+    logger.info("Гибридный классификатор использует нейросеть")
+
+
+async def load_alphabet_letter(letter: dict):
+    """Читает картинку и аудио буквы в память, чтобы не обращаться к диску при просмотре"""
+    for key in ('photo', 'sound'):
+        async with aiofiles.open(Path(__file__).parent / letter[key], 'rb') as f:
+            alphabet_media_cache[letter[key]] = await f.read()
+
+
+async def warm_menus():
+    await main_menu_kb()
+    await vocabulary_menu_kb()
+    await alphabet_menu_kb()
+    await grammar_toc_kb()
+    # tales_menu_kb() и tales_menu_kb(0) — одна запись реестра
+    for page in range(page_count(len(tales_data['stories']), TALES_PAGE_SIZE)):
+        await tales_menu_kb(page)
+    for page in range(len(grammar_digest['pages'])):
+        await grammar_page_kb(page)
+
+
+async def warm_story(story_id: int):
+    """Клавиатуры сказки, включая первую страницу чтения на обоих языках"""
+    await language_menu_kb(story_id)
+    await story_menu_kb(story_id)
+    for lang in READER_LANGUAGES:
+        await reader_kb(story_id, lang, 0, len(story_texts[(story_id, lang)]))
+
+
+def plan_warmup(orchestrator: WarmupOrchestrator = warmup):
+    """
+    Заполняет очередь прогрева. Сказки, тесты и тексты для чтения готовятся
+    критическими фазами запуска, поэтому здесь их нет.
+    """
+    orchestrator.add("menus", "all", warm_menus)
+    for story in tales_data['stories']:
+        orchestrator.add("stories", story['id'], partial(warm_story, story['id']))
+    for letter_idx, letter in enumerate(alphabet_data):
+        orchestrator.add("alphabet", letter_idx, partial(load_alphabet_letter, letter))
+    for story in tales_data['stories']:
+        for img in get_story_images(story):
+            orchestrator.add("illustrations", str(img), partial(get_image_variant, img, "full"))
+    if FFMPEG_PATH and FFPROBE_PATH:
+        for story in tales_data['stories']:
+            if story_audio_source(story):
+                orchestrator.add("audio", story['id'], partial(prepare_story_audio, story))
+    else:
+        logger.warning("ffmpeg/ffprobe не найдены — озвучка будет отправляться в исходном MP3")
+    orchestrator.add("models", "themes", partial(asyncio.to_thread, load_theme_models))
+
+
+def health_snapshot() -> dict:
+    if startup_report["ready_s"] is None:
+        status = "starting"
+    elif not warmup.is_warm:
+        status = "warming"
+    else:
+        status = "ready"
+    return {
+        "status": status,
+        "serving": startup_report["ready_s"] is not None,
+        "warm": warmup.is_warm,
+        "uptime_s": round(time.perf_counter() - PROCESS_STARTED, 3),
+        "ready_s": startup_report["ready_s"],
+        "warm_s": startup_report["warm_s"],
+        "warmup": warmup.snapshot(),
+        "phases": {name: record.get("ok", False) for name, record in startup_report["phases"].items()},
+    }
+
+
+async def handle_health_request(request: web.Request) -> web.Response:
+    """
+    /health — 200, только когда бот принимает обновления и кэши прогреты;
+    /health/serving — 200, как только бот принимает обновления.
+    Пока ответ 503, балансировщику стоит не нагружать экземпляр в полную силу.
+    """
+    snapshot = health_snapshot()
+    ready = snapshot["serving"] if request.path.endswith("/serving") else snapshot["warm"]
+    return web.json_response(snapshot, status=200 if ready else 503,
+                             dumps=partial(json.dumps, ensure_ascii=False))
+
+
+async def run_warmup():
+    plan_warmup()
+    await warmup.run()
+    startup_report["warm_s"] = round(warmup.finished - PROCESS_STARTED, 3)
+
+
 # --- Запуск бота ---
-async def main():
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых обновлений"""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+async def run_webhook():
+    """Приём обновлений через вебхук на aiohttp"""
+    if not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(WEBHOOK_MAX_CONCURRENCY))
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100)
+    )
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# Ссылка на задачу, ждущую фоновые фазы: цикл событий хранит задачи только по слабым ссылкам
+startup_finisher: Optional[asyncio.Task] = None
+
+
+async def finish_startup(background: List[asyncio.Task]):
+    await asyncio.gather(*background, return_exceptions=True)
+    log_startup_report()
+
+
+@dp.startup()
+async def on_startup():
+    """Приём обновлений начался: фоновые фазы и прогрев кэшей не задерживают ответы"""
+    startup_report["ready_s"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+    logger.info(f"Бот принимает обновления через {startup_report['ready_s']} с после старта")
+    background = start_startup_phases(phase_names(critical=False))
+    background.append(asyncio.create_task(run_warmup(), name="warmup"))
+    global startup_finisher
+    startup_finisher = asyncio.create_task(finish_startup(background), name="startup:finish")
+
+
+async def main() -> int:
+    """Возвращает код выхода: 1, если бот не запустился или упал"""
+    metrics_runner = None
+    lag_task = None
+    exit_code = 0
     try:
         logger.info("Запуск бота...")
-        await set_bot_commands(bot)  # Добавьте эту строку
-        await preload_images()  # Добавьте эту строку перед start_polling
-        await dp.start_polling(bot)
+        metrics_runner = await start_metrics_server()
+        lag_task = asyncio.create_task(monitor_event_loop_lag())
+        # Данные, тексты и база — одновременно; без них обработчики не работают
+        await asyncio.gather(*start_startup_phases(phase_names(critical=True)))
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
+        # Например, не прочиталась критическая фаза: супервизор должен увидеть сбой
         logger.critical(f"Ошибка при запуске бота: {e}")
+        exit_code = 1
     finally:
+        if lag_task:
+            lag_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if update_recorder:
+            update_recorder.close()
+        await dp.storage.close()
         await bot.session.close()
         logger.info("Бот остановлен")
+    return exit_code
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sys.exit(asyncio.run(main()))
 
 
 
@@ -0,0 +1,307 @@
+"""
+Локальная заглушка Telegram Bot API для замеров задержки и пропускной способности.
+
+Бот подключается к ней через TELEGRAM_API_URL, заглушка отдаёт обновления
+через getUpdates (polling) или сама отправляет их на вебхук (webhook) и
+засекает время от отправки обновления до первого ответа бота в этот чат.
+
+Пример:
+    python fake_bot_api.py --port 8081 --updates 2000 --rate 200
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("fake_bot_api")
+
+# Методы, которые возвращают отправленное сообщение
+MESSAGE_METHODS = {
+    "sendmessage", "sendphoto", "sendaudio", "sendvoice", "senddocument",
+    "editmessagetext", "editmessagemedia", "editmessagereplymarkup", "editmessagecaption",
+}
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Перцентиль по отсортированному списку (без numpy)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+class FakeBotAPI:
+    """Минимальная реализация Bot API: getUpdates, setWebhook и методы отправки"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081):
+        self.host = host
+        self.port = port
+        self.updates: Deque[dict] = deque()
+        self.update_event = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self.connected = asyncio.Event()
+        # chat_id -> время отправки ещё не отвеченных обновлений
+        self.pending: Dict[int, Deque[float]] = defaultdict(deque)
+        self.latencies: List[float] = []
+        self.undelivered = 0
+        self.calls: Counter = Counter()
+        self.bytes_in: Counter = Counter()
+        self.outbound: List[dict] = []
+        self.record_outbound = False
+        # chat_id -> очередь ответов бота для подписанных чатов (см. load_test.py)
+        self.replies: Dict[int, asyncio.Queue] = {}
+        # id callback-запроса -> chat_id, чтобы отнести всплывающее уведомление к чату
+        self.callback_chats: Dict[str, int] = {}
+        self.http: Optional[ClientSession] = None
+        self.runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application(client_max_size=50 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.handle_method)
+        self.app.router.add_get("/bot{token}/{method}", self.handle_method)
+
+    async def start(self):
+        self.http = ClientSession()
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Заглушка Bot API слушает http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self.http:
+            await self.http.close()
+        if self.runner:
+            await self.runner.cleanup()
+
+    # --- Построение обновлений ---
+    def user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Learner{user_id}", "language_code": "ru"}
+
+    def chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "private", "first_name": f"Learner{chat_id}"}
+
+    def message_update(self, user_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self.chat(user_id),
+            "from": self.user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def callback_update(self, user_id: int, data: str, message_id: Optional[int] = None) -> dict:
+        callback_id = str(next(self.message_ids))
+        self.callback_chats[callback_id] = user_id
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": callback_id,
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id or next(self.message_ids),
+                    "date": int(time.time()),
+                    "chat": self.chat(user_id),
+                    "from": {"id": 1, "is_bot": True, "first_name": "Fake"},
+                    "text": "…",
+                },
+            },
+        }
+
+    def subscribe(self, chat_id: int) -> asyncio.Queue:
+        """Очередь, в которую попадают все сообщения бота в этот чат"""
+        return self.replies.setdefault(chat_id, asyncio.Queue())
+
+    async def push_update(self, update: dict):
+        """Передаёт обновление боту (в очередь getUpdates или на вебхук)"""
+        chat_id = (update.get("message") or update["callback_query"]["message"])["chat"]["id"]
+        self.pending[chat_id].append(time.perf_counter())
+        if self.webhook_url:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+            try:
+                async with self.http.post(self.webhook_url, json=update, headers=headers) as response:
+                    delivered = response.status == 200
+                    if not delivered:
+                        logger.warning(f"Вебхук ответил {response.status}")
+            except Exception as e:
+                delivered = False
+                logger.warning(f"Не удалось доставить обновление на вебхук: {e}")
+            if not delivered:
+                self.undelivered += 1
+                self.pending[chat_id].pop()
+        else:
+            self.updates.append(update)
+            self.update_event.set()
+
+    # --- Обработка запросов бота ---
+    async def read_params(self, request: web.Request) -> dict:
+        params = dict(request.query)
+        if request.can_read_body:
+            form = await request.post()
+            for key, value in form.items():
+                if isinstance(value, web.FileField):
+                    content = value.file.read()
+                    self.bytes_in[request.match_info["method"].lower()] += len(content)
+                    params[key] = f"file:{value.filename}"
+                else:
+                    params[key] = value
+        return params
+
+    def sent_message(self, method: str, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": self.chat(chat_id),
+            "from": {"id": 1, "is_bot": True, "first_name": "Fake"},
+        }
+        file_id = f"fake_{method}_{message['message_id']}"
+        if method in ("sendphoto", "editmessagemedia"):
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}]
+        elif method == "sendaudio":
+            message["audio"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+        elif method == "sendvoice":
+            message["voice"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+        elif method == "senddocument":
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        else:
+            message["text"] = params.get("text", "")
+        if params.get("caption"):
+            message["caption"] = params["caption"]
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset", 0) or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), timeout=float(params.get("timeout", 0) or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100) or 100)
+        return list(itertools.islice(self.updates, limit))
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = await self.read_params(request)
+        self.calls[method] += 1
+
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method == "getupdates":
+            self.connected.set()
+            result = await self.get_updates(params)
+        elif method == "setwebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            self.connected.set()
+            result = True
+        elif method == "deletewebhook":
+            self.webhook_url = None
+            result = True
+        elif method == "getwebhookinfo":
+            result = {"url": self.webhook_url or "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method in MESSAGE_METHODS:
+            result = self.sent_message(method, params)
+        else:
+            result = True
+
+        if method in MESSAGE_METHODS:
+            queue = self.replies.get(result["chat"]["id"])
+            if queue is not None:
+                queue.put_nowait(result)
+        elif method == "answercallbackquery":
+            chat = self.callback_chats.pop(params.get("callback_query_id"), None)
+            if params.get("text") and chat in self.replies:
+                self.replies[chat].put_nowait({"alert": params["text"]})
+
+        if self.record_outbound and method not in ("getupdates", "getme"):
+            self.outbound.append({"method": method, "params": params, "result": result})
+
+        # Первый ответ в чат закрывает самое старое ожидающее обновление
+        chat_id = params.get("chat_id")
+        if chat_id is not None and str(chat_id).lstrip("-").isdigit():
+            queue = self.pending.get(int(chat_id))
+            if queue:
+                self.latencies.append(time.perf_counter() - queue.popleft())
+
+        return web.json_response({"ok": True, "result": result})
+
+    def report(self, elapsed: float) -> dict:
+        latencies_ms = [value * 1000 for value in self.latencies]
+        return {
+            "mode": "webhook" if self.webhook_url else "polling",
+            "answered": len(latencies_ms),
+            "unanswered": sum(len(queue) for queue in self.pending.values()),
+            "undelivered": self.undelivered,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(len(latencies_ms) / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(latencies_ms, 50), 2),
+                "p95": round(percentile(latencies_ms, 95), 2),
+                "p99": round(percentile(latencies_ms, 99), 2),
+                "max": round(max(latencies_ms, default=0.0), 2),
+            },
+            "calls": dict(self.calls),
+        }
+
+
+async def run(args):
+    api = FakeBotAPI(args.host, args.port)
+    await api.start()
+    try:
+        logger.info("Ожидание подключения бота (getUpdates или setWebhook)...")
+        await api.connected.wait()
+        # Даём боту закончить запуск
+        await asyncio.sleep(args.warmup)
+
+        started = time.perf_counter()
+        interval = 1 / args.rate if args.rate > 0 else 0
+        for i in range(args.updates):
+            user_id = 100000 + i % args.users
+            asyncio.create_task(api.push_update(api.message_update(user_id, args.text)))
+            if interval:
+                await asyncio.sleep(interval)
+
+        deadline = time.perf_counter() + args.timeout
+        while len(api.latencies) + api.undelivered < args.updates and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+        print(json.dumps(api.report(time.perf_counter() - started), ensure_ascii=False, indent=2))
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API с генератором нагрузки")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--updates", type=int, default=1000, help="сколько обновлений отправить")
+    parser.add_argument("--rate", type=float, default=100, help="обновлений в секунду (0 — без паузы)")
+    parser.add_argument("--users", type=int, default=100, help="число разных пользователей")
+    parser.add_argument("--text", default="/start", help="текст сообщения в обновлении")
+    parser.add_argument("--warmup", type=float, default=1.0, help="пауза после подключения бота, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="сколько ждать ответов, с")
+    asyncio.run(run(parser.parse_args()))
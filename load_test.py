@@ -0,0 +1,401 @@
+"""
+Нагрузочный тест бота: локальная заглушка Bot API и синтетические ученики.
+
+Скрипт поднимает fake_bot_api.FakeBotAPI, запускает bot.py с TELEGRAM_API_URL,
+указывающим на заглушку, и прогоняет множество учеников по типичным сценариям:
+/start, сказка на обоих языках с листанием, иллюстрации, тест из tests.json,
+общая лексика. Ученики нажимают те кнопки, которые бот им действительно прислал.
+
+В отчёте: пропускная способность, p50/p95/p99 задержки ответа по действиям,
+а со страницы /metrics бота — задержка цикла событий, время операций с базой
+и блокировки SQLite, время обработчиков и ожидание в очереди отправки.
+
+Пример:
+    python load_test.py --learners 2000 --concurrency 200
+    python load_test.py --mode webhook --bot-env SEND_GLOBAL_RATE=1000 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession
+
+from fake_bot_api import FakeBotAPI, percentile
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("load_test")
+
+BASE_DIR = Path(__file__).parent
+# Кнопки навигации, которые не выбираются как «случайная сказка / тема»
+NAVIGATION_PREFIXES = ("◀️", "▶️", "Вперёд", "🗂️", "🔙", "📄", "📝 Описание")
+
+
+def load_test_answers() -> Dict[str, List[str]]:
+    """Текст вопроса -> правильные ответы из tests.json"""
+    try:
+        with open(BASE_DIR / "tests.json", encoding="utf-8") as f:
+            tests = json.load(f)
+    except Exception as e:
+        logger.warning(f"tests.json не прочитан, ответы будут случайными: {e}")
+        return {}
+    answers = {}
+    for test in tests["tests"]:
+        for question in test["questions"]:
+            right = question["right answer"]
+            answers[question["question"].strip()] = [
+                answer.strip().lower() for answer in (right if isinstance(right, list) else [right])
+            ]
+    return answers
+
+
+class Learner:
+    """Синтетический ученик: отправляет обновления и ждёт ответов бота в своём чате"""
+
+    def __init__(self, api: FakeBotAPI, user_id: int, rng: random.Random, stats: "LoadStats",
+                 answers: Dict[str, List[str]], timeout: float, think: float):
+        self.api = api
+        self.user_id = user_id
+        self.rng = rng
+        self.stats = stats
+        self.answers = answers
+        self.timeout = timeout
+        self.think = think
+        self.replies = api.subscribe(user_id)
+        # Последнее сообщение с кнопками и все когда-либо присланные кнопки: текст -> (data, message_id)
+        self.last_markup: List[Tuple[str, str, int]] = []
+        self.seen_buttons: Dict[str, Tuple[str, int]] = {}
+        self.last_text = ""
+
+    def remember(self, reply: dict):
+        markup = reply.get("reply_markup")
+        if reply.get("text") or reply.get("caption"):
+            self.last_text = reply.get("text") or reply.get("caption")
+        if not markup:
+            return
+        self.last_markup = []
+        for row in markup.get("inline_keyboard", []):
+            for button in row:
+                if "callback_data" in button:
+                    item = (button["text"], button["callback_data"], reply["message_id"])
+                    self.last_markup.append(item)
+                    self.seen_buttons[button["text"]] = (button["callback_data"], reply["message_id"])
+
+    async def send(self, action: str, update: dict) -> List[dict]:
+        """Отправляет обновление и собирает ответы до сообщения с кнопками или всплывающего уведомления"""
+        while not self.replies.empty():
+            self.remember(self.replies.get_nowait())
+        if self.think:
+            await asyncio.sleep(self.rng.expovariate(1 / self.think))
+
+        started = time.perf_counter()
+        await self.api.push_update(update)
+        received = []
+        deadline = started + self.timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            try:
+                reply = await asyncio.wait_for(self.replies.get(), timeout=max(remaining, 0.001))
+            except asyncio.TimeoutError:
+                break
+            if not received:
+                self.stats.latency(action, time.perf_counter() - started)
+            received.append(reply)
+            self.remember(reply)
+            if reply.get("reply_markup") or reply.get("alert"):
+                break
+        if not received:
+            self.stats.timeout(action)
+        return received
+
+    async def command(self, text: str, action: str) -> List[dict]:
+        return await self.send(action, self.api.message_update(self.user_id, text))
+
+    def find(self, prefix: str, only_last: bool = False) -> Optional[Tuple[str, int]]:
+        """Кнопка из последнего меню, а если её там нет — из ранее присланных (кнопки не зависят от сообщения)"""
+        for text, data, message_id in self.last_markup:
+            if text.startswith(prefix):
+                return data, message_id
+        if only_last:
+            return None
+        return self.seen_buttons.get(prefix) or next(
+            (value for text, value in self.seen_buttons.items() if text.startswith(prefix)), None
+        )
+
+    async def click(self, prefix: str, action: str, only_last: bool = False) -> Optional[List[dict]]:
+        button = self.find(prefix, only_last)
+        if button is None:
+            return None
+        data, message_id = button
+        return await self.send(action, self.api.callback_update(self.user_id, data, message_id))
+
+    async def click_random(self, action: str) -> Optional[List[dict]]:
+        """Нажимает случайную содержательную кнопку последнего меню (сказка, тема)"""
+        choices = [
+            (data, message_id) for text, data, message_id in self.last_markup
+            if not text.startswith(NAVIGATION_PREFIXES)
+        ]
+        if not choices:
+            return None
+        data, message_id = self.rng.choice(choices)
+        return await self.send(action, self.api.callback_update(self.user_id, data, message_id))
+
+    # --- Сценарии ---
+    async def read_tale(self):
+        await self.click("📖 Сказки", "tales_menu")
+        if self.rng.random() < 0.5:
+            await self.click("Вперёд ▶️", "tales_page", only_last=True)
+        if not await self.click_random("open_story"):
+            return
+        await self.click("🇷🇺", "open_tale_ru")
+        for _ in range(self.rng.randint(0, 3)):
+            if not await self.click("▶️", "read_page", only_last=True):
+                break
+        await self.click("🦦", "open_tale_kh")
+
+    async def browse_illustrations(self):
+        if not await self.click("🖼️", "illustrations"):
+            return
+        for _ in range(self.rng.randint(1, 4)):
+            if not await self.click("Вперёд ▶️", "illustration_page", only_last=True):
+                break
+
+    async def take_test(self, correct_rate: float = 0.7):
+        replies = await self.click("📝 Пройти тест", "start_test")
+        for _ in range(30):
+            if not replies or "завершён" in self.last_text:
+                return
+            question = self.last_text.split("\n", 1)[-1].strip()
+            right = self.answers.get(question, [])
+            variants = [(text, data, message_id) for text, data, message_id in self.last_markup]
+            if not variants:
+                return
+            picked = next(
+                (item for item in variants if item[0].strip().lower() in right),
+                None
+            ) if self.rng.random() < correct_rate else None
+            text, data, message_id = picked or self.rng.choice(variants)
+            replies = await self.send("test_answer", self.api.callback_update(self.user_id, data, message_id))
+
+    async def browse_lexicon(self):
+        await self.click("📚 Словарик", "vocabulary")
+        if not await self.click("🔤 Общая лексика", "lexicon_menu"):
+            return
+        for _ in range(self.rng.randint(1, 3)):
+            if not await self.click_random("lexicon_theme"):
+                break
+            await self.click("🔙 Назад к темам", "lexicon_back", only_last=True)
+        await self.click("Вперёд ▶️", "lexicon_page", only_last=True)
+
+    async def run(self):
+        await self.command("/start", "start")
+        scenarios = [self.read_tale, self.browse_illustrations, self.take_test, self.browse_lexicon]
+        # Сказка открывается первой: иллюстрации и тест доступны из её меню
+        await self.read_tale()
+        for scenario in self.rng.sample(scenarios[1:], k=self.rng.randint(1, 3)):
+            await scenario()
+        self.api.replies.pop(self.user_id, None)
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.timeouts: Dict[str, int] = defaultdict(int)
+
+    def latency(self, action: str, seconds: float):
+        self.latencies[action].append(seconds * 1000)
+
+    def timeout(self, action: str):
+        self.timeouts[action] += 1
+
+    def summary(self, values: List[float]) -> dict:
+        return {
+            "count": len(values),
+            "p50": round(percentile(values, 50), 2),
+            "p95": round(percentile(values, 95), 2),
+            "p99": round(percentile(values, 99), 2),
+            "max": round(max(values, default=0.0), 2),
+        }
+
+    def report(self, elapsed: float) -> dict:
+        everything = [value for values in self.latencies.values() for value in values]
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "actions": len(everything),
+            "timeouts": sum(self.timeouts.values()),
+            "throughput_rps": round(len(everything) / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": self.summary(everything),
+            "by_action": {
+                action: {**self.summary(values), "timeouts": self.timeouts.get(action, 0)}
+                for action, values in sorted(self.latencies.items())
+            },
+        }
+
+
+# --- Метрики бота ---
+METRIC_LINE_RE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_prometheus(text: str) -> Dict[str, List[Tuple[dict, float]]]:
+    series = defaultdict(list)
+    for line in text.splitlines():
+        match = METRIC_LINE_RE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            series[name].append((dict(LABEL_RE.findall(labels or "")), float(value)))
+    return series
+
+
+def histogram_quantiles(series: Dict[str, List[Tuple[dict, float]]], name: str,
+                        group_by: Tuple[str, ...] = ()) -> dict:
+    """p50/p99 (мс) по корзинам гистограммы, с группировкой по меткам"""
+    buckets = defaultdict(list)
+    for labels, value in series.get(f"{name}_bucket", []):
+        key = tuple(labels.get(label, "") for label in group_by)
+        buckets[key].append((float(labels["le"]), value))
+    result = {}
+    for key, items in buckets.items():
+        items.sort()
+        total = items[-1][1]
+        quantiles = {"count": int(total)}
+        for q in (0.5, 0.99):
+            rank, previous_bound, previous_count = q * total, 0.0, 0.0
+            estimate = 0.0
+            for bound, cumulative in items:
+                if cumulative >= rank and total:
+                    if bound == float("inf"):
+                        estimate = previous_bound
+                    else:
+                        share = (rank - previous_count) / (cumulative - previous_count or 1)
+                        estimate = previous_bound + (bound - previous_bound) * share
+                    break
+                previous_bound, previous_count = bound, cumulative
+            quantiles[f"p{int(q * 100)}_ms"] = round(estimate * 1000, 2)
+        result["/".join(key) or "all"] = quantiles
+    return result
+
+
+async def scrape_bot_metrics(url: str) -> dict:
+    try:
+        async with ClientSession() as session:
+            async with session.get(url) as response:
+                text = await response.text()
+    except Exception as e:
+        logger.warning(f"Не удалось получить метрики бота с {url}: {e}")
+        return {}
+    series = parse_prometheus(text)
+    return {
+        "event_loop_lag": histogram_quantiles(series, "bot_event_loop_lag_seconds"),
+        "db": histogram_quantiles(series, "bot_db_seconds", ("operation",)),
+        "db_locked": {labels.get("operation"): value for labels, value in series.get("bot_db_locked_total", [])},
+        "handlers": histogram_quantiles(series, "bot_handler_seconds", ("handler",)),
+        "telegram_requests": histogram_quantiles(series, "bot_telegram_request_seconds", ("method",)),
+        "send_queue_wait_max_s": next((value for _, value in series.get("bot_send_scheduler_wait_seconds_max", [])), None),
+        "logged_errors": {labels.get("function"): value for labels, value in series.get("bot_logged_errors_total", [])},
+    }
+
+
+def start_bot(args) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_BOT_TOKEN", "123456:LOAD-TEST")
+    env.update({
+        "TELEGRAM_API_URL": f"http://{args.host}:{args.port}",
+        "BOT_MODE": args.mode,
+        "METRICS_PORT": str(args.metrics_port),
+    })
+    if args.mode == "webhook":
+        env.update({
+            "WEBHOOK_URL": f"http://127.0.0.1:{args.webhook_port}",
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PORT": str(args.webhook_port),
+        })
+    for item in args.bot_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    logger.info(f"Запуск {' '.join(args.bot_cmd)} в режиме {args.mode}")
+    return subprocess.Popen(args.bot_cmd, env=env, cwd=BASE_DIR)
+
+
+async def run(args):
+    api = FakeBotAPI(args.host, args.port)
+    await api.start()
+    bot_process = start_bot(args) if args.bot_cmd else None
+    try:
+        logger.info("Ожидание подключения бота (getUpdates или setWebhook)...")
+        await asyncio.wait_for(api.connected.wait(), timeout=args.startup_timeout)
+        await asyncio.sleep(args.warmup)
+
+        stats = LoadStats()
+        answers = load_test_answers()
+        rng = random.Random(args.seed)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def learner_task(index: int):
+            async with semaphore:
+                learner = Learner(api, 100000 + index, random.Random(rng.random()), stats,
+                                  answers, args.timeout, args.think)
+                try:
+                    await learner.run()
+                except Exception as e:
+                    logger.warning(f"Ученик {learner.user_id} прервал сценарий: {e}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(learner_task(i) for i in range(args.learners)))
+        elapsed = time.perf_counter() - started
+
+        report = {
+            "mode": args.mode,
+            "learners": args.learners,
+            "concurrency": args.concurrency,
+            **stats.report(elapsed),
+            "api_calls": dict(api.calls),
+            "bot": await scrape_bot_metrics(f"http://127.0.0.1:{args.metrics_port}/metrics")
+            if args.metrics_port else {},
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        print(output)
+        if args.output:
+            Path(args.output).write_text(output, encoding="utf-8")
+    finally:
+        if bot_process:
+            bot_process.terminate()
+            try:
+                bot_process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                bot_process.kill()
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушкой Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="порт заглушки Bot API")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--webhook-port", type=int, default=8082)
+    parser.add_argument("--metrics-port", type=int, default=9102, help="порт /metrics бота (0 — не собирать)")
+    parser.add_argument("--learners", type=int, default=1000, help="сколько учеников прогнать")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько учеников активны одновременно")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза между действиями ученика, с")
+    parser.add_argument("--timeout", type=float, default=10.0, help="сколько ждать ответа на действие, с")
+    parser.add_argument("--warmup", type=float, default=1.0, help="пауза после подключения бота, с")
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="сколько ждать запуска бота, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot-cmd", nargs="*", default=[sys.executable, "bot.py"],
+                        help="команда запуска бота (пусто — бот уже запущен и смотрит на заглушку)")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные переменные окружения бота, например SEND_GLOBAL_RATE=1000")
+    parser.add_argument("--output", help="сохранить отчёт в JSON")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,267 @@
+"""
+Воспроизведение записанного трафика (UPDATE_LOG_PATH) на диспетчере бота без сети.
+
+Скрипт импортирует bot.py с фиктивным токеном, подменяет сессию бота заглушкой,
+которая сразу отвечает на методы Bot API (по желанию — с искусственной задержкой),
+и подаёт обновления из журнала в dp.feed_update: с исходными интервалами
+(--speed 1, 2 — вдвое быстрее) или без пауз (--speed 0). Обновления одного
+пользователя обрабатываются строго по порядку, как в исходном трафике.
+
+В отчёте: время каждого обработчика (имена как в метриках bot_handler_seconds),
+ошибки, число запросов к Bot API по методам и общая пропускная способность.
+Перед воспроизведением выполняются фазы запуска бота (данные, база, модели).
+Прогресс пишется во временную базу, лимиты отправки и защита от флуда по умолчанию
+сняты (--keep-send-limits и --keep-flood-limits оставляют их как в боевом режиме);
+отброшенные защитой от флуда обновления попадают в отчёт (dropped).
+
+Пример:
+    UPDATE_LOG_PATH=updates.jsonl python bot.py          # запись
+    python replay.py updates.jsonl --speed 0 --output replay.json
+    python replay.py updates.jsonl --speed 1 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+BASE_DIR = Path(__file__).parent
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("replay")
+
+
+def read_log(path: str, limit: int = 0) -> List[dict]:
+    """Записи журнала по порядку; битые строки (например, оборванная последняя) пропускаются"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                if record["k"] in ("m", "c"):
+                    records.append(record)
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Строка {line_no} пропущена: {e}")
+            if limit and len(records) >= limit:
+                break
+    return records
+
+
+def import_bot(args):
+    """Импортирует bot.py с окружением для воспроизведения"""
+    os.chdir(BASE_DIR)
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:REPLAY")
+    os.environ.setdefault("FSM_STORAGE", "memory")
+    os.environ["UPDATE_LOG_PATH"] = ""  # не записывать воспроизводимый трафик повторно
+    os.environ["DB_PATH"] = str(Path(args.tmp) / "replay.db")
+    if not args.keep_send_limits:
+        for name in ("SEND_GLOBAL_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST"):
+            os.environ.setdefault(name, "1000000")
+    if not args.keep_flood_limits:
+        # Ускоренное воспроизведение иначе упирается в ведро токенов пользователя
+        for name in ("FLOOD_RATE", "FLOOD_DUPLICATE_WINDOW"):
+            os.environ.setdefault(name, "0")
+    return importlib.import_module("bot")
+
+
+def build_stub_session(bot_module, api_latency: float):
+    """Сессия Bot API, которая отвечает без сети; middleware исходной сессии сохраняются"""
+    from aiogram.client.session.base import BaseSession
+
+    from fake_bot_api import MESSAGE_METHODS, FakeBotAPI
+
+    class StubSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            # Заглушка используется только для построения ответов, сервер не запускается
+            self.fake = FakeBotAPI()
+            self.calls: Counter = Counter()
+
+        async def make_request(self, bot, method, timeout=None):
+            api_method = method.__api_method__.lower()
+            self.calls[api_method] += 1
+            if api_latency:
+                await asyncio.sleep(api_latency)
+            params = {
+                key: value for key, value in method.model_dump(exclude_none=True).items()
+                if isinstance(value, (str, int, float))
+            }
+            if api_method == "getme":
+                result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+            elif api_method in MESSAGE_METHODS:
+                result = self.fake.sent_message(api_method, params)
+            else:
+                result = True
+            response = self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result}))
+            return response.result
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+    stub = StubSession()
+    stub.middleware = bot_module.bot.session.middleware
+    return stub
+
+
+class HandlerTimings:
+    """Точное время каждого вызова обработчика (метки как у HandlerMetricsMiddleware)"""
+
+    def __init__(self, handler_labels):
+        self.handler_labels = handler_labels
+        self.durations: Dict[tuple, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    async def __call__(self, handler, event, data):
+        labels = self.handler_labels(event, data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[labels] += 1
+            raise
+        finally:
+            self.durations[labels].append(time.perf_counter() - started)
+
+    def report(self) -> dict:
+        from fake_bot_api import percentile
+
+        report = {}
+        for (handler_name, callback_op), durations in sorted(self.durations.items()):
+            values_ms = [value * 1000 for value in durations]
+            name = f"{handler_name}[{callback_op}]" if callback_op else handler_name
+            report[name] = {
+                "count": len(values_ms),
+                "p50_ms": round(percentile(values_ms, 50), 3),
+                "p95_ms": round(percentile(values_ms, 95), 3),
+                "p99_ms": round(percentile(values_ms, 99), 3),
+                "max_ms": round(max(values_ms), 3),
+                "total_ms": round(sum(values_ms), 3),
+                "errors": self.errors[(handler_name, callback_op)],
+            }
+        return report
+
+
+async def replay(args, records: List[dict]) -> dict:
+    from aiogram import types
+
+    from fake_bot_api import FakeBotAPI
+
+    bot_module = import_bot(args)
+    bot_module.logger.setLevel(getattr(logging, args.bot_log_level))
+    logging.getLogger("aiogram.event").setLevel(getattr(logging, args.bot_log_level))
+    bot, dp = bot_module.bot, bot_module.dp
+    bot.session = build_stub_session(bot_module, args.api_latency)
+    # Как в работающем боте после запуска: данные, тексты, база и модели;
+    # --warm дополнительно выполняет весь фоновый прогрев (меню, медиа, аудио)
+    await asyncio.gather(*bot_module.start_startup_phases(bot_module.phase_names(critical=True)))
+    if args.warm:
+        await bot_module.run_warmup()
+    else:
+        await asyncio.to_thread(bot_module.load_theme_models)
+    timings = HandlerTimings(bot_module.handler_labels)
+    dp.message.middleware(timings)
+    dp.callback_query.middleware(timings)
+
+    updates = FakeBotAPI()
+    user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+    slots = asyncio.Semaphore(args.concurrency)
+    failed = 0
+
+    async def feed(record: dict):
+        nonlocal failed
+        user_id = int(record["u"])
+        if record["k"] == "m":
+            raw = updates.message_update(user_id, record["d"] or args.text)
+        else:
+            raw = updates.callback_update(user_id, record["d"])
+        async with user_locks[user_id], slots:
+            try:
+                await dp.feed_update(bot, types.Update.model_validate(raw, context={"bot": bot}))
+            except Exception as e:
+                failed += 1
+                logger.warning(f"Обновление {record['k']}:{record['d']!r} завершилось ошибкой: {e}")
+
+    tasks = []
+    started = time.perf_counter()
+    first_t = records[0]["t"] if records else 0.0
+    offset = 0.0
+    previous_t = first_t
+    for record in records:
+        if args.speed > 0:
+            # Простои между запусками бота в журнале не воспроизводятся дольше max-gap
+            offset += min(max(record["t"] - previous_t, 0.0), args.max_gap) / args.speed
+            previous_t = record["t"]
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(record)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+    dropped = bot_module.metrics.counters.get("bot_flood_dropped_total", {})
+
+    return {
+        "log": args.log,
+        "speed": args.speed,
+        "api_latency_s": args.api_latency,
+        "updates": len(records),
+        "users": len({record["u"] for record in records}),
+        "failed": failed,
+        "dropped": int(sum(dropped.values())),
+        "dropped_by": {":".join(labels): int(value) for labels, value in dropped.items()},
+        "recorded_span_s": round(records[-1]["t"] - first_t, 3) if records else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(records) / elapsed, 1) if elapsed else 0.0,
+        "handlers": timings.report(),
+        "api_calls": dict(bot.session.calls),
+    }
+
+
+def main(args) -> int:
+    records = read_log(args.log, args.limit)
+    if not records:
+        logger.error(f"В журнале {args.log} нет обновлений")
+        return 1
+    logger.info(f"Воспроизведение {len(records)} обновлений из {args.log}")
+    with tempfile.TemporaryDirectory() as tmp:
+        args.tmp = tmp
+        report = asyncio.run(replay(args, records))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика на заглушке бота")
+    parser.add_argument("log", help="журнал обновлений (UPDATE_LOG_PATH)")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="1 — исходные интервалы, 2 — вдвое быстрее, 0 — без пауз")
+    parser.add_argument("--max-gap", type=float, default=5.0, help="наибольшая пауза между обновлениями, с")
+    parser.add_argument("--concurrency", type=int, default=64, help="сколько обновлений обрабатывать одновременно")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="искусственная задержка ответа Bot API, с")
+    parser.add_argument("--warm", action="store_true", help="прогреть иллюстрации, аудио и медиа до воспроизведения")
+    parser.add_argument("--keep-send-limits", action="store_true", help="не снимать лимиты планировщика отправки")
+    parser.add_argument("--keep-flood-limits", action="store_true", help="не снимать защиту от флуда входящих обновлений")
+    parser.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N обновлений")
+    parser.add_argument("--text", default="привет", help="текст вместо обезличенных сообщений без команды")
+    parser.add_argument("--bot-log-level", default="WARNING", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+    parser.add_argument("--output", help="сохранить отчёт в JSON")
+    sys.exit(main(parser.parse_args()))